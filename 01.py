@@ -1,63 +1,143 @@
 import re
+from contextlib import nullcontext
 import pandas as pd
-from sqlalchemy import create_engine, text
-from unidecode import unidecode
 import configparser
+from aggregates import TableAggregates
+from matching import NgramIndex, iris_quality, normalize_series
+from parallel import (
+    ORDER_COLUMN,
+    DepartementSlices,
+    departement_from_code,
+    departement_pool,
+    map_by_departement,
+)
+from instrumentation import active, distribution, record_counts, stage, step
+from incremental import IncrementalRun, fingerprint_table, reference_context
+from schema import (
+    align_categories,
+    compact_frame,
+    drop_unused_categories,
+    normalized_sql,
+    prepare_normalized_columns,
+)
+from serverside import create_table_as_select, table_columns
+from export import EXPORT_FORMAT, export_table
+from storage import open_storage
 
 # Load configuration
 config = configparser.ConfigParser()
 config.read("./config.ini")
 
-DB_CONFIG = {
-    "host": config["database"]["host"],
-    "user": config["database"]["user"],
-    "password": config["database"]["password"],
-    "database": config["database"]["database"],
-    "port": config["database"].get("port", "3306"),
-}
 
-# Construct the database URL for SQLAlchemy
-db_url = f"mysql+pymysql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
+def normalize_column_name(col_name):
+    if col_name is None:
+        return None
+    col_name = col_name.lower()
+    col_name = re.sub(r"[^a-z0-9]", "_", col_name)
+    return col_name
 
 
-def EG_Insee_Iris(
-    table_entree,
-    top_tnp,
-    civilite=None,
-    prenom=None,
-    nom=None,
-    complement_nom=None,
-    adresse=None,
-    complement_adrs=None,
-    lieu_dit=None,
-    cp=None,
-    ville=None,
-    id_client=None,
-    pays=None,
-    email=None,
-    tel=None,
+def indexer_references_insee_iris(REFCPDF, REFIRISGEO2024DF):
+    """Associe à refCP et Ref_IRIS_geo2024 les index du rapprochement approché.
+
+    Les communes sont indexées par code postal, les IRIS par code commune.
+    """
+    return (
+        REFCPDF,
+        REFIRISGEO2024DF,
+        NgramIndex(REFCPDF["code_postal"], REFCPDF["nom_de_la_commune_normalized"]),
+        NgramIndex(
+            REFIRISGEO2024DF["depcom"], REFIRISGEO2024DF["lib_iris_normalized"]
+        ),
+    )
+
+
+def charger_references_insee_iris(storage):
+    """Charge une seule fois refCP et Ref_IRIS_geo2024 (noms déjà normalisés)."""
+    REFCPDF = storage.read_table("refcp")
+    REFIRISGEO2024DF = storage.read_table("ref_iris_geo2024")
+    return indexer_references_insee_iris(REFCPDF, REFIRISGEO2024DF)
+
+
+def decouper_references_insee_iris(references):
+    """Découpe refCP et Ref_IRIS_geo2024 par département du code postal.
+
+    La tranche IRIS d'un département contient les IRIS de toutes les communes
+    de sa tranche refCP, y compris celles rattachées à un autre département.
+    Chaque tranche ne garde que ses propres catégories.
+    """
+    REFCPDF, REFIRISGEO2024DF = references[:2]
+    slices = {}
+    for departement, refcp_departement in REFCPDF.groupby(
+        departement_from_code(REFCPDF["code_postal"], 5).values, sort=False
+    ):
+        c_insee = refcp_departement["code_commune_insee"]
+        slices[departement] = indexer_references_insee_iris(
+            drop_unused_categories(refcp_departement),
+            drop_unused_categories(
+                REFIRISGEO2024DF[REFIRISGEO2024DF["depcom"].isin(c_insee)]
+            ),
+        )
+    return DepartementSlices(
+        slices,
+        indexer_references_insee_iris(
+            drop_unused_categories(REFCPDF.iloc[:0]),
+            drop_unused_categories(REFIRISGEO2024DF.iloc[:0]),
+        ),
+    )
+
+
+def completer_par_similarite(
+    enriched_df, a_completer, cle, libelle, reference, index, colonnes, seuil
 ):
-    """Enrichit un DataFrame avec des données INSEE et IRIS.
+    """Complète les lignes non rapprochées par le libellé de référence voisin.
 
     Args:
-        table_entree (pd.DataFrame): DataFrame d'entrée.
+        enriched_df (pd.DataFrame): Lot en cours d'enrichissement, modifié en place.
+        a_completer (pd.Series): Lignes sans correspondance exacte.
+        cle (str): Colonne du lot limitant les candidats (code postal, commune).
+        libelle (str): Colonne du libellé normalisé du lot.
+        reference (pd.DataFrame): Table de référence.
+        index (NgramIndex): Index des libellés de la référence, par clé.
+        colonnes (list): Colonnes de la référence recopiées dans le lot.
+        seuil (float): Similarité minimale des trigrammes, entre 0 et 1.
+
+    Returns:
+        pd.Series: Lignes complétées par rapprochement approché.
+    """
+    a_completer = a_completer & enriched_df[cle].notna() & (enriched_df[libelle] != "")
+    complete = pd.Series(False, index=enriched_df.index)
+    if not a_completer.any():
+        return complete
+    lignes = enriched_df.index[a_completer.to_numpy()]
+    positions = index.match(
+        enriched_df.loc[lignes, cle], enriched_df.loc[lignes, libelle], seuil
+    )
+    trouve = positions >= 0
+    enriched_df.loc[lignes[trouve], colonnes] = (
+        reference[colonnes].iloc[positions[trouve]].to_numpy()
+    )
+    complete[lignes[trouve]] = True
+    return complete
+
+
+def enrichir_insee_iris(table_entree, references, top_tnp, champs, seuil=None):
+    """Ajoute c_insee, c_iris, c_qualite_iris et codgeo à un lot de clients.
+
+    Args:
+        table_entree (pd.DataFrame): Lot de clients.
+        references (tuple): Tables renvoyées par charger_references_insee_iris.
         top_tnp (int): Indicateur pour déterminer la logique d'analyse des noms.
-        civilite, prenom, nom, ... (str, optional): Noms de colonnes pour divers champs. Par défaut à None.
+        champs (dict): Noms de colonnes passés à EG_Insee_Iris (civilite, prenom, ...).
+        seuil (float, optional): Similarité minimale du rapprochement approché
+            des communes et lieux-dits restés sans correspondance exacte. Par
+            défaut à None (correspondances exactes seules).
 
     Returns:
-        pd.DataFrame: DataFrame enrichi.
+        pd.DataFrame: Lot enrichi.
     """
-    # Connexion à la base de données
-    engine = create_engine(db_url)
-    REFCPDF = pd.read_sql_table("refcp", con=engine)
-    REFIRISGEO2024DF = pd.read_sql_table("ref_iris_geo2024", con=engine)
-
-    def normalize_column_name(col_name):
-        if col_name is None:
-            return None
-        col_name = col_name.lower()
-        col_name = re.sub(r"[^a-z0-9]", "_", col_name)
-        return col_name
+    REFCPDF, REFIRISGEO2024DF, INDEX_COMMUNES, INDEX_IRIS = references
+    nom = champs["nom"]
 
     enriched_df = table_entree.copy()
 
@@ -67,25 +147,7 @@ def EG_Insee_Iris(
         enriched_df["prenom"] = split_names[1]
         enriched_df["nom"] = split_names[2]
     else:
-        columns_to_select = [
-            col
-            for col in [
-                civilite,
-                prenom,
-                nom,
-                complement_nom,
-                adresse,
-                complement_adrs,
-                lieu_dit,
-                cp,
-                ville,
-                id_client,
-                pays,
-                email,
-                tel,
-            ]
-            if col is not None
-        ]
+        columns_to_select = [col for col in champs.values() if col is not None]
         normalized_columns = [normalize_column_name(col) for col in columns_to_select]
         enriched_df = enriched_df[normalized_columns]
 
@@ -93,58 +155,90 @@ def EG_Insee_Iris(
         normalize_column_name(col) for col in enriched_df.columns if col is not None
     ]
 
-    enriched_df["ville_normalized"] = enriched_df["ville"].apply(
-        lambda x: unidecode(str(x).lower().replace("-", " "))
-    )
-    REFCPDF["nom_de_la_commune_normalized"] = REFCPDF["nom_de_la_commune"].apply(
-        lambda x: unidecode(str(x).lower().replace("-", " "))
-    )
+    # Reference names come already normalized from the snapshot cache
+    with step("normalisation", rows=len(enriched_df)):
+        enriched_df["ville_normalized"] = normalize_series(enriched_df["ville"])
+        enriched_df["lieu_dit_normalized"] = normalize_series(enriched_df["lieu_dit"])
 
-    enriched_df["lieu_dit_normalized"] = enriched_df["lieu_dit"].apply(
-        lambda x: unidecode(str(x).lower().replace("-", " ")) if pd.notna(x) else ""
-    )
-    REFIRISGEO2024DF["lib_iris_normalized"] = REFIRISGEO2024DF["lib_iris"].apply(
-        lambda x: unidecode(str(x).lower().replace("-", " ")) if pd.notna(x) else ""
-    )
-
-    enriched_df = enriched_df.merge(
-        REFCPDF[
-            [
-                "code_postal",
-                "code_commune_insee",
-                "nom_de_la_commune",
-                "nom_de_la_commune_normalized",
-            ]
-        ],
-        how="left",
-        left_on=["cp", "ville_normalized"],
-        right_on=["code_postal", "nom_de_la_commune_normalized"],
-    )
+    with step("fusion communes", rows=len(enriched_df)) as measured:
+        # Postcodes joined on their category codes rather than their strings
+        enriched_df["cp"], code_postal = align_categories(
+            enriched_df["cp"], REFCPDF["code_postal"]
+        )
+        enriched_df = enriched_df.merge(
+            REFCPDF[
+                [
+                    "code_postal",
+                    "code_commune_insee",
+                    "nom_de_la_commune",
+                    "nom_de_la_commune_normalized",
+                ]
+            ].assign(code_postal=code_postal),
+            how="left",
+            left_on=["cp", "ville_normalized"],
+            right_on=["code_postal", "nom_de_la_commune_normalized"],
+        )
+        measured.rows_out = len(enriched_df)
+    # Second pass, for the unmatched rows only: closest commune of the postcode
+    approche = pd.Series(False, index=enriched_df.index)
+    if seuil:
+        with step("similarite communes"):
+            approche = completer_par_similarite(
+                enriched_df,
+                enriched_df["code_commune_insee"].isna(),
+                "cp",
+                "ville_normalized",
+                REFCPDF,
+                INDEX_COMMUNES,
+                [
+                    "code_postal",
+                    "code_commune_insee",
+                    "nom_de_la_commune",
+                    "nom_de_la_commune_normalized",
+                ],
+                seuil,
+            )
     enriched_df["c_insee"] = enriched_df["code_commune_insee"]
+    # Carried as a column through the IRIS merge, which may repeat rows
+    enriched_df["approche"] = approche
 
-    enriched_df["c_insee"] = enriched_df["c_insee"].apply(
-        lambda x: f"0{x}" if pd.notna(x) and len(str(x)) == 4 else x
-    )
-
-    enriched_df = enriched_df.merge(
-        REFIRISGEO2024DF[["depcom", "lib_iris", "lib_iris_normalized", "code_iris"]],
-        how="left",
-        left_on=["c_insee", "lieu_dit_normalized"],
-        right_on=["depcom", "lib_iris_normalized"],
-    )
+    with step("fusion iris", rows=len(enriched_df)) as measured:
+        enriched_df["c_insee"], depcom = align_categories(
+            enriched_df["c_insee"], REFIRISGEO2024DF["depcom"]
+        )
+        enriched_df = enriched_df.merge(
+            REFIRISGEO2024DF[
+                ["depcom", "lib_iris", "lib_iris_normalized", "code_iris"]
+            ].assign(depcom=depcom),
+            how="left",
+            left_on=["c_insee", "lieu_dit_normalized"],
+            right_on=["depcom", "lib_iris_normalized"],
+        )
+        measured.rows_out = len(enriched_df)
+    if seuil:
+        # Closest IRIS label of the commune
+        with step("similarite iris"):
+            enriched_df["approche"] |= completer_par_similarite(
+                enriched_df,
+                enriched_df["code_iris"].isna(),
+                "c_insee",
+                "lieu_dit_normalized",
+                REFIRISGEO2024DF,
+                INDEX_IRIS,
+                ["depcom", "lib_iris", "lib_iris_normalized", "code_iris"],
+                seuil,
+            )
 
     enriched_df["c_iris"] = enriched_df["code_iris"].str[-4:].fillna("0000")
 
-    enriched_df["c_qualite_iris"] = enriched_df.apply(
-        lambda row: (
-            1
-            if pd.notna(row["code_iris"]) and pd.notna(row["c_insee"])
-            else (2 if pd.notna(row["c_insee"]) else 8)
-        ),
-        axis=1,
+    enriched_df["c_qualite_iris"] = iris_quality(
+        enriched_df["code_iris"], enriched_df["c_insee"], enriched_df["approche"]
     )
 
-    enriched_df["codgeo"] = enriched_df["c_insee"].fillna("") + enriched_df["c_iris"]
+    # Plain values rather than categories: "" is not one of the commune codes
+    enriched_df["codgeo"] = (
+        enriched_df["c_insee"].astype(object).fillna("") + enriched_df["c_iris"]
+    )
 
     original_columns = enriched_df.columns.tolist()
     enriched_df = enriched_df[original_columns].drop(
@@ -153,36 +247,341 @@ def EG_Insee_Iris(
             "lieu_dit_normalized",
             "nom_de_la_commune_normalized",
             "lib_iris_normalized",
+            "approche",
         ]
     )
 
-    # Enregistrer dans la base de données, en supprimant la table si elle existe
+    return enriched_df
+
+
+def enrichir_insee_iris_sql(table_entree, top_tnp, champs, table_name, engine):
+    """Réalise l'enrichissement INSEE/IRIS dans MySQL par CREATE TABLE ... AS SELECT.
+
+    Les libellés normalisés des références sont des colonnes générées par la
+    base ; ceux des clients sont calculés dans la jointure. Aucune ligne ne
+    transite par Python.
+
+    Args:
+        table_entree (str): Nom de la table des clients.
+        top_tnp (int): Indicateur pour déterminer la logique d'analyse des noms.
+        champs (dict): Noms de colonnes passés à EG_Insee_Iris (civilite, prenom, ...).
+        table_name (str): Table à créer.
+        engine (sqlalchemy.Engine): Connexion à la base de données.
+
+    Returns:
+        int: Nombre de lignes écrites.
+    """
+    prepare_normalized_columns(["refcp", "ref_iris_geo2024"], engine)
+
+    colonnes = {
+        normalize_column_name(col): f"c.`{col}`"
+        for col in table_columns(table_entree, engine)
+    }
+
+    if top_tnp == 1:
+        selection = dict(colonnes)
+        nom = colonnes[normalize_column_name(champs["nom"])]
+        # Same tokens as str.split(): the n-th run of non-blank characters
+        for position, col in enumerate(["gender", "prenom", "nom"], start=1):
+            selection[col] = f"REGEXP_SUBSTR({nom}, '[^[:space:]]+', 1, {position})"
+    else:
+        selection = {}
+        for col in champs.values():
+            if col is None:
+                continue
+            col = normalize_column_name(col)
+            if col not in colonnes:
+                raise ValueError(f"La colonne '{col}' n'existe pas dans {table_entree}.")
+            selection[col] = colonnes[col]
+
+    c_iris = "COALESCE(RIGHT(i.code_iris, 4), '0000')"
+    selection.update(
+        {
+            "code_postal": "r.code_postal",
+            "code_commune_insee": "r.code_commune_insee",
+            "nom_de_la_commune": "r.nom_de_la_commune",
+            "c_insee": "r.code_commune_insee",
+            "depcom": "i.depcom",
+            "lib_iris": "i.lib_iris",
+            "code_iris": "i.code_iris",
+            "c_iris": c_iris,
+            "c_qualite_iris": (
+                "CASE WHEN i.code_iris IS NOT NULL"
+                " AND r.code_commune_insee IS NOT NULL THEN 1"
+                " WHEN r.code_commune_insee IS NOT NULL THEN 2 ELSE 8 END"
+            ),
+            "codgeo": f"CONCAT(COALESCE(r.code_commune_insee, ''), {c_iris})",
+        }
+    )
+
+    colonnes_select = ", ".join(
+        f"{expression} AS `{col}`" for col, expression in selection.items()
+    )
+    select = f"""
+    SELECT {colonnes_select}
+    FROM `{table_entree}` c
+    LEFT JOIN refcp r
+        ON r.code_postal = {selection["cp"]}
+        AND r.nom_de_la_commune_normalized = {normalized_sql(selection["ville"])}
+    LEFT JOIN ref_iris_geo2024 i
+        ON i.depcom = r.code_commune_insee
+        AND i.lib_iris_normalized = {normalized_sql(selection["lieu_dit"])}
+    """
+    return create_table_as_select(table_name, select, engine)
+
+
+def EG_Insee_Iris(
+    table_entree,
+    top_tnp,
+    civilite=None,
+    prenom=None,
+    nom=None,
+    complement_nom=None,
+    adresse=None,
+    complement_adrs=None,
+    lieu_dit=None,
+    cp=None,
+    ville=None,
+    id_client=None,
+    pays=None,
+    email=None,
+    tel=None,
+    chunksize=None,
+    workers=None,
+    execution=None,
+    incremental=False,
+    seuil_similarite=None,
+    enregistrer=True,
+):
+    """Enrichit un DataFrame avec des données INSEE et IRIS.
+
+    Args:
+        table_entree (pd.DataFrame | str): DataFrame d'entrée, ou nom de la table
+            à lire par lots en mode streaming.
+        top_tnp (int): Indicateur pour déterminer la logique d'analyse des noms.
+        civilite, prenom, nom, ... (str, optional): Noms de colonnes pour divers champs. Par défaut à None.
+        chunksize (int, optional): Taille des lots du mode streaming. Par défaut à None
+            (tout le DataFrame est enrichi en mémoire).
+        workers (int, optional): Nombre de processus ; au-delà de 1, les clients sont
+            répartis par département du code postal. Par défaut à None (un seul cœur).
+        execution (str, optional): "sql" pour réaliser les jointures dans MySQL, à
+            partir d'un nom de table ; chunksize et workers sont alors ignorés.
+            Par défaut à None (jointures pandas).
+        incremental (bool, optional): N'enrichit que les clients nouveaux ou modifiés
+            depuis l'exécution précédente et remplace leurs lignes dans la table de
+            sortie, au lieu de la recréer. Nécessite id_client. Par défaut à False.
+        seuil_similarite (float, optional): Similarité minimale (0 à 1) du
+            rapprochement approché des villes et lieux-dits sans correspondance
+            exacte, marqué c_qualite_iris = 3. Par défaut à None (désactivé).
+        enregistrer (bool, optional): Écrit le résultat dans la table de sortie.
+            False n'est possible qu'en mémoire, sans chunksize, incremental ni
+            exécution "sql" : le DataFrame enrichi est seulement renvoyé.
+            Par défaut à True.
+
+    Returns:
+        pd.DataFrame | int: DataFrame enrichi, ou nombre de lignes écrites en mode
+            streaming ou sql.
+    """
+    champs = {
+        "civilite": civilite,
+        "prenom": prenom,
+        "nom": nom,
+        "complement_nom": complement_nom,
+        "adresse": adresse,
+        "complement_adrs": complement_adrs,
+        "lieu_dit": lieu_dit,
+        "cp": cp,
+        "ville": ville,
+        "id_client": id_client,
+        "pays": pays,
+        "email": email,
+        "tel": tel,
+    }
+
+    # Stockage des tables (section [database] de config.ini)
+    storage = open_storage()
     table_name = "01eg_insee_iris"
 
-    with engine.connect() as connection:
-        with connection.begin():
-            connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+    if not enregistrer and (chunksize is not None or incremental or execution == "sql"):
+        raise ValueError(
+            "Seul l'enrichissement en mémoire peut se passer de la table de sortie."
+        )
 
-        enriched_df.to_sql(table_name, con=engine, index=False, if_exists="replace")
+    # Server-side mode: neither the clients nor the references are read in Python
+    if execution == "sql":
+        if incremental:
+            raise ValueError(
+                "Le mode incrémental n'est pas disponible en exécution 'sql'."
+            )
+        if seuil_similarite:
+            raise ValueError(
+                "Le rapprochement approché n'est pas disponible en exécution 'sql'."
+            )
+        if not isinstance(table_entree, str):
+            raise ValueError("Le mode d'exécution 'sql' nécessite un nom de table.")
+        storage.require_mysql("L'exécution 'sql'")
+        with step("jointure sql") as measured:
+            measured.rows_out = enrichir_insee_iris_sql(
+                table_entree, top_tnp, champs, table_name, storage.engine
+            )
+        if active():
+            # Counted by the database, like the join itself
+            counts = TableAggregates(storage, table_name).counts(["c_qualite_iris"])
+            record_counts(
+                "c_qualite_iris", counts.set_index("c_qualite_iris")["count"]
+            )
+        return measured.rows_out
 
-    return enriched_df
+    with step("references"):
+        references = charger_references_insee_iris(storage)
+
+    if incremental:
+        storage.require_mysql("Le mode incrémental")
+        if id_client is None:
+            raise ValueError("Le mode incrémental nécessite la colonne id_client.")
+        # Fingerprinted fields: those copied to the output table
+        colonnes_empreinte = None
+        if top_tnp != 1:
+            colonnes_empreinte = [
+                normalize_column_name(col) for col in champs.values() if col is not None
+            ]
+        suivi = IncrementalRun(
+            table_name,
+            id_client,
+            normalize_column_name(id_client),
+            colonnes_empreinte,
+            reference_context(
+                {"top_tnp": top_tnp, "champs": champs, "seuil": seuil_similarite},
+                ["refcp", "ref_iris_geo2024"],
+                storage,
+            ),
+            storage.engine,
+        )
+    else:
+        suivi = None
+        if enregistrer:
+            # The output table is replaced once written; its fingerprints go stale
+            storage.drop_table(fingerprint_table(table_name))
+
+    slices = None
+    if workers and workers > 1:
+        with step("decoupage references"):
+            slices = decouper_references_insee_iris(references)
+
+    with (
+        departement_pool(workers, slices) if slices is not None else nullcontext()
+    ) as executor:
+        if executor is not None:
+            # Keeps the row-order column through the column selection of top_tnp=0
+            champs_lot = {**champs, ORDER_COLUMN: ORDER_COLUMN}
+
+        def enrichir(lot):
+            with step("enrichissement", rows=len(lot)) as measured:
+                if executor is None:
+                    enriched_lot = enrichir_insee_iris(
+                        lot, references, top_tnp, champs, seuil_similarite
+                    )
+                else:
+                    cp_column = next(
+                        col
+                        for col in lot.columns
+                        if normalize_column_name(col) == "cp"
+                    )
+                    enriched_lot = map_by_departement(
+                        enrichir_insee_iris,
+                        lot,
+                        departement_from_code(lot[cp_column], 5),
+                        (top_tnp, champs_lot, seuil_similarite),
+                        executor,
+                    )
+                measured.rows_out = len(enriched_lot)
+            # Match quality: 1 IRIS, 2 commune only, 3 approximate, 8 none
+            distribution("c_qualite_iris", enriched_lot["c_qualite_iris"])
+            return enriched_lot
+
+        if chunksize is None and suivi is not None:
+            lot, empreintes = suivi.select(table_entree)
+            enriched_df = enrichir(lot) if len(lot) else lot
+            suivi.write(enriched_df, empreintes)
+            suivi.finish()
+            return enriched_df
+
+        if chunksize is None:
+            # The whole table stays in memory: codes and labels as categories,
+            # without those of the references that no client uses
+            enriched_df = compact_frame(drop_unused_categories(enrichir(table_entree)))
+            if enregistrer:
+                storage.write_table(enriched_df, table_name)
+            return enriched_df
+
+        # Streaming mode: memory is bounded by the chunk size, not the client count
+        total_rows = 0
+        # Chunks fill a staging table, indexed and swapped in once complete
+        writer = None if suivi is not None else storage.table_writer(table_name)
+        with writer or nullcontext():
+            for chunk in storage.read_table_in_chunks(table_entree, chunksize):
+                if suivi is not None:
+                    chunk, empreintes = suivi.select(chunk)
+                    if chunk.empty:
+                        continue
+                enriched_chunk = enrichir(chunk)
+                if suivi is not None:
+                    suivi.write(enriched_chunk, empreintes)
+                else:
+                    with step(f"ecriture {table_name}", rows=len(enriched_chunk)):
+                        writer.write(enriched_chunk)
+                total_rows += len(enriched_chunk)
+
+        if suivi is not None:
+            # The table was indexed when the first changed rows created it
+            suivi.finish()
+        return total_rows
 
 
 # Exemple d'utilisation
+if __name__ == "__main__":
+    # Stockage des tables (section [database] de config.ini)
+    storage = open_storage()
 
-# Connexion à la base de données
-engine = create_engine(db_url)
-
-enriched_table = EG_Insee_Iris(
-    table_entree=pd.read_sql_table("true_table_entree", con=engine),
-    top_tnp=0,
-    cp="cp",
-    ville="ville",
-    id_client="id_client",
-    lieu_dit="lieu_dit",
-    civilite="civilit_",
-    nom="nom",
-    prenom="prenom",
-)
+    # Taille des lots du mode streaming (0 : enrichissement en mémoire)
+    CHUNKSIZE = config.getint("enrichissement", "chunksize", fallback=0)
+    # Nombre de processus (1 : un seul cœur)
+    WORKERS = config.getint("enrichissement", "workers", fallback=1)
+    # Jointures réalisées par pandas ou dans MySQL (sql)
+    EXECUTION = config.get("enrichissement", "execution", fallback="pandas")
+    # Enrichissement des seuls clients nouveaux ou modifiés
+    INCREMENTAL = config.getboolean("enrichissement", "incremental", fallback=False)
+    # Similarité minimale du rapprochement approché (0 : correspondances exactes)
+    SIMILARITE = config.getfloat("enrichissement", "similarite", fallback=0)
+
+    # Durées, mémoire et taux de rapprochement (section [instrumentation])
+    with stage("01"):
+        enriched_table = EG_Insee_Iris(
+            table_entree=(
+                "true_table_entree"
+                if CHUNKSIZE or EXECUTION == "sql"
+                else storage.read_table("true_table_entree")
+            ),
+            top_tnp=0,
+            cp="cp",
+            ville="ville",
+            id_client="id_client",
+            lieu_dit="lieu_dit",
+            civilite="civilit_",
+            nom="nom",
+            prenom="prenom",
+            chunksize=CHUNKSIZE or None,
+            workers=WORKERS,
+            execution=EXECUTION,
+            incremental=INCREMENTAL,
+            seuil_similarite=SIMILARITE or None,
+        )
+
+        print(enriched_table)
 
-print(enriched_table)
+        if EXPORT_FORMAT:
+            # Only the complete table, when in memory, spares reading it back
+            complete = isinstance(enriched_table, pd.DataFrame) and not INCREMENTAL
+            export_table(
+                storage, "01eg_insee_iris", df=enriched_table if complete else None
+            )
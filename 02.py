@@ -1,42 +1,85 @@
 import re
+from contextlib import nullcontext
 import pandas as pd
-from sqlalchemy import create_engine, text
-from unidecode import unidecode
 import numpy as np
 import configparser
+from incremental import IncrementalRun, fingerprint_table, reference_context
+from instrumentation import distribution, stage, step
+from parallel import DepartementSlices, departement_pool, map_by_departement
+from prenoms import PROFILE_TABLE, load_first_name_profile, lookup_first_names
+from export import EXPORT_FORMAT, export_table
+from schema import compact_frame, drop_unused_categories, map_categories
+from storage import open_storage
 
 # Load configuration from config.ini
 config = configparser.ConfigParser()
 config.read("./config.ini")
 
-DB_CONFIG = {
-    "host": config["database"]["host"],
-    "user": config["database"]["user"],
-    "password": config["database"]["password"],
-    "database": config["database"]["database"],
-    "port": config["database"].get("port", "3306"),
+# Connect to the database (backend set in config.ini)
+storage = open_storage()
+
+# Mean age of each age bucket of tbrefgeo
+AGE_BUCKETS = {
+    "age_0_5": 2.5,
+    "age_6_10": 8,
+    "age_11_17": 14,
+    "age_18_24": 21,
+    "age_25_39": 32,
+    "age_40_54": 47,
+    "age_55_64": 60,
+    "age_65_79": 72,
+    "age_over_80": 85,
 }
 
-# Construct the database URL for SQLAlchemy
-db_url = f"mysql+pymysql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
 
-# Connect to the MySQL database
-engine = create_engine(db_url)
+def charger_references_age_sexe(storage):
+    """Charge une seule fois l'âge moyen par codgeo et le profil des prénoms."""
+    # Fetch geographical reference data (without id_client)
+    tbrefgeo = storage.read_table("tbrefgeo")
+
+    # Weighted mean age per codgeo, computed once over tbrefgeo and
+    # attached to the clients with a single hash join. The counts may be read
+    # as small integers: the weighted sums are computed in float64
+    effectifs = tbrefgeo[list(AGE_BUCKETS)].to_numpy(dtype=np.float64, na_value=np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        age_estim = effectifs @ np.array(list(AGE_BUCKETS.values())) / np.nansum(
+            effectifs, axis=1
+        )
+    age_par_codgeo = pd.Series(age_estim, index=tbrefgeo["codgeo"].astype(str))
+    age_par_codgeo = age_par_codgeo[~age_par_codgeo.index.duplicated()]
 
+    # Fetch the precomputed first-name profile
+    profil_prenoms = load_first_name_profile(storage)
 
-def EG_age_sexe(
+    return age_par_codgeo, profil_prenoms
+
+
+def decouper_references_age_sexe(references):
+    """Découpe l'âge par codgeo par département ; le profil des prénoms reste entier."""
+    age_par_codgeo, profil_prenoms = references
+    slices = {
+        departement: (age_departement, profil_prenoms)
+        for departement, age_departement in age_par_codgeo.groupby(
+            age_par_codgeo.index.astype(str).str[:2], sort=False
+        )
+    }
+    return DepartementSlices(slices, (age_par_codgeo.iloc[:0], profil_prenoms))
+
+
+def estimer_age_sexe(
     tb_client,
+    references,
     prenom,
-    sexe="NA",
-    age_declare="NA",
-    top_estim_sexe=1,
-    codgeo="codegeo",
-    ajust=0,
-    var_ajust="NA",
+    sexe,
+    age_declare,
+    top_estim_sexe,
+    codgeo,
+    current_year,
 ):
-    # Check validity of columns
+    """Estime le sexe et l'âge (avant ajustement) d'un lot de clients."""
+    age_par_codgeo, profil_prenoms = references
 
-    # Database connection for reading tables
+    # Check validity of columns
     required_columns = [prenom, codgeo]
     if sexe != "NA":
         required_columns.append(sexe)
@@ -47,171 +90,311 @@ def EG_age_sexe(
         if col not in tb_client.columns:
             raise ValueError(f"La colonne '{col}' n'existe pas dans tb_client.")
 
-    tb_client[codgeo] = tb_client[codgeo].astype(str)
-    tb_client["c_insee"] = tb_client[codgeo].str[:5]
-    tb_client["c_iris"] = tb_client[codgeo].str[4:]
+    # Categorical codes stay categories: sliced and looked up once per category
+    if not isinstance(tb_client[codgeo].dtype, pd.CategoricalDtype):
+        tb_client[codgeo] = tb_client[codgeo].astype(str)
+    tb_client["c_insee"] = map_categories(tb_client[codgeo], lambda c: c.str[:5])
+    tb_client["c_iris"] = map_categories(tb_client[codgeo], lambda c: c.str[4:])
 
-    # Fetch geographical reference data (without id_client)
-    tbrefgeo = pd.read_sql_table("tbrefgeo", con=engine)
-
-    # Fetch the names table
-    tb_prenoms = pd.read_sql_table("table_prenoms", con=engine)
+    # Look every client's first name up once in the profile
+    with step("prenoms", rows=len(tb_client)):
+        profil_client = lookup_first_names(
+            profil_prenoms, tb_client[prenom], current_year
+        )
 
     tb_client["sexe"] = tb_client[sexe] if sexe != "NA" else "NA"
 
     # Estimate gender based on the name if required
     if top_estim_sexe == 1:
+        sexe_prenom = np.where(
+            profil_client["part_f"].notna(),
+            np.where(profil_client["part_f"] >= 0.5, "F", "M"),
+            np.where(tb_client[prenom].str[-1].str.lower() == "a", "F", "M"),
+        )
         tb_client["e_sexe"] = np.where(
-            tb_client["sexe"].isin(["H", "F"]),
-            tb_client["sexe"],
-            tb_client[prenom].apply(lambda x: "F" if x[-1].lower() == "a" else "M"),
+            tb_client["sexe"].isin(["H", "F"]), tb_client["sexe"], sexe_prenom
         )
     else:
         tb_client["e_sexe"] = np.nan
 
-    def estimer_age_geo(client_codgeo):
-        if len(client_codgeo) == 8:
-            client_codgeo = "0" + client_codgeo
-
-        geo_data = tbrefgeo[tbrefgeo["codgeo"] == client_codgeo]
-        if geo_data.empty:
-            return np.nan
-
-        age_estim = (
-            (
-                geo_data["age_0_5"] * 2.5
-                + geo_data["age_6_10"] * 8
-                + geo_data["age_11_17"] * 14
-                + geo_data["age_18_24"] * 21
-                + geo_data["age_25_39"] * 32
-                + geo_data["age_40_54"] * 47
-                + geo_data["age_55_64"] * 60
-                + geo_data["age_65_79"] * 72
-                + geo_data["age_over_80"] * 85
-            )
-            / geo_data[
-                [
-                    "age_0_5",
-                    "age_6_10",
-                    "age_11_17",
-                    "age_18_24",
-                    "age_25_39",
-                    "age_40_54",
-                    "age_55_64",
-                    "age_65_79",
-                    "age_over_80",
-                ]
-            ].sum(axis=1)
-        ).values[0]
-
-        return age_estim
-
     if age_declare != "NA" and age_declare in tb_client.columns:
         tb_client["e_age"] = tb_client[age_declare]
         tb_client["e_top_age_ok"] = 1
     else:
-        tb_client["e_age_geo"] = tb_client[codgeo].apply(estimer_age_geo)
+        with step("age codgeo", rows=len(tb_client)):
+            tb_client["e_age_geo"] = (
+                tb_client[codgeo].map(age_par_codgeo).astype(float)
+            )
 
-        def estimer_age_prenom_nom(prenom):
-            prenom_cleaned = unidecode(prenom).lower()
-            prenom_data = tb_prenoms[tb_prenoms["prenom"].str.lower() == prenom_cleaned]
+        tb_client["e_age_prenom"] = profil_client["age_prenom"]
 
-            if prenom_data.empty:
-                return np.nan
+        tb_client["e_age"] = tb_client[["e_age_geo", "e_age_prenom"]].mean(
+            axis=1, skipna=True
+        )
 
-            current_year = pd.Timestamp.now().year
-            ages = []
+        tb_client["e_top_age_ok"] = np.where(tb_client["e_age"].notna(), 2, 3)
 
-            for year in range(1913, 2015):
-                year_column = f"n{year}"
-                if year_column in prenom_data.columns:
-                    count = prenom_data[year_column].values[0]
-                    if count > 0:
-                        ages.append(current_year - year)
+    return tb_client
 
-            return np.mean(ages) if ages else np.nan
 
-        tb_client["e_age_prenom"] = tb_client.apply(
-            lambda x: estimer_age_prenom_nom(x[prenom]), axis=1
-        )
+def moyennes_ajustement(tb_client, var_ajust):
+    """Âge estimé moyen, par valeur de var_ajust ou sur toute la table."""
+    if var_ajust != "NA" and var_ajust in tb_client.columns:
+        return tb_client.groupby(var_ajust, observed=True)["e_age"].mean()
+    return tb_client["e_age"].mean()
 
-        tb_client["e_age"] = tb_client[["e_age_geo", "e_age_prenom"]].mean(
-            axis=1, skipna=True
+
+def sommes_ajustement(tb_client, var_ajust):
+    """Somme et nombre d'âges estimés, par valeur de var_ajust ou sur tout le lot."""
+    if var_ajust != "NA" and var_ajust in tb_client.columns:
+        return tb_client.groupby(var_ajust, observed=True)["e_age"].agg(
+            ["sum", "count"]
         )
+    return pd.DataFrame(
+        {"sum": [tb_client["e_age"].sum()], "count": [tb_client["e_age"].count()]}
+    )
 
-        tb_client["e_top_age_ok"] = np.where(tb_client["e_age"].notna(), 2, 3)
 
-    if ajust == 1:
-        if var_ajust != "NA" and var_ajust in tb_client.columns:
-            grouped_ages = tb_client.groupby(var_ajust)["e_age"].transform("mean")
-            tb_client["e_age"] = (
-                tb_client["e_age"] - (tb_client["e_age"] - grouped_ages) / 2
-            )
-        else:
-            mean_age = tb_client["e_age"].mean()
-            tb_client["e_age"] = (
-                tb_client["e_age"] - (tb_client["e_age"] - mean_age) / 2
-            )
+def ajuster_age(tb_client, var_ajust, moyennes):
+    """Rapproche e_age de moitié vers la moyenne de son groupe (ou globale)."""
+    if isinstance(moyennes, pd.Series):
+        # Mapped categories stay categories: the means are turned into floats
+        moyennes = tb_client[var_ajust].map(moyennes).astype(float)
+    tb_client["e_age"] = tb_client["e_age"] - (tb_client["e_age"] - moyennes) / 2
+    return tb_client
 
-    current_year = pd.Timestamp.now().year
+
+def finaliser_age_sexe(tb_client, current_year):
+    """Ajoute l'année de naissance, e_p_5ans et l'indice de confiance."""
     tb_client["e_annee_naissance"] = current_year - tb_client["e_age"].round().astype(
-        int
+        "Int64"
     )
 
     tb_client["e_p_5ans"] = 0.9
 
-    def ajuster_indice_confiance(row):
-        age_geo = row["e_age_geo"]
-        age_prenom = row["e_age_prenom"]
-
-        if pd.notna(age_geo) and pd.notna(age_prenom):
-            if abs(age_geo - age_prenom) < 5:
-                return "Confiance ++"
-            elif abs(age_geo - age_prenom) < 10:
-                return "Confiance +"
-            else:
-                return "Confiance"
-        elif pd.notna(age_geo) or pd.notna(age_prenom):
-            return "Confiance -"
-        else:
-            return "Confiance --"
-
-    tb_client["indice_conf_age"] = tb_client.apply(ajuster_indice_confiance, axis=1)
-
-    additional_columns = [
-        "e_age",
-        "e_top_age_ok",
-        "indice_conf_age",
-        "e_p_5ans",
-        "e_annee_naissance",
-        "e_sexe",
-    ]
-
-    output_columns = list(tb_client.columns) + [
-        col for col in additional_columns if col not in tb_client.columns
-    ]
-
-    table_name = "02eg_age_sexe"
-
-    with engine.connect() as connection:
-        with connection.begin():
-            connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+    def ajuster_indice_confiance(age_geo, age_prenom):
+        ecart = (age_geo - age_prenom).abs()
+        deux_estimations = age_geo.notna() & age_prenom.notna()
+        une_estimation = age_geo.notna() | age_prenom.notna()
+
+        return np.select(
+            [
+                deux_estimations & (ecart < 5),
+                deux_estimations & (ecart < 10),
+                deux_estimations,
+                une_estimation,
+            ],
+            ["Confiance ++", "Confiance +", "Confiance", "Confiance -"],
+            default="Confiance --",
+        )
 
-        tb_client.to_sql(table_name, con=engine, index=False, if_exists="replace")
+    tb_client["indice_conf_age"] = ajuster_indice_confiance(
+        tb_client["e_age_geo"], tb_client["e_age_prenom"]
+    )
 
     return tb_client
 
 
-# Call the function with all arguments
-resultat = EG_age_sexe(
-    tb_client=pd.read_sql_table("true_table_entree", con=engine),
-    prenom="prenom",
-    sexe="sexe",
+def EG_age_sexe(
+    tb_client,
+    prenom,
+    sexe="NA",
     age_declare="NA",
-    codgeo="codegeo",
     top_estim_sexe=1,
+    codgeo="codegeo",
     ajust=0,
     var_ajust="NA",
-)
+    chunksize=None,
+    workers=None,
+    incremental=False,
+    id_client="id_client",
+    enregistrer=True,
+):
+    """Estime l'âge et le sexe des clients à partir du prénom et du codgeo.
+
+    Avec chunksize, tb_client est le nom de la table à lire par lots : chaque lot
+    est enrichi puis ajouté à la table de sortie. Si ajust vaut 1, une première
+    passe sur les lots calcule les moyennes d'ajustement de toute la table.
+    Avec workers > 1, l'estimation est répartie par département du codgeo sur
+    un pool de processus ; l'ajustement reste calculé sur l'ensemble des clients.
+    Avec incremental, seuls les clients (repérés par id_client) nouveaux ou
+    modifiés depuis l'exécution précédente sont estimés, et leurs lignes
+    remplacent les anciennes dans la table de sortie ; ce mode est incompatible
+    avec ajust=1, dont les moyennes portent sur tous les clients.
+    Avec enregistrer=False (en mémoire seulement, sans chunksize ni
+    incremental), le DataFrame enrichi est renvoyé sans être écrit.
+
+    Returns:
+        pd.DataFrame | int: DataFrame enrichi, ou nombre de lignes écrites en mode streaming.
+    """
+    current_year = pd.Timestamp.now().year
+    with step("references"):
+        references = charger_references_age_sexe(storage)
+    parametres = (prenom, sexe, age_declare, top_estim_sexe, codgeo, current_year)
+
+    table_name = "02eg_age_sexe"
+
+    if not enregistrer and (chunksize is not None or incremental):
+        raise ValueError(
+            "Seule l'estimation en mémoire peut se passer de la table de sortie."
+        )
+
+    if incremental:
+        storage.require_mysql("Le mode incrémental")
+        if ajust == 1:
+            raise ValueError("Le mode incrémental est incompatible avec ajust=1.")
+        suivi = IncrementalRun(
+            table_name,
+            id_client,
+            id_client,
+            None,
+            reference_context(
+                {"parametres": parametres},
+                ["tbrefgeo", PROFILE_TABLE, "table_prenoms"],
+                storage,
+            ),
+            storage.engine,
+        )
+    else:
+        suivi = None
+        if enregistrer:
+            # The output table is replaced once written; its fingerprints go stale
+            storage.drop_table(fingerprint_table(table_name))
+
+    slices = None
+    if workers and workers > 1:
+        with step("decoupage references"):
+            slices = decouper_references_age_sexe(references)
+
+    with (
+        departement_pool(workers, slices) if slices is not None else nullcontext()
+    ) as executor:
+        def estimer(lot):
+            with step("estimation", rows=len(lot)) as measured:
+                if executor is None:
+                    estimated = estimer_age_sexe(lot, references, *parametres)
+                else:
+                    estimated = map_by_departement(
+                        estimer_age_sexe,
+                        lot,
+                        lot[codgeo].astype(str).str[:2],
+                        parametres,
+                        executor,
+                    )
+                    estimated.index = lot.index
+                measured.rows_out = len(estimated)
+            return estimated
+
+        def finaliser(lot):
+            with step("finalisation", rows=len(lot)):
+                lot = finaliser_age_sexe(lot, current_year)
+            # Age source: 1 declared, 2 estimated, 3 none
+            distribution("e_top_age_ok", lot["e_top_age_ok"])
+            return lot
+
+        if chunksize is None and suivi is not None:
+            lot, empreintes = suivi.select(tb_client)
+            if len(lot):
+                lot = finaliser(estimer(lot))
+            suivi.write(lot, empreintes)
+            suivi.finish()
+            return lot
+
+        if chunksize is None:
+            tb_client = estimer(tb_client)
+            if ajust == 1:
+                with step("ajustement", rows=len(tb_client)):
+                    moyennes = moyennes_ajustement(tb_client, var_ajust)
+                    tb_client = ajuster_age(tb_client, var_ajust, moyennes)
+            # The whole table stays in memory: codes and labels as categories,
+            # without those of the clients left out of the table
+            tb_client = compact_frame(drop_unused_categories(finaliser(tb_client)))
+            if enregistrer:
+                storage.write_table(tb_client, table_name)
+            return tb_client
+
+        # Streaming mode: the adjustment means need a first pass over every chunk
+        moyennes = None
+        if ajust == 1:
+            if not isinstance(tb_client, str):
+                raise ValueError("ajust=1 en mode streaming nécessite un nom de table.")
+            sommes = None
+            for chunk in storage.read_table_in_chunks(tb_client, chunksize):
+                chunk_sommes = sommes_ajustement(estimer(chunk), var_ajust)
+                sommes = (
+                    chunk_sommes
+                    if sommes is None
+                    else sommes.add(chunk_sommes, fill_value=0)
+                )
+            moyennes = _moyennes(sommes)
+
+        total_rows = 0
+        # Chunks fill a staging table, indexed and swapped in once complete
+        writer = None if suivi is not None else storage.table_writer(table_name)
+        with writer or nullcontext():
+            for chunk in storage.read_table_in_chunks(tb_client, chunksize):
+                if suivi is not None:
+                    chunk, empreintes = suivi.select(chunk)
+                    if chunk.empty:
+                        continue
+                chunk = estimer(chunk)
+                if ajust == 1:
+                    with step("ajustement", rows=len(chunk)):
+                        chunk = ajuster_age(chunk, var_ajust, moyennes)
+                chunk = finaliser(chunk)
+                if suivi is not None:
+                    suivi.write(chunk, empreintes)
+                else:
+                    with step(f"ecriture {table_name}", rows=len(chunk)):
+                        writer.write(chunk)
+                total_rows += len(chunk)
+
+        if suivi is not None:
+            # The table was indexed when the first changed rows created it
+            suivi.finish()
+        return total_rows
+
+
+def _moyennes(sommes):
+    moyennes = sommes["sum"] / sommes["count"]
+    # Without var_ajust, a single unnamed row holds the global sums
+    if sommes.index.name is None:
+        return moyennes.iloc[0]
+    return moyennes
+
+
+if __name__ == "__main__":
+    # Taille des lots du mode streaming (0 : enrichissement en mémoire)
+    CHUNKSIZE = config.getint("enrichissement", "chunksize", fallback=0)
+    # Nombre de processus (1 : un seul cœur)
+    WORKERS = config.getint("enrichissement", "workers", fallback=1)
+    # Estimation des seuls clients nouveaux ou modifiés
+    INCREMENTAL = config.getboolean("enrichissement", "incremental", fallback=False)
+
+    # Durées, mémoire et taux d'estimation (section [instrumentation])
+    with stage("02"):
+        # Call the function with all arguments
+        resultat = EG_age_sexe(
+            tb_client=(
+                "true_table_entree"
+                if CHUNKSIZE
+                else storage.read_table("true_table_entree")
+            ),
+            prenom="prenom",
+            sexe="sexe",
+            age_declare="NA",
+            codgeo="codegeo",
+            top_estim_sexe=1,
+            ajust=0,
+            var_ajust="NA",
+            chunksize=CHUNKSIZE or None,
+            workers=WORKERS,
+            incremental=INCREMENTAL,
+        )
+
+        print(resultat)
 
-print(resultat)
+        if EXPORT_FORMAT:
+            # Only the complete table, when in memory, spares reading it back
+            complete = isinstance(resultat, pd.DataFrame) and not INCREMENTAL
+            export_table(storage, "02eg_age_sexe", df=resultat if complete else None)
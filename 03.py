@@ -1,42 +1,86 @@
 # Import the necessary libraries
 import pandas as pd
-from sqlalchemy import create_engine
 import configparser
+from export import EXPORT_FORMAT, export_table
+from instrumentation import stage, step
+from schema import align_categories
+from storage import open_storage
 
 # Load configuration from config.ini
 config = configparser.ConfigParser()
 config.read("./config.ini")
 
-# Extract database credentials
-DB_CONFIG = {
-    "host": config["database"]["host"],
-    "user": config["database"]["user"],
-    "password": config["database"]["password"],
-    "database": config["database"]["database"],
-    "port": config["database"].get("port", "3306"),
-}
+# Join run by pandas, or inside the database with "sql"
+EXECUTION = config.get("enrichissement", "execution", fallback="pandas")
 
-# Construct the database URL for SQLAlchemy
-db_url = f"mysql+pymysql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
+# Define the name for the new table to be created in the database
+new_table_name = "03enriched_clients_with_references"
 
-# Create a connection to the MySQL database using SQLAlchemy
-engine = create_engine(db_url)
 
-# Load the '01eg_insee_iris' table from the database into a Pandas DataFrame
-enriched_clients = pd.read_sql_table("01eg_insee_iris", con=engine)
+def enrichir_references(enriched_clients, maj_reference):
+    """Ajoute aux clients de 01eg_insee_iris les indicateurs de maj_2014_references.
 
-# Load the 'maj_2014_references' table from the database into another DataFrame
-maj_reference = pd.read_sql_table("maj_2014_references", con=engine)
+    Args:
+        enriched_clients (pd.DataFrame): Clients enrichis par EG_Insee_Iris (01.py).
+        maj_reference (pd.DataFrame): Table maj_2014_references.
 
-# Merge the two DataFrames on the 'codgeo' column with a left join
-merged_df = pd.merge(enriched_clients, maj_reference, on="codgeo", how="left")
+    Returns:
+        pd.DataFrame: Jointure à gauche des deux tables sur 'codgeo'.
+    """
+    # Merge the two DataFrames on the 'codgeo' column with a left join, on the
+    # codes of the categories when both columns are categorical
+    with step("jointure", rows=len(enriched_clients)) as measured:
+        left, right = align_categories(
+            enriched_clients["codgeo"], maj_reference["codgeo"]
+        )
+        merged_df = pd.merge(
+            enriched_clients.assign(codgeo=left),
+            maj_reference.assign(codgeo=right),
+            on="codgeo",
+            how="left",
+        )
+        measured.rows_out = len(merged_df)
+    return merged_df
 
-# Define the name for the new table to be created in the MySQL database
-new_table_name = "03enriched_clients_with_references"
 
-# Save the merged DataFrame as a new table in the database
-# Replace the table if it already exists
-merged_df.to_sql(new_table_name, con=engine, index=False, if_exists="replace")
+if __name__ == "__main__":
+    # Open the storage backend set in config.ini (MySQL by default)
+    storage = open_storage()
+
+    # Durées et mémoire de chaque sous-étape (section [instrumentation])
+    with stage("03"):
+        if EXECUTION == "sql":
+            # Same left join on 'codgeo', run by the database: no row goes through
+            # Python
+            with step("jointure sql") as measured:
+                measured.rows_out = storage.left_join_table(
+                    "01eg_insee_iris", "maj_2014_references", "codgeo", new_table_name
+                )
+        else:
+            # Load the '01eg_insee_iris' table from the database into a Pandas
+            # DataFrame
+            enriched_clients = storage.read_table("01eg_insee_iris")
+
+            # Load the 'maj_2014_references' table from the database into another
+            # DataFrame
+            maj_reference = storage.read_table("maj_2014_references")
+
+            merged_df = enrichir_references(enriched_clients, maj_reference)
+
+            # Save the merged DataFrame as a new table in the database, bulk loaded
+            # into a staging table that replaces the existing one once indexed
+            storage.write_table(merged_df, new_table_name)
+
+        # Print a confirmation message indicating that the table was created
+        # successfully
+        print(
+            f"Table '{new_table_name}' créée avec succès dans la base de données."
+        )
 
-# Print a confirmation message indicating that the table was created successfully
-print(f"Table '{new_table_name}' créée avec succès dans la base de données.")
+        if EXPORT_FORMAT:
+            # The sql join leaves no DataFrame: the table is read back by chunks
+            export_table(
+                storage,
+                new_table_name,
+                df=None if EXECUTION == "sql" else merged_df,
+            )
@@ -0,0 +1,172 @@
+import configparser
+import pandas as pd
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+# Where the aggregations of the reports are computed:
+# base: GROUP BY queries sent to the storage, only their results are read
+# pandas: the whole table is read, then aggregated in memory
+AGGREGATION = config.get("rapports", "agregation", fallback="base")
+
+
+class Aggregates:
+    """Agrégations d'une table de clients, seules données lues par les rapports.
+
+    Les résultats sont petits (une ligne par catégorie) et ordonnés de la même
+    façon quel que soit l'endroit où ils sont calculés. Les lignes de détail
+    ne sont lues que si le rapport les écrit, et au plus autant qu'il en écrit.
+    """
+
+    def counts(self, columns):
+        """Nombre de lignes de chaque combinaison des valeurs de columns.
+
+        Les combinaisons comportant une valeur manquante sont comptées aussi.
+
+        Returns:
+            pd.DataFrame: columns puis "count", triées par valeurs de columns.
+        """
+        raise NotImplementedError
+
+    def value_counts(self, column):
+        """Équivalent de df[column].value_counts() : colonnes column et "count"."""
+        counts = self.counts([column]).dropna(subset=[column])
+        # Ties are ordered by value, whatever computed the counts
+        return counts.sort_values(
+            "count", ascending=False, kind="stable", ignore_index=True
+        )
+
+    def means(self, category, indicators):
+        """Équivalent de df.groupby(category)[indicators].agg(["mean", "count"]).
+
+        Avec une liste d'indicateurs, calculés ensemble, les colonnes sont
+        indexées par (indicateur, "mean" ou "count"), comme avec pandas.
+        """
+        raise NotImplementedError
+
+    def sums(self, columns):
+        """Équivalent de df[columns].sum() : une somme par colonne."""
+        raise NotImplementedError
+
+    def rows(self, columns, limit=None):
+        """Lignes de détail : colonnes columns des limit premières lignes."""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class FrameAggregates(Aggregates):
+    """Agrégations calculées par pandas sur une table déjà en mémoire."""
+
+    def __init__(self, df):
+        self.df = df
+
+    def counts(self, columns):
+        # Categories absent from the table are not counted, as by GROUP BY
+        counts = self.df.groupby(columns, dropna=False, observed=True).size()
+        return counts.reset_index(name="count")
+
+    def means(self, category, indicators):
+        return self.df.groupby(category, observed=True)[indicators].agg(
+            ["mean", "count"]
+        )
+
+    def sums(self, columns):
+        return self.df[columns].sum()
+
+    def rows(self, columns, limit=None):
+        return self.df[columns] if limit is None else self.df[columns].iloc[:limit]
+
+    def __len__(self):
+        return len(self.df)
+
+
+class TableAggregates(Aggregates):
+    """Agrégations calculées par le moteur de stockage (requêtes GROUP BY).
+
+    Seuls les résultats des requêtes sont transférés : quelques kilo-octets
+    pour les graphiques, quel que soit le nombre de clients de la table.
+    """
+
+    def __init__(self, storage, table_name):
+        self.storage = storage
+        self.table_name = table_name
+        self._rows = None
+
+    def counts(self, columns):
+        keys = ", ".join(self._name(col) for col in columns)
+        counts = self._query(f"SELECT {keys}, COUNT(*) AS {self._name('count')}", keys)
+        # Sorted here: the collations of the backends do not order text alike
+        return counts.sort_values(columns, na_position="last", ignore_index=True)
+
+    def means(self, category, indicators):
+        single = isinstance(indicators, str)
+        indicators = [indicators] if single else list(indicators)
+        key = self._name(category)
+        # Positional aliases: indicator names may not be valid aliases
+        selection = ", ".join(
+            f"AVG({self._name(indicator)}) AS {self._name(f'mean_{i}')}, "
+            f"COUNT({self._name(indicator)}) AS {self._name(f'count_{i}')}"
+            for i, indicator in enumerate(indicators)
+        )
+        means = self._query(
+            f"SELECT {key}, {selection}", key, where=f"{key} IS NOT NULL"
+        )
+        means = means.set_index(category).sort_index()
+        means.columns = pd.MultiIndex.from_product([indicators, ["mean", "count"]])
+        return means[indicators[0]] if single else means
+
+    def sums(self, columns):
+        # An empty or all-null column sums to 0, as with pandas
+        selection = ", ".join(
+            f"COALESCE(SUM({self._name(col)}), 0) AS {self._name(col)}"
+            for col in columns
+        )
+        return self._query(f"SELECT {selection}").iloc[0]
+
+    def rows(self, columns, limit=None):
+        selection = ", ".join(self._name(col) for col in columns)
+        select = f"SELECT {selection} FROM {self.storage.table_source(self.table_name)}"
+        if limit is not None:
+            select += f" LIMIT {int(limit)}"
+        return self.storage.query(select)
+
+    def __len__(self):
+        if self._rows is None:
+            self._rows = int(self._query("SELECT COUNT(*) AS n").iloc[0, 0])
+        return self._rows
+
+    def _name(self, name):
+        return f"{self.storage.quote}{name}{self.storage.quote}"
+
+    def _query(self, selection, group_by=None, where=None):
+        select = f"{selection} FROM {self.storage.table_source(self.table_name)}"
+        if where is not None:
+            select += f" WHERE {where}"
+        if group_by is not None:
+            select += f" GROUP BY {group_by}"
+        return self.storage.query(select)
+
+
+def as_aggregates(source):
+    """Agrégations de source : DataFrame déjà en mémoire ou Aggregates."""
+    if isinstance(source, Aggregates):
+        return source
+    return FrameAggregates(source)
+
+
+def table_aggregates(storage, table_name, aggregation=AGGREGATION):
+    """Agrégations de table_name, calculées selon la clé agregation de [rapports].
+
+    Les moteurs qui ne savent pas exécuter de requêtes (parquet sans duckdb)
+    et agregation = pandas lisent la table entière, agrégée par pandas.
+    """
+    if aggregation not in ("base", "pandas"):
+        raise ValueError(
+            f"Mode d'agrégation inconnu : '{aggregation}' (base ou pandas)."
+        )
+    if aggregation == "base" and storage.can_query:
+        return TableAggregates(storage, table_name)
+    return FrameAggregates(storage.read_table(table_name))
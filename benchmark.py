@@ -0,0 +1,504 @@
+import gc
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import configparser
+import initfiles
+from instrumentation import PeakMemory
+from prenoms import YEARS
+from reports import REPORTS, build_report
+from schema import compact_frame
+from storage import DEFAULT_PATHS, open_storage
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+# Client counts of the synthetic input tables
+BENCHMARK_SIZES = [
+    int(size)
+    for size in config.get(
+        "benchmark", "tailles", fallback="1000, 10000, 100000"
+    ).split(",")
+]
+# Results and stand-in database
+BENCHMARK_DIRECTORY = config.get("benchmark", "dossier", fallback="benchmarks")
+# Backend of the stand-in database: sqlite, duckdb or parquet
+BENCHMARK_BACKEND = config.get("benchmark", "moteur", fallback="sqlite")
+# Previous results file compared with the new ones (empty: no comparison)
+BENCHMARK_REFERENCE = config.get("benchmark", "reference", fallback="")
+SEED = config.getint("benchmark", "graine", fallback=0)
+
+DATA_DIRECTORY = "output_data"
+
+# Share of the clients with a misspelt town, and without a lieu-dit
+MISSPELT_SHARE = 0.05
+NO_LIEU_DIT_SHARE = 0.2
+
+# Slowdown beyond which a stage is reported as a regression
+REGRESSION_RATIO = 1.1
+
+# Columns of true_table_entree, as initfiles.py names them
+CLIENT_COLUMNS = [
+    "sexe",
+    "civilit_",
+    "prenom",
+    "nom",
+    "complement_nom",
+    "adresse",
+    "complement_adrs",
+    "lieu_dit",
+    "num_voie",
+    "bis_ter",
+    "type_voie_court",
+    "type_voie_long",
+    "lib_voie",
+    "cp",
+    "ville",
+    "id_client",
+    "pays",
+    "email",
+    "tel",
+    "codegeo",
+]
+
+# Fields passed to EG_Insee_Iris by 01.py
+INSEE_IRIS_FIELDS = {
+    "civilite": "civilit_",
+    "prenom": "prenom",
+    "nom": "nom",
+    "complement_nom": None,
+    "adresse": None,
+    "complement_adrs": None,
+    "lieu_dit": "lieu_dit",
+    "cp": "cp",
+    "ville": "ville",
+    "id_client": "id_client",
+    "pays": None,
+    "email": None,
+    "tel": None,
+}
+
+# Age bands of tbrefgeo, taken from the population counts of insee_2014.csv
+AGE_BANDS = {
+    "age_6_10": "p10_pop0610",
+    "age_11_17": "p10_pop1117",
+    "age_18_24": "p10_pop1824",
+    "age_25_39": "p10_pop2539",
+    "age_40_54": "p10_pop4054",
+    "age_55_64": "p10_pop5564",
+    "age_65_79": "p10_pop6579",
+    "age_over_80": "p10_pop80p",
+}
+
+# Indicators of maj_2014_references read by the 03graph report
+INDICATOR_COLUMNS = [
+    "rev",
+    "c_indice_qualite_rev",
+    "propr",
+    "locat",
+    "locat_hlm",
+    "c_indice_qualite_logement",
+    "et_niv0",
+    "et_niv1",
+    "et_niv2",
+    "tx_fammono",
+    "tx_coupsenf",
+    "tx_coupaenf",
+]
+
+STREET_TYPES = [("r", "rue"), ("av", "avenue"), ("bd", "boulevard"), ("imp", "impasse")]
+STREET_NAMES = ["du moulin", "de la gare", "des écoles", "victor hugo", "de l'église"]
+
+
+def read_reference_csv(file_name):
+    """Lit un CSV de output_data comme initfiles.py le charge.
+
+    Les noms de colonnes sont normalisés et les codes INSEE, IRIS et postaux
+    complétés par des zéros à gauche ; les valeurs restent du texte.
+    """
+    df = pd.read_csv(
+        os.path.join(DATA_DIRECTORY, file_name),
+        dtype=str,
+        encoding="utf-8-sig",
+        keep_default_na=False,
+        na_values=initfiles.NA_STRINGS,
+    )
+    df.columns = [initfiles.normalize_column_name(col) for col in df.columns]
+    for col, width in initfiles.CODE_WIDTHS.items():
+        if col in df.columns:
+            df[col] = df[col].str.zfill(width)
+    return df
+
+
+def name_pools():
+    """Prénoms et noms distincts des fichiers clients d'exemple.
+
+    Les prénoms sont ceux de table_prenoms.csv si ce fichier est présent.
+    """
+    samples = pd.concat(
+        [
+            read_reference_csv("table_entree.csv")[["prenom", "nom"]],
+            read_reference_csv("true_table_entree.csv")[["prenom", "nom"]],
+        ]
+    )
+    first_names = samples["prenom"]
+    if os.path.exists(os.path.join(DATA_DIRECTORY, "table_prenoms.csv")):
+        first_names = read_reference_csv("table_prenoms.csv")["prenom"]
+    return (
+        first_names.dropna().drop_duplicates().to_numpy(dtype=object),
+        samples["nom"].dropna().drop_duplicates().to_numpy(dtype=object),
+    )
+
+
+def reference_addresses(refcp, ref_iris):
+    """Adresses réelles : chaque IRIS avec un code postal et le nom de sa commune.
+
+    Les IRIS étant plus nombreux dans les communes peuplées, tirer les adresses
+    uniformément parmi eux reproduit à peu près la répartition des clients.
+    """
+    communes = refcp.drop_duplicates("code_commune_insee")
+    addresses = ref_iris.merge(
+        communes, left_on="depcom", right_on="code_commune_insee"
+    )
+    # Clients of communes without IRIS do not write the "(commune non irisée)" label
+    lieu_dit = addresses["lib_iris"].where(addresses["typ_iris"] != "Z")
+    return pd.DataFrame(
+        {
+            "cp": addresses["code_postal"],
+            "ville": addresses["nom_de_la_commune"],
+            "lieu_dit": lieu_dit,
+            "codegeo": addresses["code_iris"],
+        }
+    )
+
+
+def generate_clients(size, addresses, first_names, last_names, seed=SEED):
+    """Génère une table de clients synthétique aux colonnes de true_table_entree.
+
+    Les adresses (code postal, commune, lieu-dit, codegeo) sont tirées parmi
+    les références réelles ; une part des villes comporte une faute de frappe
+    (une lettre manquante) et une part des clients n'a pas de lieu-dit.
+
+    Args:
+        size (int): Nombre de clients.
+        addresses (pd.DataFrame): Adresses renvoyées par reference_addresses.
+        first_names, last_names (np.ndarray): Prénoms et noms tirés au hasard.
+        seed (int, optional): Graine du générateur aléatoire.
+
+    Returns:
+        pd.DataFrame: Clients, id_client de 1 à size.
+    """
+    rng = np.random.default_rng(seed)
+    clients = addresses.iloc[rng.integers(0, len(addresses), size)].reset_index(
+        drop=True
+    )
+
+    ville = clients["ville"].to_numpy(dtype=object)
+    misspelt = np.flatnonzero(rng.random(size) < MISSPELT_SHARE)
+    lengths = clients["ville"].str.len().to_numpy()[misspelt]
+    positions = (rng.random(len(misspelt)) * lengths).astype(int)
+    ville[misspelt] = [
+        name[:position] + name[position + 1 :]
+        for name, position in zip(ville[misspelt], positions)
+    ]
+    clients["ville"] = ville
+    clients.loc[rng.random(size) < NO_LIEU_DIT_SHARE, "lieu_dit"] = None
+
+    feminine = rng.random(size) < 0.5
+    prenom = first_names[rng.integers(0, len(first_names), size)]
+    nom = last_names[rng.integers(0, len(last_names), size)]
+    street = rng.integers(0, len(STREET_TYPES), size)
+    num_voie = rng.integers(1, 200, size)
+    lib_voie = np.array(STREET_NAMES, dtype=object)[
+        rng.integers(0, len(STREET_NAMES), size)
+    ]
+    type_court = np.array([short for short, _ in STREET_TYPES], dtype=object)[street]
+    type_long = np.array([long for _, long in STREET_TYPES], dtype=object)[street]
+
+    clients = clients.assign(
+        sexe=np.where(feminine, "F", "M"),
+        civilit_=np.where(feminine, "Mme", "M"),
+        prenom=prenom,
+        nom=nom,
+        complement_nom=None,
+        adresse=pd.Series(num_voie).astype(str) + " " + type_long + " " + lib_voie,
+        complement_adrs=None,
+        num_voie=num_voie,
+        bis_ter=None,
+        type_voie_court=type_court,
+        type_voie_long=type_long,
+        lib_voie=lib_voie,
+        id_client=np.arange(1, size + 1).astype(str),
+        pays="FR",
+        email=(
+            pd.Series(prenom).str.lower() + "." + pd.Series(nom).str.lower()
+        ).str.replace(" ", "")
+        + "@example.com",
+        tel="06" + pd.Series(rng.integers(0, 10**8, size)).astype(str).str.zfill(8),
+    )
+    return clients[CLIENT_COLUMNS]
+
+
+def build_stand_in_database(storage, refcp, ref_iris, first_names, seed=SEED):
+    """Remplit la base de substitution avec les tables lues par 01.py, 02.py et 03.py.
+
+    refcp et ref_iris_geo2024 sont les références réelles. tbrefgeo reprend,
+    pour chaque IRIS, la pyramide des âges de sa commune (insee_2014.csv).
+    table_prenoms et maj_2014_references, absentes du dépôt, sont aléatoires :
+    elles n'ont que la forme des vraies tables.
+    """
+    rng = np.random.default_rng(seed)
+    storage.write_table(refcp, "refcp")
+    storage.write_table(ref_iris, "ref_iris_geo2024")
+
+    insee = read_reference_csv("insee_2014.csv").set_index("codgeo")
+    ages = insee[list(AGE_BANDS.values())].apply(pd.to_numeric, errors="coerce")
+    ages.columns = list(AGE_BANDS)
+    # The 0-5 band (6 years) is not counted: it follows the 6-10 band (5 years)
+    ages.insert(0, "age_0_5", ages["age_6_10"] * 6 / 5)
+    tbrefgeo = ages.reindex(ref_iris["depcom"].values)
+    tbrefgeo.insert(0, "codgeo", ref_iris["code_iris"].values)
+    storage.write_table(tbrefgeo.dropna(), "tbrefgeo")
+
+    # Births of each first name around a random peak year
+    years = np.array(YEARS)
+    peaks = rng.integers(years[0], years[-1], len(first_names))
+    counts = rng.poisson(
+        200 * np.exp(-(((years[None, :] - peaks[:, None]) / 15) ** 2))
+    )
+    table_prenoms = pd.DataFrame(counts, columns=[f"n{year}" for year in YEARS])
+    table_prenoms.insert(0, "sexe", rng.choice(["F", "M"], len(first_names)))
+    table_prenoms.insert(0, "prenom", first_names)
+    storage.write_table(table_prenoms, "table_prenoms")
+
+    indicators = pd.DataFrame(
+        rng.random((len(ref_iris), len(INDICATOR_COLUMNS))), columns=INDICATOR_COLUMNS
+    )
+    indicators["rev"] *= 40000
+    indicators.insert(0, "codgeo", ref_iris["code_iris"].values)
+    storage.write_table(indicators, "maj_2014_references")
+
+
+def measure(stage, rows, function, *args):
+    """Exécute function(*args) en mesurant sa durée et son pic de mémoire.
+
+    Le pic est l'augmentation de la mémoire résidente pendant l'appel (relevé
+    du noyau Linux, sans ralentir l'étape) ; ailleurs, c'est le pic des
+    allocations suivies par tracemalloc, qui ralentit l'étape.
+
+    Returns:
+        tuple: Résultat de function et mesure (dictionnaire).
+    """
+    gc.collect()
+    with PeakMemory() as memory:
+        if not memory.available:
+            tracemalloc.start()
+        started = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - started
+        if not memory.available:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    if memory.available:
+        peak = memory.bytes
+
+    measurement = {
+        "etape": stage,
+        "lignes": rows,
+        "secondes": round(elapsed, 4),
+        "lignes_par_seconde": round(rows / elapsed) if elapsed > 0 else None,
+        "pic_memoire_mo": round(peak / 2**20, 1),
+    }
+    print(
+        f"{stage:>10} {rows:>10} lignes : {elapsed:8.3f} s, "
+        f"{measurement['lignes_par_seconde'] or 0:>10} lignes/s, "
+        f"pic {measurement['pic_memoire_mo']} Mo"
+    )
+    return result, measurement
+
+
+def run_benchmark(
+    sizes=BENCHMARK_SIZES,
+    directory=BENCHMARK_DIRECTORY,
+    seed=SEED,
+    backend=BENCHMARK_BACKEND,
+):
+    """Mesure chaque étape pour chaque taille de table de clients.
+
+    Étapes : chargement (initfiles.py), 01 (enrichir_insee_iris), 02
+    (estimer_age_sexe et finaliser_age_sexe), 03 (enrichir_references) et les
+    rapports Excel. Les tables de référence sont lues une fois, hors mesure,
+    dans une base de substitution (sqlite, duckdb ou parquet, voir storage.py)
+    créée dans directory ; les tables de sortie ne sont pas écrites.
+
+    Returns:
+        dict: Contexte d'exécution et mesures, prêts à être enregistrés en JSON.
+    """
+    insee_iris = importlib.import_module("01")
+    age_sexe = importlib.import_module("02")
+    references = importlib.import_module("03")
+    seuil = config.getfloat("enrichissement", "similarite", fallback=0) or None
+
+    if backend not in DEFAULT_PATHS:
+        raise ValueError(
+            f"Moteur de la base de substitution inconnu : '{backend}' "
+            "(sqlite, duckdb ou parquet)."
+        )
+    os.makedirs(directory, exist_ok=True)
+    database = os.path.join(directory, DEFAULT_PATHS[backend])
+    if os.path.isdir(database):
+        shutil.rmtree(database)
+    elif os.path.exists(database):
+        os.remove(database)
+    storage = open_storage(backend, database)
+
+    refcp = read_reference_csv("refCP.csv")
+    ref_iris = read_reference_csv("Ref_IRIS_geo2024.csv")
+    first_names, last_names = name_pools()
+    build_stand_in_database(storage, refcp, ref_iris, first_names, seed)
+    addresses = reference_addresses(refcp, ref_iris)
+
+    references_01 = insee_iris.charger_references_insee_iris(storage)
+    references_02 = age_sexe.charger_references_age_sexe(storage)
+    maj_reference = storage.read_table("maj_2014_references")
+    current_year = pd.Timestamp.now().year
+
+    def estimate_age_sexe(tb_client):
+        tb_client = age_sexe.estimer_age_sexe(
+            tb_client, references_02, "prenom", "sexe", "NA", 1, "codegeo", current_year
+        )
+        return age_sexe.finaliser_age_sexe(tb_client, current_year)
+
+    measurements = []
+    with tempfile.TemporaryDirectory() as work_directory:
+        for size in sizes:
+            clients = generate_clients(size, addresses, first_names, last_names, seed)
+            csv_path = os.path.join(work_directory, "true_table_entree.csv")
+            clients.to_csv(csv_path, index=False)
+            # Same types as the clients read from the storage
+            clients = compact_frame(clients)
+
+            _, measurement = measure(
+                "chargement",
+                size,
+                initfiles.load_csv_into_storage,
+                csv_path,
+                storage,
+            )
+            measurements.append(measurement)
+            os.remove(csv_path)
+
+            outputs = {}
+            outputs["01"], measurement = measure(
+                "01",
+                size,
+                insee_iris.enrichir_insee_iris,
+                clients,
+                references_01,
+                0,
+                INSEE_IRIS_FIELDS,
+                seuil,
+            )
+            measurements.append(measurement)
+            outputs["02"], measurement = measure(
+                "02", size, estimate_age_sexe, clients.copy()
+            )
+            measurements.append(measurement)
+            outputs["03"], measurement = measure(
+                "03",
+                len(outputs["01"]),
+                references.enrichir_references,
+                outputs["01"],
+                maj_reference,
+            )
+            measurements.append(measurement)
+
+            for name in REPORTS:
+                df = outputs[name[:2]]
+                output_file = os.path.join(work_directory, f"{name}.xlsx")
+                _, measurement = measure(
+                    name, len(df), build_report, name, df, output_file
+                )
+                measurements.append(measurement)
+            del clients, outputs
+    storage.close()
+
+    return {
+        "date": pd.Timestamp.now().isoformat(timespec="seconds"),
+        "version": _git_version(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "similarite": seuil,
+        "moteur": backend,
+        "mesures": measurements,
+    }
+
+
+def _git_version():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(reference, results):
+    """Compare deux jeux de mesures, étape par étape et taille par taille.
+
+    Returns:
+        list: Pour chaque étape mesurée dans les deux jeux, le rapport des
+            durées (nouvelle / ancienne) ; au-delà de REGRESSION_RATIO, l'étape
+            est signalée comme une régression.
+    """
+    previous = {(m["etape"], m["lignes"]): m for m in reference["mesures"]}
+    comparison = []
+    for measurement in results["mesures"]:
+        old = previous.get((measurement["etape"], measurement["lignes"]))
+        if old is None or not old["secondes"]:
+            continue
+        ratio = measurement["secondes"] / old["secondes"]
+        comparison.append(
+            {
+                "etape": measurement["etape"],
+                "lignes": measurement["lignes"],
+                "rapport_durees": round(ratio, 3),
+                "regression": ratio > REGRESSION_RATIO,
+            }
+        )
+    return comparison
+
+
+# Exemple d'utilisation
+if __name__ == "__main__":
+    results = run_benchmark()
+
+    stamp = f"{pd.Timestamp.now():%Y%m%d_%H%M%S}_{results['version'] or 'local'}"
+    results_path = os.path.join(BENCHMARK_DIRECTORY, f"resultats_{stamp}.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Résultats enregistrés dans '{results_path}'.")
+
+    if BENCHMARK_REFERENCE:
+        with open(BENCHMARK_REFERENCE, "r") as f:
+            reference = json.load(f)
+        print(f"Comparaison avec '{BENCHMARK_REFERENCE}' ({reference['version']}) :")
+        for line in compare_results(reference, results):
+            flag = "  régression" if line["regression"] else ""
+            print(
+                f"{line['etape']:>10} {line['lignes']:>10} lignes : "
+                f"x{line['rapport_durees']}{flag}"
+            )
@@ -0,0 +1,248 @@
+import configparser
+import pandas as pd
+import xlsxwriter
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+# Rows of an Excel sheet, header included
+EXCEL_MAX_ROWS = 1048576
+# Characters of an Excel sheet name
+SHEET_NAME_LENGTH = 31
+
+# Detail rows (client-level columns) of each report sheet:
+# meme_feuille: above the chart data, as the reports always did
+# feuilles: on separate sheets, after the sheet of the chart
+# aucun: not written, the sheet only holds the chart data
+DETAIL_MODES = ("meme_feuille", "feuilles", "aucun")
+DETAIL_MODE = config.get("rapports", "detail", fallback="meme_feuille")
+# Detail rows written per report sheet (0: as many as Excel allows)
+DETAIL_ROWS = config.getint("rapports", "lignes_detail", fallback=0)
+# Categories charted, the others being grouped in one bar (0: all of them)
+TOP_CATEGORIES = config.getint("rapports", "categories", fallback=0)
+
+OTHERS_LABEL = "Autres"
+
+# Rows converted to Python values at a time while writing the detail
+WRITE_BATCH_SIZE = 10000
+
+
+def report_settings():
+    """Réglages de la section [rapports], qui déterminent le contenu des classeurs."""
+    return {
+        "detail": DETAIL_MODE,
+        "lignes_detail": DETAIL_ROWS,
+        "categories": TOP_CATEGORIES,
+    }
+
+
+def top_categories(graph_data, category, top_n=TOP_CATEGORIES, weights=None):
+    """Garde les top_n catégories d'un tableau agrégé et regroupe les autres.
+
+    Les catégories sont classées par poids décroissant : weights (nombre de
+    clients de chaque catégorie) s'il est fourni, sinon la somme des colonnes
+    de valeurs. La ligne OTHERS_LABEL porte la somme des autres catégories,
+    ou, avec weights, leur moyenne pondérée (moyenne sur leurs clients).
+
+    Args:
+        graph_data (pd.DataFrame): Une ligne par catégorie.
+        category (str): Colonne des catégories.
+        top_n (int, optional): Nombre de catégories gardées (0 : toutes).
+        weights (pd.Series, optional): Nombre de clients de chaque ligne, pour
+            les tableaux de moyennes.
+
+    Returns:
+        pd.DataFrame: Au plus top_n + 1 lignes.
+    """
+    if not top_n or len(graph_data) <= top_n:
+        return graph_data
+
+    values = [col for col in graph_data.columns if col != category]
+    if weights is None:
+        ranking = graph_data[values].sum(axis=1)
+    else:
+        ranking = pd.Series(weights.to_numpy(), index=graph_data.index)
+    order = ranking.sort_values(ascending=False, kind="stable").index
+    top, others = graph_data.loc[order[:top_n]], graph_data.loc[order[top_n:]]
+
+    if weights is None:
+        grouped = others[values].sum()
+    else:
+        others_weights = ranking.loc[others.index]
+        grouped = (
+            others[values].mul(others_weights, axis=0).sum() / others_weights.sum()
+        )
+    others_row = pd.DataFrame([{category: OTHERS_LABEL, **grouped.to_dict()}])
+    return pd.concat([top, others_row], ignore_index=True)
+
+
+class ReportWriter:
+    """Classeur Excel de rapport, écrit en flux (mode constant_memory d'xlsxwriter).
+
+    Chaque ligne est écrite une fois, dans l'ordre, puis quitte la mémoire :
+    le classeur n'est jamais entièrement chargé, quelle que soit la taille
+    des tables. Chaque feuille de rapport reçoit le tableau agrégé de son
+    graphique et ce graphique ; les lignes de détail (colonnes des clients)
+    sont écrites selon detail :
+
+    - "meme_feuille" : au-dessus du tableau agrégé, comme auparavant ;
+    - "feuilles" : sur des feuilles suivantes, d'au plus EXCEL_MAX_ROWS lignes ;
+    - "aucun" : pas de détail.
+
+    Args:
+        output_file (str): Fichier Excel produit.
+        detail (str, optional): Disposition des lignes de détail.
+        detail_rows (int, optional): Nombre maximal de lignes de détail par
+            feuille de rapport (0 : autant qu'Excel le permet).
+    """
+
+    def __init__(self, output_file, detail=DETAIL_MODE, detail_rows=DETAIL_ROWS):
+        if detail not in DETAIL_MODES:
+            raise ValueError(
+                f"Disposition du détail inconnue : '{detail}' "
+                "(meme_feuille, feuilles ou aucun)."
+            )
+        self.output_file = output_file
+        self.detail = detail
+        self.detail_rows = detail_rows
+        self.workbook = xlsxwriter.Workbook(output_file, {"constant_memory": True})
+        # Same header style as pandas' to_excel
+        self.header_format = self.workbook.add_format(
+            {"bold": True, "border": 1, "align": "center", "valign": "top"}
+        )
+        self.sheet_names = set()
+
+    @property
+    def detail_limit(self):
+        """Nombre maximal de lignes de détail d'une feuille (None : sans limite)."""
+        if self.detail == "aucun":
+            return 0
+        if self.detail == "meme_feuille":
+            return min(self.detail_rows or EXCEL_MAX_ROWS, EXCEL_MAX_ROWS)
+        return self.detail_rows or None
+
+    def add_chart_sheet(
+        self,
+        sheet_name,
+        graph_data,
+        x_col,
+        y_cols,
+        detail=None,
+        detail_total=None,
+        chart_type="column",
+        colors=None,
+        y_axis=None,
+        plotarea=None,
+    ):
+        """Ajoute une feuille avec le tableau agrégé graph_data et son graphique.
+
+        Args:
+            sheet_name (str): Nom de la feuille, repris dans le titre du graphique.
+            graph_data (pd.DataFrame): Catégories en première colonne, puis les
+                valeurs de chaque série.
+            x_col (str): Titre de l'axe des catégories.
+            y_cols (list): Colonnes de graph_data représentées, une série chacune.
+            detail (pd.DataFrame | callable, optional): Lignes de détail de la
+                feuille, ou fonction qui les lit, appelée avec le nombre maximal
+                de lignes écrites (None : toutes) seulement si elles le sont.
+            detail_total (int, optional): Nombre total de lignes de détail,
+                quand detail ne renvoie que les premières.
+            chart_type (str, optional): Type de graphique xlsxwriter.
+            colors (list, optional): Couleur de chaque série.
+            y_axis (dict, optional): Options de l'axe des valeurs.
+            plotarea (dict, optional): Options de la zone de traçage.
+        """
+        worksheet = self._add_worksheet(sheet_name)
+        row = 0
+        if detail is not None and self.detail == "meme_feuille":
+            # The chart data and its header follow the detail, after a blank row
+            room = max(0, EXCEL_MAX_ROWS - len(graph_data) - 3)
+            detail = self._capped(detail, room, detail_total, sheet_name)
+            row = self._write_frame(worksheet, detail)
+            row += 1
+        data_row = row
+        self._write_frame(worksheet, graph_data, data_row)
+
+        chart = self.workbook.add_chart({"type": chart_type})
+        first, last = data_row + 1, data_row + len(graph_data)
+        for i, y_col in enumerate(y_cols):
+            column = graph_data.columns.get_loc(y_col)
+            series = {
+                "name": y_col,
+                "categories": [sheet_name, first, 0, last, 0],
+                "values": [sheet_name, first, column, last, column],
+                # Cached values of the chart, which constant_memory cannot read
+                # back from the written rows
+                "categories_data": self._cache(graph_data.iloc[:, 0]),
+                "values_data": self._cache(graph_data[y_col]),
+            }
+            if colors is not None:
+                series["fill"] = {"color": colors[i]}
+            chart.add_series(series)
+        chart.set_title({"name": sheet_name + " Graph"})
+        chart.set_x_axis({"name": x_col})
+        chart.set_y_axis(y_axis or {"name": y_cols[0]})
+        if plotarea is not None:
+            chart.set_plotarea(plotarea)
+        worksheet.insert_chart("D2", chart)
+
+        if detail is not None and self.detail == "feuilles":
+            self._write_detail_sheets(sheet_name, detail, detail_total)
+
+    def close(self):
+        self.workbook.close()
+        print(f"Fichier Excel '{self.output_file}' créé avec succès.")
+
+    def _add_worksheet(self, name):
+        worksheet = self.workbook.add_worksheet(name)
+        self.sheet_names.add(name)
+        return worksheet
+
+    def _capped(self, detail, room, total, sheet_name):
+        # room is None when the detail may take any number of sheets
+        limit = room
+        if self.detail_rows:
+            limit = self.detail_rows if room is None else min(room, self.detail_rows)
+        if callable(detail):
+            detail = detail(limit)
+        total = len(detail) if total is None else total
+        if limit is not None and total > limit:
+            print(
+                f"Feuille '{sheet_name}' : {limit} lignes de détail écrites "
+                f"sur {total}."
+            )
+            return detail.iloc[:limit]
+        return detail
+
+    def _write_detail_sheets(self, sheet_name, detail, total):
+        detail = self._capped(detail, None, total, sheet_name)
+        per_sheet = EXCEL_MAX_ROWS - 1
+        pages = max(1, -(-len(detail) // per_sheet))
+        for page in range(pages):
+            suffix = " détail" if pages == 1 else f" détail {page + 1}"
+            name = sheet_name[: SHEET_NAME_LENGTH - len(suffix)] + suffix
+            while name in self.sheet_names:
+                # Truncated names of two sheets may collide
+                name = name[:-1] + "_"
+            worksheet = self._add_worksheet(name)
+            start = page * per_sheet
+            self._write_frame(worksheet, detail.iloc[start : start + per_sheet])
+
+    @staticmethod
+    def _cache(column):
+        return [None if pd.isna(value) else value for value in column.tolist()]
+
+    def _write_frame(self, worksheet, df, row=0):
+        """Écrit l'en-tête et les lignes de df à partir de row ; renvoie la suivante."""
+        header = [str(col) for col in df.columns]
+        worksheet.write_row(row, 0, header, self.header_format)
+        row += 1
+        for start in range(0, len(df), WRITE_BATCH_SIZE):
+            batch = df.iloc[start : start + WRITE_BATCH_SIZE].astype(object)
+            # Missing values are left blank, like pandas' to_excel
+            batch = batch.where(batch.notna(), None)
+            for values in batch.itertuples(index=False, name=None):
+                worksheet.write_row(row, 0, values)
+                row += 1
+        return row
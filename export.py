@@ -0,0 +1,247 @@
+import os
+import shutil
+import configparser
+import pandas as pd
+from instrumentation import step
+from parallel import departement_from_code
+from writer import STAGING_SUFFIX
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+except ImportError:  # Exports are unavailable without pyarrow
+    pa = ds = None
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+# Columnar copy of the enriched tables: parquet, arrow (Arrow IPC), or none
+EXPORT_FORMAT = config.get("export", "format", fallback="").strip()
+EXPORT_DIRECTORY = config.get("export", "dossier", fallback="export")
+# Rows read at a time from a table that is not in memory
+EXPORT_CHUNKSIZE = config.getint("export", "chunksize", fallback=100000)
+
+# Dataset format and file extension of each export format. Arrow IPC files are
+# written uncompressed, so that they can be memory-mapped without a copy
+FORMATS = {"parquet": ("parquet", "parquet"), "arrow": ("ipc", "arrow")}
+
+# Partition column, and the code columns it is taken from, in order of
+# preference: the IRIS code of the matched clients (unmatched ones get a
+# codgeo of 4 characters, without commune), else their postal code
+PARTITION_COLUMN = "departement"
+PARTITION_SOURCES = ["codgeo", "codegeo", "cp"]
+
+# Smallest row group written to a partition, rather than one per chunk read
+MIN_ROWS_PER_GROUP = 10000
+
+# Arrow types of the columns added by the enrichment, whatever their pandas
+# dtype: integers with missing values are read back as floats
+COLUMN_TYPES = {
+    "c_qualite_iris": "int64",
+    "e_top_age_ok": "int64",
+    "e_annee_naissance": "int64",
+    "e_age_geo": "float64",
+    "e_age_prenom": "float64",
+    "e_age": "float64",
+    "e_p_5ans": "float64",
+}
+
+
+def arrow_schema(df):
+    """Schéma Arrow stable des colonnes de df, suivi de la colonne de partition.
+
+    Les types ne dépendent que du type pandas de chaque colonne (ou de son
+    type déclaré) : entiers en int64, décimaux en float64, booléens, dates,
+    et tout le reste (codes compris) en texte, même une colonne vide.
+    """
+    fields = []
+    for col, dtype in df.dtypes.items():
+        if col in COLUMN_TYPES:
+            arrow_type = pa.type_for_alias(COLUMN_TYPES[col])
+        elif pd.api.types.is_bool_dtype(dtype):
+            arrow_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(dtype):
+            arrow_type = pa.int64()
+        elif pd.api.types.is_float_dtype(dtype):
+            arrow_type = pa.float64()
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            arrow_type = pa.timestamp("us")
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(str(col), arrow_type))
+    fields.append(pa.field(PARTITION_COLUMN, pa.string()))
+    return pa.schema(fields)
+
+
+def departements(df):
+    """Département de chaque ligne de df (None si aucun code n'est renseigné)."""
+    result = pd.Series(None, index=df.index, dtype=object)
+    for col in PARTITION_SOURCES:
+        if col not in df.columns:
+            continue
+        codes = df[col]
+        usable = codes.notna()
+        if not pd.api.types.is_numeric_dtype(codes):
+            # Numeric codes lost their leading zeros, text ones must hold a commune
+            usable &= codes.astype(str).str.len() >= 5
+        missing = result.isna() & usable
+        if missing.any():
+            result[missing] = departement_from_code(codes[missing], 5)
+    return result
+
+
+def to_record_batch(df, schema):
+    """Lot Arrow de df, converti colonne par colonne aux types de schema."""
+    arrays = []
+    for field in schema:
+        values = (
+            departements(df) if field.name == PARTITION_COLUMN else df[field.name]
+        )
+        if pa.types.is_string(field.type):
+            try:
+                array = pa.array(values, type=field.type, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                # Numbers in a text column: written as text
+                text = values.astype(object).where(values.isna(), values.astype(str))
+                array = pa.array(text, type=field.type, from_pandas=True)
+        elif pa.types.is_integer(field.type):
+            array = pa.array(pd.array(values, dtype="Int64"), type=field.type)
+        else:
+            array = pa.array(values, type=field.type, from_pandas=True)
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_table(
+    storage,
+    table_name,
+    df=None,
+    fmt=EXPORT_FORMAT,
+    directory=EXPORT_DIRECTORY,
+    chunksize=EXPORT_CHUNKSIZE,
+):
+    """Exporte une table enrichie en jeu de données partitionné par département.
+
+    La table devient le dossier directory/table_name, dont chaque sous-dossier
+    departement=XX contient ses lignes (departement=__HIVE_DEFAULT_PARTITION__
+    pour celles sans code). Les colonnes gardent les mêmes types d'un export
+    à l'autre (arrow_schema). L'export est écrit sous un nom de transit puis
+    substitué d'un coup à l'ancien.
+
+    Args:
+        storage (Storage): Stockage où relire la table si df n'est pas fourni.
+        table_name (str): Table exportée.
+        df (pd.DataFrame, optional): Contenu complet de la table, s'il est déjà
+            en mémoire ; sinon la table est relue par lots de chunksize lignes.
+        fmt (str, optional): parquet ou arrow (Arrow IPC).
+        directory (str, optional): Dossier des exports.
+        chunksize (int, optional): Nombre de lignes relues à la fois.
+
+    Returns:
+        int: Nombre de lignes exportées.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Format d'export inconnu : '{fmt}' (parquet ou arrow).")
+    if pa is None:
+        raise ImportError("L'export nécessite le paquet pyarrow.")
+
+    if df is not None:
+        # Converted by slices, so that a single slice is copied to Arrow at a time
+        frames = (
+            df.iloc[start : start + chunksize]
+            for start in range(0, max(len(df), 1), chunksize)
+        )
+    else:
+        frames = storage.read_table_in_chunks(table_name, chunksize)
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        # An empty table read by chunks: its columns are unknown
+        first = storage.read_table(table_name)
+    schema = arrow_schema(first)
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        for frame in _chain(first, frames):
+            rows += len(frame)
+            yield to_record_batch(frame, schema)
+
+    dataset_format, extension = FORMATS[fmt]
+    path = os.path.join(directory, table_name)
+    staging = f"{path}{STAGING_SUFFIX}"
+    shutil.rmtree(staging, ignore_errors=True)
+    with step(f"export {table_name}") as measured:
+        ds.write_dataset(
+            batches(),
+            staging,
+            schema=schema,
+            format=dataset_format,
+            partitioning=ds.partitioning(
+                pa.schema([schema.field(PARTITION_COLUMN)]), flavor="hive"
+            ),
+            basename_template=f"part-{{i}}.{extension}",
+            min_rows_per_group=MIN_ROWS_PER_GROUP,
+        )
+        measured.rows_out = rows
+    # An empty table leaves an empty export
+    os.makedirs(staging, exist_ok=True)
+
+    old = f"{path}__ancienne"
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old)
+    os.rename(staging, path)
+    shutil.rmtree(old, ignore_errors=True)
+    print(f"Table '{table_name}' exportée en {fmt} dans '{path}' ({rows} lignes).")
+    return rows
+
+
+def read_export(
+    table_name,
+    columns=None,
+    departements=None,
+    fmt=EXPORT_FORMAT,
+    directory=EXPORT_DIRECTORY,
+):
+    """Lit un export : seulement les colonnes et départements demandés.
+
+    Seuls les fichiers des départements demandés sont ouverts, et seules les
+    colonnes demandées y sont lues. Les fichiers Arrow IPC sont projetés en
+    mémoire (memory map) : leurs colonnes ne sont pas copiées en les lisant.
+
+    Args:
+        table_name (str): Table exportée.
+        columns (list, optional): Colonnes lues ; par défaut, toutes.
+        departements (list, optional): Départements lus ("01", "2A"...) ; par
+            défaut, tous.
+        fmt (str, optional): parquet ou arrow.
+        directory (str, optional): Dossier des exports.
+
+    Returns:
+        pyarrow.Table: Lignes lues (to_pandas() pour un DataFrame).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Format d'export inconnu : '{fmt}' (parquet ou arrow).")
+    if pa is None:
+        raise ImportError("La lecture d'un export nécessite le paquet pyarrow.")
+    dataset = ds.dataset(
+        os.path.join(directory, table_name),
+        format=FORMATS[fmt][0],
+        # Département codes are text: "01" and "2A", not numbers
+        partitioning=ds.partitioning(
+            pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive"
+        ),
+        filesystem=pa.fs.LocalFileSystem(use_mmap=fmt == "arrow"),
+    )
+    condition = None
+    if departements is not None:
+        condition = ds.field(PARTITION_COLUMN).isin(list(departements))
+    return dataset.to_table(columns=columns, filter=condition)
+
+
+def _chain(first, frames):
+    yield first
+    yield from frames
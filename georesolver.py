@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+from matching import NgramIndex, iris_quality, normalize_series, normalize_text
+
+
+def _code(value, width):
+    """Code postal ou INSEE sous sa forme de référence (texte), ou None."""
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, (int, np.integer, float, np.floating)):
+        # Numeric codes have lost their leading zero
+        return str(int(value)).zfill(width)
+    return str(value)
+
+
+def _codes(values, width):
+    """_code appliqué une seule fois par valeur distincte de values."""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+    formatted = np.array([_code(value, width) for value in uniques] + [None])
+    # Missing values are coded -1 and pick the trailing None
+    return formatted[codes]
+
+
+def _normalized(value):
+    return "" if value is None or pd.isna(value) else normalize_text(value)
+
+
+def _table(mapping):
+    """Série des valeurs de mapping indexée par ses clés (code, libellé)."""
+    keys = list(mapping)
+    return pd.Series(
+        list(mapping.values()),
+        index=pd.MultiIndex.from_arrays(
+            [[code for code, _ in keys], [label for _, label in keys]]
+        ),
+        dtype=object,
+    )
+
+
+class GeoResolver:
+    """Index en mémoire des codes postaux, communes et IRIS.
+
+    refCP et Ref_IRIS_geo2024 sont chargées une fois et réduites à deux
+    dictionnaires : (code postal, commune normalisée) -> code INSEE et
+    (code INSEE, lieu-dit normalisé) -> code IRIS. Les résultats sont ceux
+    d'EG_Insee_Iris : c_insee, c_iris, c_qualite_iris et codgeo. Quand une
+    clé figure plusieurs fois dans une référence, la première ligne est
+    retenue (la jointure d'EG_Insee_Iris répète alors la ligne du client).
+
+    Args:
+        refcp (pd.DataFrame): Table refcp (code_postal, code_commune_insee,
+            nom_de_la_commune).
+        ref_iris (pd.DataFrame): Table ref_iris_geo2024 (depcom, code_iris, lib_iris).
+        seuil (float, optional): Similarité minimale du rapprochement approché
+            des villes et lieux-dits sans correspondance exacte (voir
+            matching.NgramIndex). Par défaut à None (correspondances exactes seules).
+    """
+
+    def __init__(self, refcp, ref_iris, seuil=None):
+        self.seuil = seuil
+        # Snapshots of refcache.py already carry the normalized names
+        if "nom_de_la_commune_normalized" not in refcp.columns:
+            refcp = refcp.assign(
+                nom_de_la_commune_normalized=normalize_series(
+                    refcp["nom_de_la_commune"]
+                )
+            )
+        if "lib_iris_normalized" not in ref_iris.columns:
+            ref_iris = ref_iris.assign(
+                lib_iris_normalized=normalize_series(ref_iris["lib_iris"])
+            )
+        refcp = refcp.dropna(subset=["code_postal", "code_commune_insee"])
+        ref_iris = ref_iris.dropna(subset=["depcom", "code_iris"])
+
+        cp = [_code(value, 5) for value in refcp["code_postal"].tolist()]
+        insee = [_code(value, 5) for value in refcp["code_commune_insee"].tolist()]
+        names = refcp["nom_de_la_commune_normalized"].tolist()
+        self.communes = {}
+        for key, code in zip(zip(cp, names), insee):
+            self.communes.setdefault(key, code)
+
+        depcom = [_code(value, 5) for value in ref_iris["depcom"].tolist()]
+        code_iris = [_code(value, 9) for value in ref_iris["code_iris"].tolist()]
+        labels = ref_iris["lib_iris_normalized"].tolist()
+        self.iris = {}
+        for key, code in zip(zip(depcom, labels), code_iris):
+            self.iris.setdefault(key, code)
+        # The same dictionaries as indexed Series, looked up a whole batch at once
+        self.commune_table = _table(self.communes)
+        self.iris_table = _table(self.iris)
+
+        # Candidates of the approximate matching, built only when it is enabled
+        self.commune_codes = self.iris_codes = None
+        self.commune_index = self.iris_index = None
+        if seuil:
+            self.commune_codes = insee
+            self.commune_index = NgramIndex(pd.Series(cp), pd.Series(names))
+            self.iris_codes = code_iris
+            self.iris_index = NgramIndex(pd.Series(depcom), pd.Series(labels))
+
+    @classmethod
+    def from_storage(cls, storage, seuil=None):
+        """Construit l'index à partir des tables du stockage (voir storage.py)."""
+        return cls(
+            storage.read_table("refcp"), storage.read_table("ref_iris_geo2024"), seuil
+        )
+
+    def _commune(self, cp, ville):
+        c_insee = self.communes.get((cp, ville))
+        if c_insee is None and self.seuil and cp is not None and ville:
+            position = self.commune_index.best_match(cp, ville, self.seuil)
+            if position >= 0:
+                return self.commune_codes[position], True
+        return c_insee, False
+
+    def _iris(self, c_insee, lieu_dit):
+        code_iris = self.iris.get((c_insee, lieu_dit))
+        if code_iris is None and self.seuil and lieu_dit:
+            position = self.iris_index.best_match(c_insee, lieu_dit, self.seuil)
+            if position >= 0:
+                return self.iris_codes[position], True
+        return code_iris, False
+
+    def _lookup_batch(self, table, index, codes, keys, labels):
+        """Recherche par lot des clés (keys, labels) dans table.
+
+        Les correspondances exactes sont obtenues d'un seul get_indexer ; le
+        rapprochement approché n'est tenté qu'une fois par clé distincte restée
+        sans correspondance.
+
+        Returns:
+            tuple: Codes trouvés (None sinon) et masque des rapprochements approchés.
+        """
+        positions = table.index.get_indexer(pd.MultiIndex.from_arrays([keys, labels]))
+        found = positions >= 0
+        result = np.full(len(keys), None, dtype=object)
+        result[found] = table.to_numpy()[positions[found]]
+        approche = np.zeros(len(keys), dtype=bool)
+        if not self.seuil:
+            return result, approche
+
+        keys = np.asarray(keys, dtype=object)
+        labels = np.asarray(labels, dtype=object)
+        missing = ~found & pd.notna(keys) & (labels != "")
+        matches = dict.fromkeys(zip(keys[missing], labels[missing]))
+        for key, label in matches:
+            position = index.best_match(key, label, self.seuil)
+            matches[key, label] = codes[position] if position >= 0 else None
+        approximate = np.array(
+            [matches[key] for key in zip(keys[missing], labels[missing])], dtype=object
+        )
+        result[missing] = approximate
+        approche[missing] = pd.notna(approximate)
+        return result, approche
+
+    def resolve(self, cp, ville, lieu_dit=None):
+        """Géocode une adresse.
+
+        Args:
+            cp (str | int): Code postal.
+            ville (str): Nom de la commune.
+            lieu_dit (str, optional): Lieu-dit, rapproché des libellés IRIS.
+
+        Returns:
+            dict: c_insee, c_iris, c_qualite_iris et codgeo.
+        """
+        c_insee, approche = self._commune(_code(cp, 5), _normalized(ville))
+        code_iris = None
+        if c_insee is not None:
+            code_iris, iris_approche = self._iris(c_insee, _normalized(lieu_dit))
+            approche = approche or iris_approche
+
+        c_iris = code_iris[-4:] if code_iris is not None else "0000"
+        if c_insee is None:
+            c_qualite_iris = 8
+        elif approche:
+            c_qualite_iris = 3
+        else:
+            c_qualite_iris = 1 if code_iris is not None else 2
+        return {
+            "c_insee": c_insee,
+            "c_iris": c_iris,
+            "c_qualite_iris": c_qualite_iris,
+            "codgeo": (c_insee or "") + c_iris,
+        }
+
+    def resolve_batch(self, cp, ville, lieu_dit=None):
+        """Géocode un lot d'adresses.
+
+        Les communes puis les IRIS sont recherchés pour tout le lot à la fois
+        (voir _lookup_batch) ; codes postaux et libellés ne sont mis en forme
+        qu'une fois par valeur distincte.
+
+        Args:
+            cp (array-like): Codes postaux.
+            ville (array-like): Noms des communes.
+            lieu_dit (array-like, optional): Lieux-dits.
+
+        Returns:
+            pd.DataFrame: c_insee, c_iris, c_qualite_iris et codgeo, une ligne par
+                adresse, indexées comme cp s'il s'agit d'une Series.
+        """
+        index = cp.index if isinstance(cp, pd.Series) else None
+        cp = _codes(cp, 5)
+        ville = normalize_series(pd.Series(ville).reset_index(drop=True))
+        if lieu_dit is None:
+            lieu_dit = pd.Series("", index=ville.index)
+        else:
+            lieu_dit = normalize_series(pd.Series(lieu_dit).reset_index(drop=True))
+
+        c_insee, approche = self._lookup_batch(
+            self.commune_table,
+            self.commune_index,
+            self.commune_codes,
+            cp,
+            ville.tolist(),
+        )
+        # Addresses without a commune have no IRIS: their key is left missing
+        code_iris, iris_approche = self._lookup_batch(
+            self.iris_table,
+            self.iris_index,
+            self.iris_codes,
+            c_insee,
+            lieu_dit.where(pd.notna(c_insee), "").tolist(),
+        )
+        c_insee = pd.Series(c_insee, dtype=object)
+        code_iris = pd.Series(code_iris, dtype=object)
+        approche |= iris_approche
+
+        c_iris = code_iris.str[-4:].fillna("0000")
+        result = pd.DataFrame(
+            {
+                "c_insee": c_insee,
+                "c_iris": c_iris,
+                "c_qualite_iris": iris_quality(
+                    code_iris, c_insee, pd.Series(approche)
+                ),
+                "codgeo": c_insee.fillna("") + c_iris,
+            }
+        )
+        if index is not None:
+            result.index = index
+        return result
@@ -0,0 +1,176 @@
+import json
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect, text
+from schema import widen_columns
+from writer import write_table
+
+# Suffix of the table holding the fingerprint of every enriched client
+FINGERPRINT_SUFFIX = "_empreintes"
+
+
+def fingerprint_table(table_name):
+    """Nom de la table des empreintes associée à une table de sortie."""
+    return f"{table_name}{FINGERPRINT_SUFFIX}"
+
+
+def reference_context(parameters, reference_tables, storage):
+    """Résume les paramètres d'appel et l'état des tables de référence.
+
+    Le résumé entre dans l'empreinte de chaque client : si un paramètre ou une
+    référence change, tous les clients sont de nouveau enrichis.
+    """
+    signatures = {
+        table_name: storage.table_signature(table_name)
+        for table_name in reference_tables
+        if storage.has_table(table_name)
+    }
+    return json.dumps(
+        {"parametres": parameters, "references": signatures}, sort_keys=True
+    )
+
+
+def client_fingerprints(tb, id_column, columns, context):
+    """Empreinte (entier 64 bits) des champs de chaque client, indexée par id."""
+    columns = tb.columns if columns is None else columns
+    values = tb[columns].astype("string").fillna("<NA>").assign(_contexte=context)
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    # Stored signed, as MySQL BIGINT
+    return pd.Series(hashes.view(np.int64), index=tb[id_column].astype(str).values)
+
+
+def upsert_rows(df, table_name, id_column, engine):
+    """Remplace dans table_name les lignes des clients présents dans df.
+
+    Les lignes sont d'abord écrites dans une table de transit, puis les
+    anciennes lignes des mêmes clients sont supprimées et les nouvelles
+    insérées en une transaction. Les colonnes de table_name trop étroites
+    pour les nouvelles valeurs sont élargies au préalable.
+    """
+    if df.empty:
+        return
+    if not inspect(engine).has_table(table_name):
+        write_table(df, table_name, engine)
+        return
+
+    staging = f"{table_name}_maj"
+    write_table(df, staging, engine)
+    raw_connection = engine.raw_connection()
+    try:
+        widen_columns(table_name, df, raw_connection)
+    finally:
+        raw_connection.close()
+    columns = ", ".join(f"`{col}`" for col in df.columns)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f"DELETE t FROM `{table_name}` t JOIN `{staging}` s "
+                f"ON t.`{id_column}` = s.`{id_column}`"
+            )
+        )
+        connection.execute(
+            text(
+                f"INSERT INTO `{table_name}` ({columns}) "
+                f"SELECT {columns} FROM `{staging}`"
+            )
+        )
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS `{staging}`"))
+
+
+def delete_rows(table_name, id_column, ids, engine):
+    """Supprime de table_name les lignes des clients ids."""
+    if len(ids) == 0 or not inspect(engine).has_table(table_name):
+        return
+    staging = f"{table_name}_suppr"
+    write_table(pd.DataFrame({id_column: ids}), staging, engine)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                f"DELETE t FROM `{table_name}` t JOIN `{staging}` s "
+                f"ON t.`{id_column}` = s.`{id_column}`"
+            )
+        )
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS `{staging}`"))
+
+
+class IncrementalRun:
+    """Exécution incrémentale : seuls les clients nouveaux ou modifiés sont enrichis.
+
+    L'empreinte de chaque client est comparée à celle enregistrée lors de
+    l'exécution précédente. Les lignes des clients modifiés remplacent les
+    anciennes dans la table de sortie, et les clients disparus de l'entrée en
+    sont retirés à la fin.
+
+    Args:
+        table_name (str): Table de sortie.
+        id_column (str): Colonne id_client de l'entrée.
+        output_id_column (str): Colonne id_client de la table de sortie.
+        columns (list): Colonnes de l'entrée entrant dans l'empreinte (None : toutes).
+        context (str): Résumé renvoyé par reference_context.
+        engine (sqlalchemy.Engine): Connexion à la base de données.
+    """
+
+    def __init__(
+        self, table_name, id_column, output_id_column, columns, context, engine
+    ):
+        self.table_name = table_name
+        self.id_column = id_column
+        self.output_id_column = output_id_column
+        self.columns = columns
+        self.context = context
+        self.engine = engine
+
+        fingerprints = fingerprint_table(table_name)
+        if inspect(engine).has_table(table_name) and inspect(engine).has_table(
+            fingerprints
+        ):
+            stored = pd.read_sql_table(fingerprints, con=engine)
+        else:
+            stored = pd.DataFrame({"id_client": [], "empreinte": []})
+        self.stored = pd.Series(
+            stored["empreinte"].to_numpy(dtype=np.int64),
+            index=stored["id_client"].astype(str).values,
+        )
+        self.seen = np.zeros(len(self.stored), dtype=bool)
+
+    def select(self, tb):
+        """Renvoie les clients de tb nouveaux ou modifiés, avec leurs empreintes."""
+        if tb[self.id_column].duplicated().any():
+            raise ValueError(
+                f"La colonne '{self.id_column}' doit être unique en mode incrémental."
+            )
+        fingerprints = client_fingerprints(
+            tb, self.id_column, self.columns, self.context
+        )
+        positions = self.stored.index.get_indexer(fingerprints.index)
+        known = positions >= 0
+        self.seen[positions[known]] = True
+
+        changed = ~known
+        changed[known] = (
+            self.stored.to_numpy()[positions[known]] != fingerprints.to_numpy()[known]
+        )
+        return tb[changed], fingerprints[changed]
+
+    def write(self, enriched, fingerprints):
+        """Remplace les lignes des clients enrichis et enregistre leurs empreintes."""
+        upsert_rows(enriched, self.table_name, self.output_id_column, self.engine)
+        upsert_rows(
+            pd.DataFrame(
+                {"id_client": fingerprints.index, "empreinte": fingerprints.values}
+            ),
+            fingerprint_table(self.table_name),
+            "id_client",
+            self.engine,
+        )
+
+    def finish(self):
+        """Retire les clients absents de l'entrée ; renvoie leur nombre."""
+        removed = self.stored.index[~self.seen]
+        delete_rows(self.table_name, self.output_id_column, removed, self.engine)
+        delete_rows(
+            fingerprint_table(self.table_name), "id_client", removed, self.engine
+        )
+        return len(removed)
@@ -1,11 +1,27 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import json
-import mysql.connector
-import numpy as np
 import re
 import requests
 import configparser
+from instrumentation import stage, step
+from prenoms import PROFILE_TABLE, build_first_name_profile
+from schema import (
+    INTEGER_TYPES,
+    add_normalized_columns,
+    create_indexes,
+    integer_sql_type,
+    string_sql_type,
+)
+from storage import BACKEND, open_storage
+
+try:
+    import mysql.connector
+    from mysql.connector import pooling
+except ImportError:  # Only the mysql backend loads its tables through mysql.connector
+    mysql = pooling = None
 
 # Load configuration
 config = configparser.ConfigParser()
@@ -19,28 +35,125 @@ DB_CONFIG = {
     "port": config["database"].getint("port", fallback=3306),
 }
 
+# Number of tables created and loaded concurrently
+LOAD_WORKERS = config.getint("chargement", "workers", fallback=4)
+
+# Number of CSV rows parsed at a time, so memory stays flat whatever the file size
+CHUNK_SIZE = 100000
+
+# Fields read as NULL by LOAD DATA, like pandas' default missing values
+NA_STRINGS = ("", "NA", "N/A", "NULL", "NaN", "nan", "null", "None", "#N/A", "<NA>")
+
 # Function to normalize column names
 def normalize_column_name(col_name):
     col_name = col_name.lower()
     col_name = re.sub(r"[^a-z0-9]", "_", col_name)
     return col_name
 
-# Function to infer SQL data types based on pandas column data types
-def infer_sql_type(dtype):
-    if pd.api.types.is_integer_dtype(dtype):
-        return "INT"
-    elif pd.api.types.is_float_dtype(dtype):
-        return "DECIMAL(10, 2)"
-    else:
+# Width of the INSEE, IRIS and postcode codes, stored as zero-padded CHAR
+CODE_WIDTHS = {
+    "code_iris": 9,
+    "depcom": 5,
+    "code_commune_insee": 5,
+    "c_insee": 5,
+    "code_postal": 5,
+    "cp": 5,
+}
+
+# Significant digits kept exactly by a single-precision FLOAT
+FLOAT_DIGITS = 6
+
+# Function to summarize the values of one column, read as text
+def column_stats(values):
+    values = values.dropna()
+    if values.empty:
+        return None
+
+    integers = values.str.fullmatch(r"[+-]?\d{1,18}")
+    numbers = pd.to_numeric(values, errors="coerce")
+    mantissas = values.str.replace(r"[eE].*$", "", regex=True)
+    digits = mantissas.str.replace(r"\D", "", regex=True).str.lstrip("0").str.len()
+    return {
+        "min_len": int(values.str.len().min()),
+        "max_len": int(values.str.len().max()),
+        "alnum": bool(values.str.fullmatch(r"[0-9A-Za-z]+").all()),
+        "leading_zero": bool(values.str.match(r"0\d").any()),
+        "integer": bool(integers.all()),
+        "number": bool(numbers.notna().all()),
+        "min": numbers.min(),
+        "max": numbers.max(),
+        "digits": int(digits.max()),
+    }
+
+# Function to merge the summaries of two chunks of the same column
+def merge_column_stats(stats, other):
+    if stats is None or other is None:
+        return other if stats is None else stats
+    return {
+        "min_len": min(stats["min_len"], other["min_len"]),
+        "max_len": max(stats["max_len"], other["max_len"]),
+        "alnum": stats["alnum"] and other["alnum"],
+        "leading_zero": stats["leading_zero"] or other["leading_zero"],
+        "integer": stats["integer"] and other["integer"],
+        "number": stats["number"] and other["number"],
+        "min": min(stats["min"], other["min"]),
+        "max": max(stats["max"], other["max"]),
+        "digits": max(stats["digits"], other["digits"]),
+    }
+
+# Function to pick the most compact SQL type holding every value of a column
+def infer_sql_type(col_name, stats):
+    if stats is None:
         return "VARCHAR(255)"
 
+    # Codes keep their leading zeros; known codes are padded back to full width
+    width = CODE_WIDTHS.get(col_name)
+    if stats["alnum"] and (width is not None or stats["leading_zero"]):
+        if width is None and stats["min_len"] == stats["max_len"]:
+            width = stats["max_len"]
+        if width is not None and stats["max_len"] <= width:
+            return f"CHAR({width})"
+        return f"VARCHAR({stats['max_len']})"
+
+    if stats["integer"]:
+        sql_type = integer_sql_type(stats["min"], stats["max"])
+        if sql_type is not None:
+            return sql_type
+
+    if stats["number"]:
+        fits_float = max(abs(stats["min"]), abs(stats["max"])) < 3.4e38
+        return "FLOAT" if fits_float and stats["digits"] <= FLOAT_DIGITS else "DOUBLE"
+
+    return string_sql_type(stats["max_len"])
+
+# Function to infer the SQL types of a CSV file in a single streamed pass
+def infer_csv_schema(file_path):
+    stats = {}
+    for chunk in pd.read_csv(
+        file_path,
+        chunksize=CHUNK_SIZE,
+        dtype=str,
+        keep_default_na=False,
+        na_values=NA_STRINGS,
+    ):
+        chunk.columns = [normalize_column_name(col) for col in chunk.columns]
+        for col in chunk.columns:
+            stats[col] = merge_column_stats(stats.get(col), column_stats(chunk[col]))
+    return {col: infer_sql_type(col, col_stats) for col, col_stats in stats.items()}
+
+# Function to infer the SQL types of a DataFrame built in Python
+def infer_dataframe_schema(df):
+    return {
+        col: infer_sql_type(col, column_stats(df[col].astype("string").astype(object)))
+        for col in df.columns
+    }
+
 # Function to generate CREATE TABLE SQL queries
-def generate_sql_create_table(file_name, df):
+def generate_sql_create_table(file_name, schema):
     table_name = os.path.splitext(file_name)[0].lower()
     sql_columns = []
 
-    for col in df.columns:
-        sql_type = infer_sql_type(df[col].dtype)
+    for col, sql_type in schema.items():
         column_definition = f"{col} {sql_type}"
         sql_columns.append(column_definition)
 
@@ -70,9 +183,8 @@ def create_json_queries(directory):
         if file_name.endswith(".csv"):
             file_path = os.path.join(directory, file_name)
             try:
-                df = pd.read_csv(file_path, low_memory=False)
-                df.columns = [normalize_column_name(col) for col in df.columns]
-                create_table_query = generate_sql_create_table(file_name, df)
+                schema = infer_csv_schema(file_path)
+                create_table_query = generate_sql_create_table(file_name, schema)
                 sql_queries[file_name] = create_table_query
             except Exception as e:
                 print(f"Erreur lors de la lecture de {file_name} : {e}")
@@ -96,35 +208,95 @@ def connect_to_db():
         user=DB_CONFIG["user"],
         password=DB_CONFIG["password"],
         port=DB_CONFIG["port"],
+        allow_local_infile=True,
     )
 
-# Create tables from JSON file
-def create_tables_from_json(json_file, connection):
+# Create one table from its DDL and load its CSV file, on a pooled connection
+def load_table(file_name, create_query, directory, pool):
+    table_name = os.path.splitext(file_name)[0].lower()
+    start = time.perf_counter()
+    with step(f"chargement {table_name}") as measured:
+        connection = pool.get_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(create_query)
+            connection.commit()
+            load_csv(
+                file_name, os.path.join(directory, file_name), table_name, connection
+            )
+            # Indexes are built after the load, which stays a plain bulk insert
+            add_normalized_columns(table_name, connection)
+            create_indexes(table_name, connection)
+            if table_name == "table_prenoms":
+                create_first_name_profile(connection)
+            cursor = connection.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM {table_name}")
+            rows = cursor.fetchone()[0]
+        except Exception:
+            # Never leave a half-loaded table behind
+            connection.rollback()
+            cursor = connection.cursor()
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+            if table_name == "table_prenoms":
+                cursor.execute(f"DROP TABLE IF EXISTS {PROFILE_TABLE}")
+            connection.commit()
+            raise
+        finally:
+            connection.close()
+        measured.rows_out = rows
+    return table_name, rows, time.perf_counter() - start
+
+# Create and load every table of the JSON file concurrently over a connection pool
+def load_tables_from_json(json_file, directory, workers):
     with open(json_file, "r") as f:
         sql_queries = json.load(f)
 
-    cursor = connection.cursor()
-    for table, create_query in sql_queries.items():
-        try:
-            cursor.execute(create_query)
-            print(f"Table '{table}' créée avec succès.")
-        except mysql.connector.Error as err:
-            print(f"Erreur lors de la création de la table '{table}': {err}")
-    connection.commit()
+    workers = max(1, min(workers, pooling.CNX_POOL_MAXSIZE))
+    pool = pooling.MySQLConnectionPool(
+        pool_name="initfiles",
+        pool_size=workers,
+        host=DB_CONFIG["host"],
+        user=DB_CONFIG["user"],
+        password=DB_CONFIG["password"],
+        port=DB_CONFIG["port"],
+        database=DB_CONFIG["database"],
+        allow_local_infile=True,
+    )
+
+    failed_tables = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(load_table, file_name, create_query, directory, pool): file_name
+            for file_name, create_query in sql_queries.items()
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            file_name = futures[future]
+            try:
+                table_name, rows, seconds = future.result()
+                print(
+                    f"[{done}/{len(futures)}] Table '{table_name}' chargée : "
+                    f"{rows} lignes en {seconds:.1f} s."
+                )
+            except Exception as e:
+                failed_tables.append(file_name)
+                print(f"[{done}/{len(futures)}] Erreur lors du traitement de {file_name} : {e}")
+    return failed_tables
 
 # Insert data from CSV file
 def insert_data_from_csv(file_name, df, table_name, connection, batch_size=1000):
     df.columns = [normalize_column_name(col) for col in df.columns]
-    df = df.replace({np.nan: None})
 
     cursor = connection.cursor()
     cols = ", ".join(df.columns)
     placeholders = ", ".join(["%s"] * len(df.columns))
     insert_query = f"INSERT INTO {table_name} ({cols}) VALUES ({placeholders})"
-    data = df.values.tolist()
 
-    for i in range(0, len(data), batch_size):
-        batch_data = data[i : i + batch_size]
+    # executemany sends each batch as a single multi-row INSERT
+    for i in range(0, len(df), batch_size):
+        batch = df.iloc[i : i + batch_size].astype(object)
+        batch_data = list(
+            batch.where(batch.notna(), None).itertuples(index=False, name=None)
+        )
         try:
             cursor.executemany(insert_query, batch_data)
         except mysql.connector.Error as err:
@@ -136,39 +308,197 @@ def insert_data_from_csv(file_name, df, table_name, connection, batch_size=1000)
 
     connection.commit()
 
-# Directory path for CSV files
-directory = os.path.join(os.getcwd(), "output_data")
-os.makedirs(directory, exist_ok=True)
+# Fixed-width code columns of a table, whose values are padded with leading zeros
+def padded_columns(table_name, connection):
+    cursor = connection.cursor()
+    cursor.execute(
+        """
+        SELECT column_name, character_maximum_length
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND data_type = 'char'
+        """,
+        (table_name,),
+    )
+    widths = {column.lower(): int(width) for column, width in cursor.fetchall()}
+    cursor.close()
+    return widths
 
-# Check and download required CSV files
-download_if_missing(
-    os.path.join(directory, "refCP.csv"),
-    "https://raw.githubusercontent.com/AurelienLELEU/GeoEnrichissmentStats/a16b696e86907f812d563515b05e15751330a1b3/refCP.csv",
-)
-download_if_missing(
-    os.path.join(directory, "Ref_IRIS_geo2024.csv"),
-    "https://raw.githubusercontent.com/AurelienLELEU/GeoEnrichissmentStats/a16b696e86907f812d563515b05e15751330a1b3/Ref_IRIS_geo2024.csv",
-)
+# Quote a value as a MySQL string literal, escaping its backslashes and quotes
+def sql_string(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+# Load a CSV file server-side with LOAD DATA LOCAL INFILE, without parsing it in Python
+def bulk_load_csv(file_path, table_name, connection, widths):
+    columns = [normalize_column_name(col) for col in pd.read_csv(file_path, nrows=0).columns]
+    with open(file_path, "rb") as f:
+        line_terminator = "\\r\\n" if f.readline().endswith(b"\r\n") else "\\n"
+
+    na_strings = ", ".join(sql_string(value) for value in NA_STRINGS)
+    variables = ", ".join(f"@v{i}" for i in range(len(columns)))
+    assignments = []
+    for i, col in enumerate(columns):
+        value = f"LPAD(@v{i}, {widths[col]}, '0')" if col in widths else f"@v{i}"
+        assignments.append(f"{col} = IF(@v{i} IN ({na_strings}), NULL, {value})")
+    # No escape character: backslashes stay as they are, as in the read_csv fallback
+    load_query = f"""
+    LOAD DATA LOCAL INFILE {sql_string(file_path.replace(os.sep, "/"))}
+    INTO TABLE {table_name}
+    CHARACTER SET utf8mb4
+    FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY ''
+    LINES TERMINATED BY '{line_terminator}'
+    IGNORE 1 LINES
+    ({variables})
+    SET {", ".join(assignments)};
+    """
+
+    cursor = connection.cursor()
+    cursor.execute(load_query)
+    connection.commit()
+    cursor.close()
 
-# Generate SQL queries and create JSON file
-create_json_queries(directory)
+# Load a CSV file, falling back to chunked multi-row INSERTs if LOAD DATA is refused
+def load_csv(file_name, file_path, table_name, connection):
+    widths = padded_columns(table_name, connection)
+    try:
+        bulk_load_csv(file_path, table_name, connection, widths)
+        return
+    except mysql.connector.Error as err:
+        connection.rollback()
+        print(f"LOAD DATA refusé pour '{table_name}' ({err}), insertion par lots.")
 
-# Connect to the database and process data
-connection = connect_to_db()
-create_database_if_not_exists(connection, DB_CONFIG["database"])
-create_tables_from_json("tables_script.json", connection)
+    # Values are sent as text, like LOAD DATA, and converted by the server
+    for chunk in pd.read_csv(
+        file_path,
+        chunksize=CHUNK_SIZE,
+        dtype=str,
+        keep_default_na=False,
+        na_values=NA_STRINGS,
+    ):
+        chunk.columns = [normalize_column_name(col) for col in chunk.columns]
+        for col, width in widths.items():
+            if col in chunk.columns:
+                chunk[col] = chunk[col].str.zfill(width)
+        insert_data_from_csv(
+            file_name, chunk, table_name, connection, batch_size=CHUNK_SIZE
+        )
 
-# Insert data into respective tables
-for file_name in os.listdir(directory):
-    if file_name.endswith(".csv"):
-        file_path = os.path.join(directory, file_name)
-        table_name = os.path.splitext(file_name)[0].lower()
+# Build the compact first-name profile used by EG_age_sexe
+def create_first_name_profile(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM table_prenoms")
+    tb_prenoms = pd.DataFrame(cursor.fetchall(), columns=cursor.column_names)
+    profile = build_first_name_profile(tb_prenoms)
+    cursor = connection.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {PROFILE_TABLE}")
+    cursor.execute(
+        generate_sql_create_table(f"{PROFILE_TABLE}.csv", infer_dataframe_schema(profile))
+    )
+    connection.commit()
+    insert_data_from_csv(f"{PROFILE_TABLE}.csv", profile, PROFILE_TABLE, connection)
+    create_indexes(PROFILE_TABLE, connection)
+    print(f"Table '{PROFILE_TABLE}' créée avec succès ({len(profile)} prénoms).")
+
+# Convert the text columns of a CSV chunk to the types inferred for its table
+def typed_chunk(chunk, schema):
+    integer_types = {sql_type for sql_type, _ in INTEGER_TYPES}
+    for col, sql_type in schema.items():
+        if sql_type.startswith("CHAR("):
+            chunk[col] = chunk[col].str.zfill(int(sql_type[5:-1]))
+        elif sql_type.split()[0] in integer_types:
+            dtype = "UInt64" if sql_type == "BIGINT UNSIGNED" else "Int64"
+            chunk[col] = pd.to_numeric(chunk[col]).astype(dtype)
+        elif sql_type in ("FLOAT", "DOUBLE"):
+            chunk[col] = pd.to_numeric(chunk[col])
+    return chunk
+
+# Load a CSV file into a SQLite, DuckDB or Parquet storage, by typed chunks
+def load_csv_into_storage(file_path, storage):
+    table_name = os.path.splitext(os.path.basename(file_path))[0].lower()
+    start = time.perf_counter()
+    with step(f"chargement {table_name}") as measured:
+        schema = infer_csv_schema(file_path)
+        rows = 0
+        # Chunks fill a staging table, swapped in once the whole file is loaded
+        with storage.table_writer(table_name) as writer:
+            for chunk in pd.read_csv(
+                file_path,
+                chunksize=CHUNK_SIZE,
+                dtype=str,
+                keep_default_na=False,
+                na_values=NA_STRINGS,
+            ):
+                chunk.columns = [
+                    normalize_column_name(col) for col in chunk.columns
+                ]
+                # Same numbering as the AUTO_INCREMENT id of the MySQL tables
+                chunk.insert(0, "id", range(rows + 1, rows + len(chunk) + 1))
+                writer.write(typed_chunk(chunk, schema))
+                rows += len(chunk)
+        if table_name == "table_prenoms":
+            profile = build_first_name_profile(storage.read_table(table_name))
+            storage.write_table(profile, PROFILE_TABLE)
+            print(
+                f"Table '{PROFILE_TABLE}' créée avec succès "
+                f"({len(profile)} prénoms)."
+            )
+        measured.rows_out = rows
+    return table_name, rows, time.perf_counter() - start
+
+# Load every CSV file of the directory into a SQLite, DuckDB or Parquet storage
+def load_tables_into_storage(directory, storage):
+    file_names = sorted(f for f in os.listdir(directory) if f.endswith(".csv"))
+    failed_tables = []
+    for done, file_name in enumerate(file_names, start=1):
         try:
-            df = pd.read_csv(file_path, low_memory=False)
-            df.columns = [normalize_column_name(col) for col in df.columns]
-            insert_data_from_csv(file_name, df, table_name, connection)
+            table_name, rows, seconds = load_csv_into_storage(
+                os.path.join(directory, file_name), storage
+            )
+            print(
+                f"[{done}/{len(file_names)}] Table '{table_name}' chargée : "
+                f"{rows} lignes en {seconds:.1f} s."
+            )
         except Exception as e:
-            print(f"Erreur lors du traitement de {file_name} : {e}")
+            failed_tables.append(file_name)
+            print(
+                f"[{done}/{len(file_names)}] Erreur lors du traitement de "
+                f"{file_name} : {e}"
+            )
+    return failed_tables
+
+if __name__ == "__main__":
+    # Directory path for CSV files
+    directory = os.path.join(os.getcwd(), "output_data")
+    os.makedirs(directory, exist_ok=True)
 
-connection.close()
-print("Processus terminé.")
+    # Check and download required CSV files
+    download_if_missing(
+        os.path.join(directory, "refCP.csv"),
+        "https://raw.githubusercontent.com/AurelienLELEU/GeoEnrichissmentStats/a16b696e86907f812d563515b05e15751330a1b3/refCP.csv",
+    )
+    download_if_missing(
+        os.path.join(directory, "Ref_IRIS_geo2024.csv"),
+        "https://raw.githubusercontent.com/AurelienLELEU/GeoEnrichissmentStats/a16b696e86907f812d563515b05e15751330a1b3/Ref_IRIS_geo2024.csv",
+    )
+
+    # Durée, mémoire et lignes de chaque table (section [instrumentation])
+    with stage("initfiles"):
+        if BACKEND == "mysql":
+            # Generate SQL queries and create JSON file
+            create_json_queries(directory)
+
+            # Create the database, then create and load the tables in parallel
+            connection = connect_to_db()
+            create_database_if_not_exists(connection, DB_CONFIG["database"])
+            connection.close()
+
+            failed_tables = load_tables_from_json(
+                "tables_script.json", directory, LOAD_WORKERS
+            )
+        else:
+            # Embedded storage: one writer at a time, no server to create
+            failed_tables = load_tables_into_storage(directory, open_storage())
+
+    if failed_tables:
+        print(f"Processus terminé avec des erreurs, tables non chargées : {', '.join(failed_tables)}")
+    else:
+        print("Processus terminé.")
@@ -0,0 +1,434 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+import configparser
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+# Measurements of each stage (initfiles, 01, 02, 03, reports), off by default
+INSTRUMENTATION = config.getboolean("instrumentation", "actif", fallback=False)
+# json, or prometheus (text format of the node_exporter textfile collector)
+INSTRUMENTATION_FORMAT = config.get("instrumentation", "format", fallback="json")
+INSTRUMENTATION_DIRECTORY = config.get(
+    "instrumentation", "dossier", fallback="instrumentation"
+)
+# cProfile statistics of each stage, next to its measurements
+PROFILE = config.getboolean("instrumentation", "profil", fallback=False)
+
+# File extension of each format: one file per stage, replaced at each run
+FORMATS = {"json": ".json", "prometheus": ".prom"}
+METRIC_PREFIX = "enrichissement"
+
+
+def _status_kib(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1])
+
+
+class PeakMemory:
+    """Pic de mémoire résidente pendant un bloc with (relevé du noyau Linux).
+
+    Le pic est l'augmentation de la mémoire résidente par rapport à l'entrée
+    dans le bloc, mesurée sans ralentir le code. Les mesures s'imbriquent : la
+    remise à zéro du pic pour une mesure intérieure n'efface pas celui des
+    mesures englobantes. La mémoire est celle du processus, tous fils
+    d'exécution confondus. Hors de Linux, available vaut False.
+
+    Attributes:
+        bytes (int): Pic en octets, à la sortie du bloc (None si indisponible).
+    """
+
+    _open = []
+    _lock = threading.Lock()
+
+    def __enter__(self):
+        self.bytes = None
+        with self._lock:
+            self.baseline = self._reset()
+            self.high = self.baseline
+            if self.baseline is not None:
+                self._open.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.baseline is None:
+            return
+        with self._lock:
+            self._open.remove(self)
+            self.high = max(self.high, _status_kib("VmHWM"))
+        # Memory released before the block may be reused without raising the RSS
+        self.bytes = max(self.high - self.baseline, 0) * 1024
+
+    @property
+    def available(self):
+        return self.baseline is not None
+
+    @classmethod
+    def _reset(cls):
+        """Remet à zéro le pic du noyau ; renvoie la mémoire actuelle en Kio."""
+        try:
+            high = _status_kib("VmHWM")
+            # The peak reached so far still counts for the enclosing measurements
+            for measurement in cls._open:
+                measurement.high = max(measurement.high, high)
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            return None
+        return _status_kib("VmRSS")
+
+
+class Step:
+    """Lignes d'une sous-étape : rows_in à l'entrée, rows_out à renseigner."""
+
+    __slots__ = ("rows_in", "rows_out")
+
+    def __init__(self, rows_in=None):
+        self.rows_in = rows_in
+        self.rows_out = None
+
+
+class StageRecord:
+    """Mesures d'une étape : ses sous-étapes et ses répartitions de valeurs.
+
+    Les appels répétés d'une même sous-étape (un par lot) sont cumulés : durée
+    et lignes additionnées, pic de mémoire le plus haut.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.seconds = None
+        self.peak = None
+        self.status = "succes"
+        self.steps = {}
+        self.distributions = {}
+        self.lock = threading.Lock()
+
+    def add_step(self, name, seconds, peak, rows_in, rows_out):
+        with self.lock:
+            totals = self.steps.setdefault(
+                name,
+                {
+                    "appels": 0,
+                    "secondes": 0.0,
+                    "pic": None,
+                    "entree": None,
+                    "sortie": None,
+                },
+            )
+            totals["appels"] += 1
+            totals["secondes"] += seconds
+            if peak is not None:
+                totals["pic"] = max(totals["pic"] or 0, peak)
+            for key, rows in (("entree", rows_in), ("sortie", rows_out)):
+                if rows is not None:
+                    totals[key] = (totals[key] or 0) + int(rows)
+
+    def add_counts(self, name, counts):
+        with self.lock:
+            totals = self.distributions.setdefault(name, {})
+            for value, count in counts:
+                label = _label(value)
+                totals[label] = totals.get(label, 0) + int(count)
+
+    def summary(self):
+        """Mesures de l'étape, telles qu'enregistrées en JSON."""
+        return {
+            "etape": self.name,
+            "debut": datetime.fromtimestamp(self.started).isoformat(
+                timespec="seconds"
+            ),
+            "statut": self.status,
+            "secondes": _round(self.seconds, 4),
+            "pic_memoire_mo": _megabytes(self.peak),
+            "sous_etapes": {
+                name: {
+                    "appels": totals["appels"],
+                    "secondes": round(totals["secondes"], 4),
+                    "pic_memoire_mo": _megabytes(totals["pic"]),
+                    "lignes_entree": totals["entree"],
+                    "lignes_sortie": totals["sortie"],
+                }
+                for name, totals in self.steps.items()
+            },
+            "repartitions": {
+                name: dict(sorted(counts.items()))
+                for name, counts in self.distributions.items()
+            },
+        }
+
+
+# Stage measured by this process, and the enclosing steps of each thread
+_current = None
+_local = threading.local()
+
+
+def active():
+    """Indique si une étape est mesurée : les mesures coûteuses en dépendent."""
+    return _current is not None
+
+
+@contextmanager
+def stage(name, fmt=INSTRUMENTATION_FORMAT, directory=INSTRUMENTATION_DIRECTORY):
+    """Mesure une étape : durée, pic de mémoire, sous-étapes et répartitions.
+
+    À la fin de l'étape, même en erreur, ses mesures remplacent celles de
+    l'exécution précédente dans directory/<name>.json (ou .prom), et avec
+    profil = 1 les statistiques cProfile sont écrites dans directory/<name>.prof.
+    Une étape lancée pendant une autre (rapport du pipeline) en est une
+    sous-étape. Sans instrumentation, ne mesure rien.
+
+    Args:
+        name (str): Nom de l'étape (01, 02, 03graph...).
+        fmt (str, optional): json ou prometheus.
+        directory (str, optional): Dossier des mesures.
+    """
+    global _current
+    if _current is not None:
+        if _current.name == name:
+            yield
+        else:
+            with step(name):
+                yield
+        return
+    if not INSTRUMENTATION:
+        yield
+        return
+    if fmt not in FORMATS:
+        raise ValueError(
+            f"Format d'instrumentation inconnu : '{fmt}' (json ou prometheus)."
+        )
+
+    record = StageRecord(name)
+    profiler = cProfile.Profile() if PROFILE else None
+    _current = record
+    try:
+        with PeakMemory() as memory:
+            started = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                record.seconds = time.perf_counter() - started
+    except BaseException:
+        record.status = "erreur"
+        raise
+    finally:
+        _current = None
+        record.peak = memory.bytes
+        save_stage(record, profiler, fmt, directory)
+
+
+@contextmanager
+def step(name, rows=None):
+    """Mesure une sous-étape de l'étape en cours : durée, pic de mémoire, lignes.
+
+    Les sous-étapes imbriquées sont nommées par leur chemin (« a/b »). Hors
+    d'une étape mesurée, ne mesure rien.
+
+    Args:
+        name (str): Nom de la sous-étape.
+        rows (int, optional): Nombre de lignes en entrée.
+
+    Yields:
+        Step: Mesure dont rows_out reçoit le nombre de lignes en sortie.
+    """
+    measured = Step(rows)
+    record = _current
+    if record is None:
+        yield measured
+        return
+    path = _path(name)
+    _steps().append(name)
+    try:
+        with PeakMemory() as memory:
+            started = time.perf_counter()
+            yield measured
+    finally:
+        _steps().pop()
+        record.add_step(
+            path,
+            time.perf_counter() - started,
+            memory.bytes,
+            measured.rows_in,
+            measured.rows_out,
+        )
+
+
+def timed_chunks(name, chunks):
+    """Parcourt chunks, la production de chaque lot comptant comme sous-étape name.
+
+    Le temps passé par l'appelant sur chaque lot n'est pas compté.
+    """
+    record = _current
+    if record is None:
+        yield from chunks
+        return
+    chunks = iter(chunks)
+    path = _path(name)
+    while True:
+        with PeakMemory() as memory:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        record.add_step(
+            path, time.perf_counter() - started, memory.bytes, None, len(chunk)
+        )
+        yield chunk
+
+
+def distribution(name, values):
+    """Ajoute à l'étape en cours le nombre de lignes de chaque valeur de values.
+
+    Args:
+        name (str): Nom de la répartition (c_qualite_iris, e_top_age_ok...).
+        values (pd.Series): Valeurs d'un lot ; les répartitions des lots
+            successifs s'additionnent.
+    """
+    if _current is not None:
+        record_counts(name, values.value_counts(dropna=False))
+
+
+def record_counts(name, counts):
+    """Comme distribution, à partir d'effectifs déjà calculés (valeur -> nombre)."""
+    if _current is not None:
+        _current.add_counts(name, counts.items())
+
+
+def save_stage(
+    record,
+    profiler=None,
+    fmt=INSTRUMENTATION_FORMAT,
+    directory=INSTRUMENTATION_DIRECTORY,
+):
+    """Écrit les mesures (et le profil) d'une étape, à la place des précédentes."""
+    os.makedirs(directory, exist_ok=True)
+    summary = record.summary()
+    if profiler is not None:
+        summary["profil"] = os.path.join(directory, f"{record.name}.prof")
+        profiler.dump_stats(summary["profil"])
+    if fmt == "prometheus":
+        text = prometheus_text(summary)
+    else:
+        text = json.dumps(summary, indent=2, ensure_ascii=False) + "\n"
+    path = os.path.join(directory, f"{record.name}{FORMATS[fmt]}")
+    # Write then rename, so a collector never reads a half-written file
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+    print(f"Mesures de l'étape '{record.name}' enregistrées dans '{path}'.")
+    return path
+
+
+def prometheus_text(summary):
+    """Mesures d'une étape au format texte de Prometheus (jauges)."""
+    etape = {"etape": summary["etape"]}
+    metrics = [
+        ("etape_duree_secondes", "Durée de l'étape", [(etape, summary["secondes"])]),
+        (
+            "etape_pic_memoire_octets",
+            "Pic de mémoire résidente de l'étape",
+            [(etape, _bytes(summary["pic_memoire_mo"]))],
+        ),
+        (
+            "etape_succes",
+            "1 si l'étape s'est terminée sans erreur",
+            [(etape, int(summary["statut"] == "succes"))],
+        ),
+        (
+            "etape_fin_timestamp_secondes",
+            "Fin de l'étape (heure Unix)",
+            [(etape, round(time.time()))],
+        ),
+    ]
+    steps = summary["sous_etapes"]
+    for metric, help_text, key, convert in (
+        ("sous_etape_duree_secondes", "Durée cumulée", "secondes", None),
+        ("sous_etape_appels", "Nombre d'appels", "appels", None),
+        ("sous_etape_pic_memoire_octets", "Pic de mémoire", "pic_memoire_mo", _bytes),
+        ("sous_etape_lignes_entree", "Lignes en entrée", "lignes_entree", None),
+        ("sous_etape_lignes_sortie", "Lignes en sortie", "lignes_sortie", None),
+    ):
+        samples = [
+            (
+                {**etape, "sous_etape": name},
+                convert(values[key]) if convert else values[key],
+            )
+            for name, values in steps.items()
+        ]
+        metrics.append((metric, f"{help_text} de chaque sous-étape", samples))
+    metrics.append(
+        (
+            "repartition_lignes",
+            "Nombre de lignes de chaque valeur d'une variable",
+            [
+                ({**etape, "variable": name, "valeur": value}, count)
+                for name, counts in summary["repartitions"].items()
+                for value, count in counts.items()
+            ],
+        )
+    )
+
+    lines = []
+    for metric, help_text, samples in metrics:
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            continue
+        name = f"{METRIC_PREFIX}_{metric}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(
+                f'{key}="{_escape(label)}"' for key, label in labels.items()
+            )
+            lines.append(f"{name}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _steps():
+    if not hasattr(_local, "steps"):
+        _local.steps = []
+    return _local.steps
+
+
+def _path(name):
+    return "/".join([*_steps(), name])
+
+
+def _label(value):
+    if pd.isna(value):
+        return "NA"
+    # Integer codes read back as floats (1.0) count with the integers
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _round(value, digits):
+    return None if value is None else round(value, digits)
+
+
+def _megabytes(value):
+    return None if value is None else round(value / 2**20, 1)
+
+
+def _bytes(megabytes):
+    return None if megabytes is None else round(megabytes * 2**20)
@@ -0,0 +1,154 @@
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from unidecode import unidecode
+
+# Translation table built once: "-" becomes a space and every accented Latin
+# character or typographic sign is replaced by its unidecode transliteration
+_TRANSLATION_TABLE = {ord("-"): " "}
+for _code_point in list(range(0x80, 0x300)) + list(range(0x2000, 0x2070)):
+    _TRANSLATION_TABLE[_code_point] = unidecode(chr(_code_point))
+
+# Enough entries to keep every commune and IRIS label of the references
+NORMALIZE_CACHE_SIZE = 1 << 17
+
+# Length of the character n-grams compared by the approximate matching
+NGRAM_SIZE = 3
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE, typed=True)
+def normalize_text(value):
+    """Normalise un libellé (minuscules, tirets en espaces, sans accents).
+
+    Équivalent à unidecode(str(value).lower().replace("-", " ")).
+    """
+    normalized = str(value).lower()
+    if normalized.isascii():
+        return normalized.replace("-", " ")
+
+    normalized = normalized.translate(_TRANSLATION_TABLE)
+    if not normalized.isascii():
+        # Characters outside the precompiled table (rare scripts, symbols)
+        normalized = unidecode(normalized)
+    return normalized
+
+
+def normalize_series(series, na_value=""):
+    """Normalise une colonne en ne traitant qu'une fois chaque valeur distincte.
+
+    Args:
+        series (pd.Series): Colonne de libellés.
+        na_value (str, optional): Valeur renvoyée pour les valeurs manquantes. Par défaut à "".
+
+    Returns:
+        pd.Series: Libellés normalisés, alignés sur series.
+    """
+    codes, uniques = pd.factorize(series)
+    normalized = np.array(
+        [normalize_text(value) for value in uniques] + [na_value], dtype=object
+    )
+    # Missing values are coded -1 and pick the trailing na_value
+    return pd.Series(normalized[codes], index=series.index, name=series.name)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def ngrams(text):
+    """Ensemble des trigrammes d'un libellé normalisé, bordé d'espaces.
+
+    Mis en cache : les libellés de référence ne sont découpés qu'une fois par
+    processus, quel que soit le nombre de lots.
+    """
+    padded = f" {text} "
+    return frozenset(
+        [padded[i : i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)]
+    )
+
+
+class NgramIndex:
+    """Index des trigrammes de libellés de référence, regroupés par clé.
+
+    Un libellé n'est comparé qu'aux candidats de même clé (code postal pour
+    les communes, code commune pour les IRIS). L'index est construit une fois
+    par table de référence ; les trigrammes des candidats d'une clé sont
+    calculés à sa première recherche, puis conservés pour les lots suivants.
+
+    Args:
+        keys (pd.Series): Clé de chaque libellé de référence.
+        names (pd.Series): Libellés de référence normalisés.
+    """
+
+    def __init__(self, keys, names):
+        self.names = names.to_numpy()
+        self.groups = pd.Series(np.arange(len(keys))).groupby(keys.to_numpy()).indices
+        self.blocks = {}
+
+    def _block(self, key):
+        if key not in self.blocks:
+            positions = self.groups.get(key, np.array([], dtype=np.intp))
+            self.blocks[key] = [
+                (position, ngrams(name))
+                for position, name in zip(
+                    positions.tolist(), self.names[positions].tolist()
+                )
+                if isinstance(name, str)
+            ]
+        return self.blocks[key]
+
+    def best_match(self, key, name, threshold):
+        """Position du libellé de même clé le plus proche de name, ou -1.
+
+        La similarité est le coefficient de Dice des trigrammes ; un candidat
+        n'est retenu que s'il atteint threshold. À score égal, le premier
+        candidat de la référence l'emporte.
+        """
+        query = ngrams(name)
+        best, best_score = -1, threshold
+        for position, candidate in self._block(key):
+            total = len(query) + len(candidate)
+            # Upper bound of the score, reached when one set contains the other
+            if 2 * min(len(query), len(candidate)) < best_score * total:
+                continue
+            score = 2 * len(query & candidate) / total
+            if score > best_score or (best < 0 and score == best_score):
+                best, best_score = position, score
+        return best
+
+    def match(self, keys, names, threshold):
+        """Rapproche chaque libellé du plus proche libellé de référence de même clé.
+
+        Chaque couple (clé, libellé) distinct n'est recherché qu'une fois.
+
+        Args:
+            keys (pd.Series): Clé de chaque libellé à rapprocher (renseignée).
+            names (pd.Series): Libellés normalisés à rapprocher (non vides).
+            threshold (float): Similarité minimale, entre 0 et 1.
+
+        Returns:
+            np.ndarray: Position dans la référence du libellé retenu, -1 si aucun.
+        """
+        queries = list(zip(keys.tolist(), names.tolist()))
+        best = {
+            query: self.best_match(*query, threshold)
+            for query in dict.fromkeys(queries)
+        }
+        return np.array([best[query] for query in queries], dtype=np.intp)
+
+
+def iris_quality(code_iris, c_insee, approximate=None):
+    """Indice de qualité du géocodage.
+
+    1 IRIS trouvé, 2 commune seule, 3 commune ou IRIS trouvé par rapprochement
+    approché (voir NgramIndex), 8 aucun.
+    """
+    if approximate is None:
+        approximate = pd.Series(False, index=c_insee.index)
+    return np.select(
+        [
+            approximate.to_numpy() & c_insee.notna().to_numpy(),
+            (code_iris.notna() & c_insee.notna()).to_numpy(),
+            c_insee.notna().to_numpy(),
+        ],
+        [3, 1, 2],
+        default=8,
+    )
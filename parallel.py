@@ -0,0 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from schema import drop_unused_categories
+
+# Column carrying the original row position while partitions are processed
+ORDER_COLUMN = "_ordre"
+
+# Sliced references of the current worker process, installed by its pool
+_references = None
+
+
+def departement_from_code(codes, width):
+    """Renvoie le département (2 premiers caractères) de codes postaux ou géographiques.
+
+    Les codes numériques ayant perdu leur zéro initial sont complétés à width
+    caractères avant d'être coupés.
+    """
+    if pd.api.types.is_numeric_dtype(codes):
+        codes = codes.astype("Int64")
+    return codes.astype(str).str.zfill(width).str[:2]
+
+
+def departement_pool(workers, references):
+    """Pool de processus pour map_by_departement.
+
+    Les références découpées sont copiées une seule fois dans chaque processus,
+    à son démarrage, et non à chaque lot.
+
+    Args:
+        workers (int): Nombre de processus.
+        references (dict): Références découpées, indexées par département.
+
+    Returns:
+        concurrent.futures.ProcessPoolExecutor: Pool de processus.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_install_references,
+        initargs=(references,),
+    )
+
+
+def map_by_departement(func, tb, departements, args, executor):
+    """Applique func à chaque département de tb dans un pool de processus.
+
+    Chaque tâche ne reçoit que ses lignes, avec leurs seules catégories ; la
+    tranche des références de son département est celle installée dans le
+    processus par departement_pool. Les résultats sont recombinés dans l'ordre
+    d'origine. Les lignes sans département (code manquant) forment une tâche
+    de plus, avec la tranche des références de la clé manquante.
+
+    Args:
+        func (callable): Fonction appelée comme func(lot, references_du_departement, *args).
+        tb (pd.DataFrame): Lignes à traiter.
+        departements (pd.Series): Département de chaque ligne, aligné sur tb.
+        args (tuple): Arguments supplémentaires de func.
+        executor (concurrent.futures.Executor): Pool créé par departement_pool.
+
+    Returns:
+        pd.DataFrame: Résultats concaténés, triés selon l'ordre des lignes de tb.
+    """
+    tb = tb.assign(**{ORDER_COLUMN: np.arange(len(tb))})
+    futures = [
+        executor.submit(
+            _run_partition, func, departement, drop_unused_categories(part), args
+        )
+        for departement, part in tb.groupby(
+            departements.values, sort=False, dropna=False
+        )
+    ]
+    results = _concat_partitions([future.result() for future in futures])
+    return (
+        results.sort_values(ORDER_COLUMN, kind="stable")
+        .drop(columns=ORDER_COLUMN)
+        .reset_index(drop=True)
+    )
+
+
+class DepartementSlices(dict):
+    """Tranches de références par département, avec une tranche vide par défaut."""
+
+    def __init__(self, slices, empty):
+        super().__init__(slices)
+        self.empty = empty
+
+    def __missing__(self, departement):
+        return self.empty
+
+
+def _install_references(references):
+    global _references
+    _references = references
+
+
+def _run_partition(func, departement, part, args):
+    return func(part, _references[departement], *args)
+
+
+def _concat_partitions(parts):
+    """Concatène les partitions en gardant leurs colonnes catégorielles.
+
+    pd.concat ne garde une colonne catégorielle que si toutes les partitions ont
+    les mêmes catégories ; sinon leurs catégories sont réunies.
+    """
+    results = pd.concat(parts, ignore_index=True)
+    for col in results.columns:
+        columns = [part[col] for part in parts]
+        if isinstance(results[col].dtype, pd.CategoricalDtype) or not all(
+            isinstance(column.dtype, pd.CategoricalDtype) for column in columns
+        ):
+            continue
+        results[col] = pd.Series(
+            union_categoricals(columns, sort_categories=True), name=col
+        )
+    return results
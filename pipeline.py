@@ -0,0 +1,355 @@
+import hashlib
+import importlib
+import json
+import os
+import time
+import configparser
+from excelreport import report_settings
+from export import EXPORT_FORMAT, export_table
+from instrumentation import stage as measure_stage
+from incremental import reference_context
+from prenoms import PROFILE_TABLE
+from refcache import CACHE_DIRECTORY, feather
+from reports import REPORTS, build_report
+from storage import open_storage
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+# Stage keys and snapshots of the stage outputs
+PIPELINE_DIRECTORY = os.path.join(CACHE_DIRECTORY, "pipeline")
+STATE_FILE = "etat.json"
+
+# Intermediate tables written to the database as well as passed in memory
+ECRIRE_TABLES = config.getboolean("pipeline", "ecrire_tables", fallback=True)
+
+# Modules through which every stage reads its tables (dtypes, derived columns)
+READ_SOURCES = ["storage.py", "schema.py", "refcache.py"]
+
+
+def file_hash(path):
+    """Empreinte SHA-256 du contenu d'un fichier."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Stage:
+    """Étape du pipeline.
+
+    Args:
+        name (str): Nom de l'étape.
+        run (callable): Fonction appelée avec les résultats des étapes amont,
+            dans l'ordre de inputs ; renvoie un DataFrame, ou None pour une
+            étape qui produit un fichier.
+        inputs (list, optional): Noms des étapes amont.
+        sources (list, optional): Fichiers Python dont le contenu entre dans la clé.
+        tables (list, optional): Tables du stockage lues par l'étape, dont le
+            nombre de lignes et le checksum entrent dans la clé.
+        parameters (dict, optional): Paramètres de l'étape, qui entrent dans la clé.
+        output_file (str, optional): Fichier produit par l'étape (rapport Excel) ;
+            sans output_file, le DataFrame renvoyé est conservé en instantané.
+    """
+
+    def __init__(
+        self,
+        name,
+        run,
+        inputs=(),
+        sources=(),
+        tables=(),
+        parameters=None,
+        output_file=None,
+    ):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.sources = list(sources)
+        self.tables = list(tables)
+        self.parameters = parameters or {}
+        self.output_file = output_file
+
+
+class Pipeline:
+    """Exécute des étapes dépendantes dans un seul processus.
+
+    Les DataFrames passent d'une étape à l'autre en mémoire, sans relecture
+    dans la base. La clé d'une étape résume ses fichiers sources, ses
+    paramètres, les tables qu'elle lit et les clés de ses étapes amont : une
+    étape dont la clé n'a pas changé depuis l'exécution précédente, et dont le
+    résultat (instantané Feather ou fichier produit) existe toujours, est
+    ignorée. Son résultat n'est relu que si une étape aval doit s'exécuter.
+
+    Args:
+        stages (list): Étapes (Stage), dans un ordre quelconque.
+        storage (Storage): Stockage des tables (voir storage.py).
+        directory (str, optional): Dossier des clés et des instantanés.
+    """
+
+    def __init__(self, stages, storage, directory=PIPELINE_DIRECTORY):
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError(
+                        f"Étape '{stage.name}' : étape amont '{name}' inconnue."
+                    )
+        self.storage = storage
+        self.directory = directory
+        self.state_path = os.path.join(directory, STATE_FILE)
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                self.state = json.load(f)
+        self.keys = {}
+        self.results = {}
+        self.timings = {}
+
+    def order(self, targets=None):
+        """Étapes nécessaires aux cibles (toutes par défaut), amont d'abord."""
+        ordered, visiting = [], set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(f"Dépendance circulaire autour de l'étape '{name}'.")
+            visiting.add(name)
+            for upstream in self.stages[name].inputs:
+                visit(upstream)
+            visiting.discard(name)
+            ordered.append(name)
+
+        for name in targets or self.stages:
+            if name not in self.stages:
+                raise ValueError(f"Étape inconnue : '{name}'.")
+            visit(name)
+        return ordered
+
+    def key(self, name):
+        """Clé de l'étape name, calculée une fois par exécution."""
+        if name not in self.keys:
+            stage = self.stages[name]
+            summary = {
+                "sources": {path: file_hash(path) for path in stage.sources},
+                "contexte": reference_context(
+                    stage.parameters,
+                    stage.tables,
+                    self.storage,
+                ),
+                "amont": [self.key(upstream) for upstream in stage.inputs],
+            }
+            self.keys[name] = hashlib.sha256(
+                json.dumps(summary, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+        return self.keys[name]
+
+    def run(self, targets=None, force=False):
+        """Exécute les étapes périmées nécessaires aux cibles.
+
+        Args:
+            targets (list, optional): Noms des étapes voulues (toutes par défaut) ;
+                leurs étapes amont sont exécutées au besoin.
+            force (bool, optional): Exécute toutes les étapes, même inchangées.
+
+        Returns:
+            dict: Durée (secondes) de chaque étape exécutée.
+        """
+        for name in self.order(targets):
+            if not force and self.is_current(name):
+                print(f"Étape '{name}' inchangée, ignorée.")
+                continue
+            self.execute(name)
+        return self.timings
+
+    def is_current(self, name):
+        stage = self.stages[name]
+        if self.state.get(name) != self.key(name):
+            return False
+        if stage.output_file is not None:
+            return os.path.exists(stage.output_file)
+        return feather is not None and os.path.exists(self.snapshot_path(name))
+
+    def result(self, name):
+        """Résultat de l'étape name : en mémoire, relu ou recalculé au besoin."""
+        if name not in self.results:
+            if self.is_current(name) and self.stages[name].output_file is None:
+                self.results[name] = feather.read_feather(self.snapshot_path(name))
+            else:
+                self.execute(name)
+        return self.results[name]
+
+    def execute(self, name):
+        stage = self.stages[name]
+        inputs = [self.result(upstream) for upstream in stage.inputs]
+        started = time.perf_counter()
+        with measure_stage(name):
+            result = stage.run(*inputs)
+        self.timings[name] = time.perf_counter() - started
+        print(f"Étape '{name}' exécutée en {self.timings[name]:.2f} s.")
+
+        self.results[name] = result
+        if stage.output_file is None and not self.save_snapshot(name, result):
+            # Without a snapshot the stage could not be skipped next time
+            return
+        self.state[name] = self.key(name)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def snapshot_path(self, name):
+        return os.path.join(self.directory, f"{name}.feather")
+
+    def save_snapshot(self, name, df):
+        """Conserve le DataFrame d'une étape ; renvoie False si c'est impossible."""
+        if feather is None:
+            return False
+        path = self.snapshot_path(name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename, so a reader never maps a half-written snapshot
+            feather.write_feather(df.reset_index(drop=True), path + ".tmp")
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"Instantané de l'étape '{name}' non enregistré : {e}")
+            for stale in (path + ".tmp", path):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            self.state.pop(name, None)
+            return False
+        return True
+
+
+def enrichment_stages(storage, ecrire_tables=ECRIRE_TABLES):
+    """Étapes de 01.py, 02.py et 03.py, puis des rapports Excel.
+
+    Les dépendances réelles sont clients -> 01 -> 03 et clients -> 02 : 02.py
+    ne lit que la table d'entrée. Avec ecrire_tables, les tables
+    01eg_insee_iris, 02eg_age_sexe et 03enriched_clients_with_references sont
+    aussi écrites dans le stockage, comme par les scripts.
+    """
+    insee_iris = importlib.import_module("01")
+    age_sexe = importlib.import_module("02")
+    references = importlib.import_module("03")
+    similarite = config.getfloat("enrichissement", "similarite", fallback=0) or None
+    workers = config.getint("enrichissement", "workers", fallback=1)
+
+    parametres_01 = {
+        "top_tnp": 0,
+        "cp": "cp",
+        "ville": "ville",
+        "id_client": "id_client",
+        "lieu_dit": "lieu_dit",
+        "civilite": "civilit_",
+        "nom": "nom",
+        "prenom": "prenom",
+        "seuil_similarite": similarite,
+    }
+    parametres_02 = {
+        "prenom": "prenom",
+        "sexe": "sexe",
+        "age_declare": "NA",
+        "codgeo": "codegeo",
+        "top_estim_sexe": 1,
+        "ajust": 0,
+        "var_ajust": "NA",
+    }
+
+    def lire_table(table_name):
+        return lambda: storage.read_table(table_name)
+
+    def exporter(df, table_name):
+        # The columnar copy is written from the DataFrame, never read back
+        if EXPORT_FORMAT:
+            export_table(storage, table_name, df=df)
+        return df
+
+    def eg_insee_iris(clients):
+        enriched_df = insee_iris.EG_Insee_Iris(
+            clients, workers=workers, enregistrer=ecrire_tables, **parametres_01
+        )
+        return exporter(enriched_df, "01eg_insee_iris")
+
+    def eg_age_sexe(clients):
+        # EG_age_sexe adds its columns to the DataFrame it is given
+        resultat = age_sexe.EG_age_sexe(
+            clients.copy(), workers=workers, enregistrer=ecrire_tables, **parametres_02
+        )
+        return exporter(resultat, "02eg_age_sexe")
+
+    def enrichir_references(enriched_clients, maj_reference):
+        merged_df = references.enrichir_references(enriched_clients, maj_reference)
+        if ecrire_tables:
+            storage.write_table(merged_df, references.new_table_name)
+        return exporter(merged_df, references.new_table_name)
+
+    def rapport(name, upstream):
+        return Stage(
+            name,
+            lambda df: build_report(name, df),
+            inputs=[upstream],
+            sources=["reports.py", "excelreport.py", "aggregates.py"],
+            # The [rapports] settings change the content of the workbook
+            parameters=report_settings(),
+            output_file=REPORTS[name]["output_file"],
+        )
+
+    return [
+        Stage(
+            "clients",
+            lire_table("true_table_entree"),
+            sources=READ_SOURCES,
+            tables=["true_table_entree"],
+        ),
+        Stage(
+            "maj_2014_references",
+            lire_table("maj_2014_references"),
+            sources=READ_SOURCES,
+            tables=["maj_2014_references"],
+        ),
+        Stage(
+            "01",
+            eg_insee_iris,
+            inputs=["clients"],
+            sources=["01.py", "matching.py", "parallel.py", *READ_SOURCES],
+            tables=["refcp", "ref_iris_geo2024"],
+            parameters={
+                **parametres_01,
+                "ecrire_tables": ecrire_tables,
+                "export": EXPORT_FORMAT,
+            },
+        ),
+        Stage(
+            "02",
+            eg_age_sexe,
+            inputs=["clients"],
+            sources=["02.py", "prenoms.py", "parallel.py", *READ_SOURCES],
+            tables=["tbrefgeo", PROFILE_TABLE, "table_prenoms"],
+            parameters={
+                **parametres_02,
+                "ecrire_tables": ecrire_tables,
+                "export": EXPORT_FORMAT,
+            },
+        ),
+        Stage(
+            "03",
+            enrichir_references,
+            inputs=["01", "maj_2014_references"],
+            sources=["03.py", "schema.py"],
+            parameters={"ecrire_tables": ecrire_tables, "export": EXPORT_FORMAT},
+        ),
+        rapport("01graph", "01"),
+        rapport("02graph", "02"),
+        rapport("03graph", "03"),
+    ]
+
+
+# Exemple d'utilisation
+if __name__ == "__main__":
+    # Stockage des tables (section [database] de config.ini)
+    storage = open_storage()
+
+    pipeline = Pipeline(enrichment_stages(storage), storage)
+    timings = pipeline.run()
+    print(f"Pipeline terminé en {sum(timings.values()):.2f} s.")
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+from unidecode import unidecode
+
+# Name of the precomputed table built by initfiles.py
+PROFILE_TABLE = "profil_prenoms"
+
+# Years covered by the birth-count columns of table_prenoms (n1913 ... n2014)
+YEARS = range(1913, 2015)
+
+
+# Function to normalize a first name the way clients are matched
+def normalize_first_name(prenom):
+    return unidecode(str(prenom)).lower()
+
+
+def build_first_name_profile(tb_prenoms):
+    """Construit le profil compact des prénoms à partir de table_prenoms.
+
+    Une ligne par prénom normalisé, avec de quoi retrouver l'âge moyen
+    (nombre et somme des années où le prénom a été donné) et la répartition
+    par sexe des naissances lorsque la table contient une colonne 'sexe'.
+
+    Args:
+        tb_prenoms (pd.DataFrame): Table des prénoms (colonnes prenom, n1913 ... n2014).
+
+    Returns:
+        pd.DataFrame: Profil indexable par 'prenom_normalise'.
+    """
+    year_columns = [f"n{year}" for year in YEARS if f"n{year}" in tb_prenoms.columns]
+    years = np.array([int(col[1:]) for col in year_columns])
+    # Birth counts fit exactly in float32, half the size of float64
+    counts = tb_prenoms[year_columns].to_numpy(dtype=np.float32, na_value=np.nan)
+    given = counts > 0
+    names = tb_prenoms["prenom"].map(normalize_first_name).to_numpy()
+
+    profile = pd.DataFrame(
+        {
+            "prenom_normalise": names,
+            "nb_annees": given.sum(axis=1),
+            "somme_annees": (given * years).sum(axis=1),
+        }
+    )
+
+    # The age estimate keeps the first matching row, as the row-by-row lookup did
+    profile = profile.drop_duplicates("prenom_normalise").set_index("prenom_normalise")
+
+    # Sex split over every row of the name, when the table tells the sex apart
+    if "sexe" in tb_prenoms.columns:
+        births = pd.DataFrame(
+            {
+                "prenom_normalise": names,
+                "sexe": tb_prenoms["sexe"].astype(str).str.upper().values,
+                "naissances": np.nansum(counts, axis=1, dtype=np.float64),
+            }
+        )
+        births["feminin"] = births["sexe"].isin(["F", "2"])
+        total = births.groupby("prenom_normalise")["naissances"].sum()
+        feminin = (
+            births[births["feminin"]].groupby("prenom_normalise")["naissances"].sum()
+        )
+        profile["part_f"] = (feminin.reindex(total.index, fill_value=0) / total).reindex(
+            profile.index
+        )
+    else:
+        profile["part_f"] = np.nan
+
+    return profile.reset_index()
+
+
+def load_first_name_profile(storage):
+    """Charge le profil des prénoms, en le construisant si initfiles.py ne l'a pas fait."""
+    if storage.has_table(PROFILE_TABLE):
+        profile = storage.read_table(PROFILE_TABLE)
+        profile = profile.drop(columns=["id"], errors="ignore")
+    else:
+        profile = build_first_name_profile(storage.read_table("table_prenoms"))
+
+    return profile.set_index("prenom_normalise")
+
+
+def lookup_first_names(profile, prenoms, current_year):
+    """Renvoie l'âge moyen et la part de naissances féminines pour chaque prénom.
+
+    Args:
+        profile (pd.DataFrame): Profil indexé par 'prenom_normalise'.
+        prenoms (pd.Series): Prénoms des clients.
+        current_year (int): Année de référence pour le calcul de l'âge.
+
+    Returns:
+        pd.DataFrame: Colonnes 'age_prenom' et 'part_f', alignées sur prenoms.
+    """
+    codes, uniques = pd.factorize(prenoms)
+    # Plain values, whether the first names are strings or categories
+    keys = pd.Index(np.asarray(uniques, dtype=object)).map(normalize_first_name)
+    matched = profile.reindex(keys)
+
+    nb_annees = matched["nb_annees"].to_numpy(dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        somme_annees = matched["somme_annees"].to_numpy(dtype=float)
+        age = (nb_annees * current_year - somme_annees) / nb_annees
+    age[~(nb_annees > 0)] = np.nan
+    part_f = matched["part_f"].to_numpy(dtype=float)
+
+    # Values missing from the factorization (NaN first names) map to code -1
+    age = np.append(age, np.nan)[codes]
+    part_f = np.append(part_f, np.nan)[codes]
+
+    return pd.DataFrame({"age_prenom": age, "part_f": part_f}, index=prenoms.index)
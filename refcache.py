@@ -0,0 +1,124 @@
+import json
+import os
+import tempfile
+import pandas as pd
+from sqlalchemy import text
+import configparser
+from matching import normalize_series
+
+try:
+    import pyarrow.feather as feather
+except ImportError:  # Snapshots are disabled without pyarrow
+    feather = None
+
+# Load configuration
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+CACHE_DIRECTORY = config.get("cache", "directory", fallback=".refcache")
+
+# Only the large, slowly changing reference tables are snapshotted: client data
+# and script outputs are read straight from the database and never land on disk
+REFERENCE_TABLES = {
+    "refcp",
+    "ref_iris_geo2024",
+    "tbrefgeo",
+    "maj_2014_references",
+    "table_prenoms",
+    "profil_prenoms",
+}
+
+
+# Columns computed once when a snapshot is built, keyed by table name
+def _add_refcp_columns(df):
+    df["nom_de_la_commune_normalized"] = normalize_series(df["nom_de_la_commune"])
+    return df
+
+
+def _add_ref_iris_columns(df):
+    df["lib_iris_normalized"] = normalize_series(df["lib_iris"])
+    return df
+
+
+DERIVED_COLUMNS = {
+    "refcp": _add_refcp_columns,
+    "ref_iris_geo2024": _add_ref_iris_columns,
+}
+
+
+def table_signature(table_name, engine):
+    """Renvoie le nombre de lignes et le checksum MySQL d'une table."""
+    with engine.connect() as connection:
+        rows = connection.execute(
+            text(f"SELECT COUNT(*) FROM `{table_name}`")
+        ).scalar()
+        try:
+            checksum = connection.execute(
+                text(f"CHECKSUM TABLE `{table_name}`")
+            ).fetchone()[1]
+        except Exception:
+            # Backends without CHECKSUM TABLE only invalidate on the row count
+            checksum = None
+    return {"rows": int(rows), "checksum": None if checksum is None else str(checksum)}
+
+
+def read_reference_table(table_name, engine):
+    """Lit une table de référence via un instantané local Feather.
+
+    L'instantané (avec les colonnes normalisées déjà calculées) est relu en
+    mémoire mappée tant que le nombre de lignes et le checksum de la table
+    MySQL n'ont pas changé ; sinon la table est relue puis l'instantané réécrit.
+    Les tables absentes de REFERENCE_TABLES sont lues directement dans la base.
+
+    Args:
+        table_name (str): Nom de la table dans la base.
+        engine (sqlalchemy.Engine): Connexion à la base de données.
+
+    Returns:
+        pd.DataFrame: Contenu de la table, avec ses colonnes dérivées.
+    """
+    snapshot_path = os.path.join(CACHE_DIRECTORY, f"{table_name}.feather")
+    signature_path = os.path.join(CACHE_DIRECTORY, f"{table_name}.json")
+
+    if feather is None or table_name not in REFERENCE_TABLES:
+        return _load_from_database(table_name, engine)
+
+    signature = table_signature(table_name, engine)
+    if os.path.exists(snapshot_path) and os.path.exists(signature_path):
+        with open(signature_path, "r") as f:
+            if json.load(f) == signature:
+                return feather.read_table(snapshot_path, memory_map=True).to_pandas()
+
+    df = _load_from_database(table_name, engine)
+
+    temporary_path = None
+    try:
+        os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+        # Write to a name unique to this process then rename, so a reader never
+        # maps a half-written snapshot and concurrent writers do not collide
+        with tempfile.NamedTemporaryFile(
+            dir=CACHE_DIRECTORY, prefix=f"{table_name}.", suffix=".tmp", delete=False
+        ) as f:
+            temporary_path = f.name
+        feather.write_feather(df, temporary_path)
+        os.replace(temporary_path, snapshot_path)
+        with open(signature_path, "w") as f:
+            json.dump(signature, f)
+    except Exception as e:
+        print(f"Instantané de '{table_name}' non enregistré : {e}")
+        for path in (temporary_path, snapshot_path, signature_path):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    return df
+
+
+def add_derived_columns(table_name, df):
+    """Ajoute à df les colonnes normalisées calculées pour table_name."""
+    if table_name in DERIVED_COLUMNS:
+        df = DERIVED_COLUMNS[table_name](df)
+    return df
+
+
+def _load_from_database(table_name, engine):
+    return add_derived_columns(table_name, pd.read_sql_table(table_name, con=engine))
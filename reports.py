@@ -0,0 +1,467 @@
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+import configparser
+from aggregates import as_aggregates, table_aggregates
+from excelreport import ReportWriter, top_categories
+from instrumentation import stage, step
+from storage import open_storage
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+# Workbooks built at the same time, each in its own process
+WORKERS = config.getint("rapports", "workers", fallback=3)
+
+# Civilities of men, any other civility being counted as a woman
+CIVILITES_HOMME = ["M", "Mr", "Monsieur"]
+
+
+def sexe(civilite):
+    """Sexe (Homme ou Femme) correspondant à chaque civilité."""
+    return civilite.isin(CIVILITES_HOMME).map({True: "Homme", False: "Femme"})
+
+
+def gender_colors(y_cols):
+    return ["blue" if y_col == "Homme" else "pink" for y_col in y_cols]
+
+
+def random_colors(y_cols):
+    return [random.choice(["blue", "pink", "black", "red", "green"]) for _ in y_cols]
+
+
+# Workbooks, each built from one table. A sheet charts one aggregation of the
+# table, named by "aggregate":
+# counts: clients of each value of by[0], most frequent first
+# shares: share of the clients of each value of by[0], largest first
+# crosstab: clients of each value of by[0] (rows) and by[1] (columns)
+# means: mean of indicator for each value of by[0], with top_categories
+#   weighted by the clients of each value
+# sums: sum of each column of indicators
+# "columns" renames the columns of the aggregation, "top" groups the
+# categories beyond [rapports] categories into one bar, "detail" lists the
+# client columns written with the sheet. Columns of "derived" are computed
+# from a column of the table, aggregated first: counts by civility, then
+# summed by sex. The other keys are those of ReportWriter.add_chart_sheet,
+# the report level giving their default.
+REPORTS = {
+    "01graph": {
+        "table": "01eg_insee_iris",
+        "output_file": "01enriched_clients_with_charts.xlsx",
+        "derived": {"sexe": ("civilit_", sexe)},
+        "colors": gender_colors,
+        "y_axis": {"name": "Counts"},
+        "sheets": [
+            {
+                "name": "Stats de Sexe",
+                "aggregate": "counts",
+                "by": ["civilit_"],
+                "columns": ["civilit_", "Counts"],
+                "x_col": "civilit_",
+                "y_cols": ["Counts"],
+                "detail": ["civilit_", "nom", "prenom"],
+            },
+            {
+                "name": "Stats de Ville",
+                "aggregate": "counts",
+                "by": ["ville"],
+                "columns": ["Ville", "Counts"],
+                "top": True,
+                "x_col": "Ville",
+                "y_cols": ["Counts"],
+                "detail": ["ville", "nom", "prenom"],
+            },
+            {
+                "name": "Pourcentage Sexe",
+                "aggregate": "shares",
+                "by": ["sexe"],
+                "columns": ["Sexe", "Pourcentage"],
+                "x_col": "Sexe",
+                "y_cols": ["Pourcentage"],
+                "chart_type": "pie",
+                "detail": ["sexe"],
+            },
+            {
+                "name": "Sexe par Ville (Counts)",
+                "aggregate": "crosstab",
+                "by": ["ville", "sexe"],
+                "top": True,
+                "x_col": "ville",
+                "y_cols": ["Femme", "Homme"],
+                "detail": ["ville", "sexe"],
+            },
+            {
+                "name": "Stats par Code INSEE",
+                "aggregate": "counts",
+                "by": ["c_insee"],
+                "columns": ["Code INSEE", "Counts"],
+                "top": True,
+                "x_col": "Code INSEE",
+                "y_cols": ["Counts"],
+                "detail": ["c_insee"],
+            },
+        ],
+    },
+    "02graph": {
+        "table": "02eg_age_sexe",
+        "output_file": "02enriched_clients_with_charts.xlsx",
+        "sheets": [
+            {
+                "name": "Année de Naissance",
+                "aggregate": "means",
+                "by": ["prenom"],
+                "indicator": "e_annee_naissance",
+                "columns": ["prenom", "Année Moyenne de Naissance"],
+                "top": True,
+                "x_col": "prenom",
+                "y_cols": ["Année Moyenne de Naissance"],
+                "detail": ["prenom", "e_annee_naissance"],
+            },
+        ],
+    },
+    "03graph": {
+        "table": "03enriched_clients_with_references",
+        "output_file": "03enriched_clients_with_charts.xlsx",
+        "colors": random_colors,
+        "sheets": [
+            {
+                "name": "Moyenne Revenu par Ville",
+                "aggregate": "means",
+                "by": ["ville"],
+                "indicator": "rev",
+                "columns": ["ville", "Moyenne Revenu"],
+                "top": True,
+                "x_col": "Ville",
+                "y_cols": ["Moyenne Revenu"],
+                "detail": ["ville", "rev"],
+            },
+            {
+                "name": "Répartition Type Logement",
+                "aggregate": "sums",
+                "indicators": ["propr", "locat", "locat_hlm"],
+                "columns": ["Type Logement", "Counts"],
+                "x_col": "Type Logement",
+                "y_cols": ["Counts"],
+                "chart_type": "bar",
+                "detail": ["propr", "locat", "locat_hlm"],
+            },
+            {
+                "name": "Qualité Logement par Commune",
+                "aggregate": "means",
+                "by": ["nom_de_la_commune"],
+                "indicator": "c_indice_qualite_logement",
+                "columns": ["nom_de_la_commune", "Qualité Logement Moyenne"],
+                "top": True,
+                "x_col": "Commune",
+                "y_cols": ["Qualité Logement Moyenne"],
+                "detail": ["nom_de_la_commune", "c_indice_qualite_logement"],
+            },
+            {
+                "name": "Répartition Niveau Éducation",
+                "aggregate": "sums",
+                "indicators": ["et_niv0", "et_niv1", "et_niv2"],
+                "columns": ["Niveau Éducation", "Counts"],
+                "x_col": "Niveau Éducation",
+                "y_cols": ["Counts"],
+                "detail": ["et_niv0", "et_niv1", "et_niv2"],
+            },
+            {
+                "name": "Familles Monoparentales",
+                "aggregate": "means",
+                "by": ["nom_de_la_commune"],
+                "indicator": "tx_fammono",
+                "columns": ["nom_de_la_commune", "Taux Familles Monoparentales"],
+                "top": True,
+                "x_col": "Commune",
+                "y_cols": ["Taux Familles Monoparentales"],
+                "detail": ["nom_de_la_commune", "tx_fammono"],
+            },
+            {
+                "name": "Répartition Type Couple",
+                "aggregate": "sums",
+                "indicators": ["tx_coupsenf", "tx_coupaenf"],
+                "columns": ["Type Couple", "Counts"],
+                "x_col": "Type Couple",
+                "y_cols": ["Counts"],
+                "chart_type": "bar",
+                "detail": ["tx_coupsenf", "tx_coupaenf"],
+            },
+            {
+                "name": "Qualité Revenu par Ville",
+                "aggregate": "means",
+                "by": ["ville"],
+                "indicator": "c_indice_qualite_rev",
+                "columns": ["ville", "Qualité Revenu Moyenne"],
+                "top": True,
+                "x_col": "Ville",
+                "y_cols": ["Qualité Revenu Moyenne"],
+                "detail": ["ville", "c_indice_qualite_rev"],
+            },
+        ],
+    },
+}
+
+# Options of ReportWriter.add_chart_sheet that a report may set for its sheets
+CHART_OPTIONS = ("chart_type", "colors", "y_axis", "plotarea")
+
+
+class ReportData:
+    """Agrégations d'une table, partagées entre les feuilles d'un rapport.
+
+    Les besoins de toutes les feuilles sont connus d'avance : chaque
+    regroupement n'est calculé qu'une fois, au plus fin demandé, et les
+    regroupements plus grossiers en sont déduits (les effectifs par ville
+    de ceux par ville et civilité). Les moyennes d'une même catégorie, les
+    sommes et les lignes de détail sont lues chacune en une fois.
+
+    Args:
+        source (Aggregates): Agrégations de la table.
+        sheets (list): Feuilles du rapport (voir REPORTS).
+        derived (dict): Colonnes dérivées : nom -> (colonne de la table, fonction).
+        detail_limit (int): Lignes de détail lues (None : toutes, 0 : aucune).
+    """
+
+    def __init__(self, source, sheets, derived, detail_limit):
+        self.source = source
+        self.derived = derived
+        self.detail_limit = detail_limit
+        # Largest groupings first: a grouping they contain is summed from them
+        self.groupings = sorted(
+            {
+                tuple(dict.fromkeys(self._table_columns(sheet["by"])))
+                for sheet in sheets
+                if sheet["aggregate"] in COUNT_AGGREGATES
+            },
+            key=len,
+            reverse=True,
+        )
+        self.indicators = {}
+        for sheet in sheets:
+            if sheet["aggregate"] == "means":
+                indicators = self.indicators.setdefault(sheet["by"][0], [])
+                if sheet["indicator"] not in indicators:
+                    indicators.append(sheet["indicator"])
+        self.summed = list(
+            dict.fromkeys(
+                col
+                for sheet in sheets
+                if sheet["aggregate"] == "sums"
+                for col in sheet["indicators"]
+            )
+        )
+        self.detailed = list(
+            dict.fromkeys(
+                self._table_columns(
+                    col for sheet in sheets for col in sheet.get("detail", [])
+                )
+            )
+        )
+        self._counts = {}
+        self._means = {}
+        self._sums = None
+        self._rows = None
+
+    def counts(self, by):
+        """Nombre de clients de chaque combinaison des valeurs de by."""
+        columns = list(dict.fromkeys(self._table_columns(by)))
+        # The finest grouping is read first; the others are summed from it
+        grouping = next(g for g in self.groupings if set(columns) <= set(g))
+        if grouping not in self._counts:
+            self._counts[grouping] = self.source.counts(list(grouping))
+        counts = self._counts[grouping]
+        if list(grouping) != columns:
+            counts = self._regroup(counts, columns)
+        if not any(col in self.derived for col in by):
+            return counts
+        # Derived values are computed on the categories, then counted again
+        counts = counts.assign(
+            **{
+                col: self.derived[col][1](counts[self.derived[col][0]])
+                for col in by
+                if col in self.derived
+            }
+        )
+        return self._regroup(counts, by)
+
+    def means(self, category, indicator):
+        """Moyenne et nombre de valeurs de indicator par valeur de category."""
+        if category not in self._means:
+            self._means[category] = self.source.means(
+                category, self.indicators[category]
+            )
+        return self._means[category][indicator]
+
+    def sums(self, indicators):
+        if self._sums is None:
+            self._sums = self.source.sums(self.summed)
+        return self._sums[indicators]
+
+    def rows(self, columns, limit):
+        """Lignes de détail de columns, au plus limit (None : toutes)."""
+        if self._rows is None:
+            self._rows = self.source.rows(self.detailed, self.detail_limit)
+        rows = self._rows if limit is None else self._rows.iloc[:limit]
+        rows = rows[self._table_columns(columns)]
+        rows.columns = columns
+        for col in columns:
+            if col in self.derived:
+                rows = rows.assign(**{col: self.derived[col][1](rows[col])})
+        return rows
+
+    def _table_columns(self, columns):
+        return [
+            self.derived[col][0] if col in self.derived else col for col in columns
+        ]
+
+    @staticmethod
+    def _regroup(counts, columns):
+        counts = counts.groupby(columns, dropna=False, observed=True)["count"].sum()
+        return counts.reset_index()
+
+
+def _counts(data, sheet):
+    counts = data.counts(sheet["by"]).dropna(subset=sheet["by"])
+    # Ties are ordered by value, as by Aggregates.value_counts
+    counts = counts.sort_values(
+        "count", ascending=False, kind="stable", ignore_index=True
+    )
+    return counts, None
+
+
+def _shares(data, sheet):
+    counts, _ = _counts(data, sheet)
+    counts["count"] = counts["count"] / counts["count"].sum()
+    return counts, None
+
+
+def _crosstab(data, sheet):
+    counts = data.counts(sheet["by"]).dropna(subset=sheet["by"])
+    counts = counts.set_index(sheet["by"])["count"].unstack().fillna(0)
+    return counts.reset_index(), None
+
+
+def _means(data, sheet):
+    means = data.means(sheet["by"][0], sheet["indicator"])
+    # Other categories: mean of the indicator over their clients
+    return means["mean"].reset_index(), means["count"]
+
+
+def _sums(data, sheet):
+    return data.sums(sheet["indicators"]).reset_index(), None
+
+
+# Aggregation of each kind of sheet: graph data (categories first) and the
+# clients of each category when the others are averaged rather than summed
+AGGREGATES = {
+    "counts": _counts,
+    "shares": _shares,
+    "crosstab": _crosstab,
+    "means": _means,
+    "sums": _sums,
+}
+
+# Aggregations computed from the client counts of ReportData.counts
+COUNT_AGGREGATES = ("counts", "shares", "crosstab")
+
+
+def graph_data(data, sheet):
+    """Tableau agrégé d'une feuille : catégories, puis une colonne par série."""
+    graph_data, weights = AGGREGATES[sheet["aggregate"]](data, sheet)
+    if sheet.get("columns"):
+        graph_data.columns = sheet["columns"]
+    if sheet.get("top"):
+        graph_data = top_categories(graph_data, graph_data.columns[0], weights=weights)
+    return graph_data
+
+
+def build_report(name, source, output_file=None):
+    """Construit le classeur du rapport name de REPORTS.
+
+    Args:
+        name (str): Rapport de REPORTS (01graph, 02graph ou 03graph).
+        source (pd.DataFrame | Aggregates): Table du rapport, ou ses
+            agrégations calculées par le moteur de stockage.
+        output_file (str, optional): Fichier Excel produit ; par défaut, celui
+            du rapport.
+    """
+    with stage(name):
+        spec = REPORTS[name]
+        source = as_aggregates(source)
+        report = ReportWriter(output_file or spec["output_file"])
+        data = ReportData(
+            source, spec["sheets"], spec.get("derived", {}), report.detail_limit
+        )
+        for sheet in spec["sheets"]:
+            options = {
+                option: sheet.get(option, spec.get(option))
+                for option in CHART_OPTIONS
+                if option in sheet or option in spec
+            }
+            if callable(options.get("colors")):
+                options["colors"] = options["colors"](sheet["y_cols"])
+            detail = sheet.get("detail")
+            # Aggregations shared by several sheets count in the first of them
+            with step(f"feuille {sheet['name']}") as measured:
+                sheet_data = graph_data(data, sheet)
+                measured.rows_out = len(sheet_data)
+                report.add_chart_sheet(
+                    sheet["name"],
+                    sheet_data,
+                    sheet["x_col"],
+                    sheet["y_cols"],
+                    detail=(
+                        (lambda limit, columns=detail: data.rows(columns, limit))
+                        if detail
+                        else None
+                    ),
+                    detail_total=len(source),
+                    **options,
+                )
+        with step("fermeture"):
+            report.close()
+
+
+def _build_from_storage(name):
+    # Run in a process of its own: the storage is opened there, only to be read
+    storage = open_storage(read_only=True)
+    try:
+        build_report(name, table_aggregates(storage, REPORTS[name]["table"]))
+    finally:
+        storage.close()
+    return name
+
+
+def build_reports(names=None, workers=WORKERS):
+    """Construit les classeurs des rapports names à partir de leurs tables.
+
+    Les classeurs sont indépendants : avec workers > 1, chacun est construit
+    dans son propre processus, qui ouvre son propre accès au stockage.
+
+    Args:
+        names (list, optional): Rapports de REPORTS ; par défaut, tous.
+        workers (int, optional): Nombre de processus.
+    """
+    names = list(REPORTS) if names is None else names
+    unknown = [name for name in names if name not in REPORTS]
+    if unknown:
+        raise ValueError(
+            f"Rapport inconnu : {', '.join(unknown)} ({', '.join(REPORTS)})."
+        )
+    with (
+        ProcessPoolExecutor(max_workers=workers)
+        if workers > 1 and len(names) > 1
+        else nullcontext()
+    ) as executor:
+        if executor is None:
+            for name in names:
+                _build_from_storage(name)
+            return
+        for future in [executor.submit(_build_from_storage, name) for name in names]:
+            future.result()
+
+
+if __name__ == "__main__":
+    # Reports named on the command line (01graph, 02graph, 03graph), or all
+    build_reports(sys.argv[1:] or None)
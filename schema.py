@@ -0,0 +1,513 @@
+import numpy as np
+import pandas as pd
+
+# Columns indexed once a table is loaded, keyed by table name. Lookups and
+# joins of the enrichment stages go through these keys
+INDEX_SPEC = {
+    "refcp": ["code_postal", "code_commune_insee"],
+    "ref_iris_geo2024": ["depcom", "code_iris"],
+    "tbrefgeo": ["codgeo"],
+    "maj_2014_references": ["codgeo"],
+    "insee_2014": ["codgeo"],
+    "dep_2014": ["codgeo"],
+    "typo_commerces": ["codgeo"],
+    "typo_logements": ["codgeo"],
+    "table_prenoms": ["prenom"],
+    "profil_prenoms": ["prenom_normalise"],
+    "01eg_insee_iris": ["codgeo", "c_insee", "code_postal"],
+    "02eg_age_sexe": ["codgeo"],
+    "03enriched_clients_with_references": ["codgeo"],
+}
+
+# Primary key of the tables written by the enrichment stages and of the
+# fingerprint tables of their incremental mode
+PRIMARY_KEYS = {
+    "01eg_insee_iris": "id_client",
+    "02eg_age_sexe": "id_client",
+    "03enriched_clients_with_references": "id_client",
+    "01eg_insee_iris_empreintes": "id_client",
+    "02eg_age_sexe_empreintes": "id_client",
+}
+
+# Types of the columns computed by the enrichment stages; the other columns
+# get the most compact type holding their values
+CODE_OUTPUT_TYPES = {
+    "code_postal": "CHAR(5)",
+    "code_commune_insee": "CHAR(5)",
+    "c_insee": "CHAR(5)",
+    "depcom": "CHAR(5)",
+    "code_iris": "CHAR(9)",
+    "c_iris": "CHAR(4)",
+    "c_qualite_iris": "TINYINT UNSIGNED",
+    "codgeo": "VARCHAR(9)",
+}
+OUTPUT_TYPES = {
+    "01eg_insee_iris": CODE_OUTPUT_TYPES,
+    "02eg_age_sexe": {
+        "e_top_age_ok": "TINYINT UNSIGNED",
+        "e_annee_naissance": "SMALLINT",
+        "indice_conf_age": "VARCHAR(12)",
+    },
+    "03enriched_clients_with_references": CODE_OUTPUT_TYPES,
+}
+
+# Smallest integer types, as (type, signed maximum)
+INTEGER_TYPES = [
+    ("TINYINT", 127),
+    ("SMALLINT", 32767),
+    ("MEDIUMINT", 8388607),
+    ("INT", 2147483647),
+    ("BIGINT", 9223372036854775807),
+]
+
+# Longest VARCHAR kept inline; longer strings are stored as TEXT
+VARCHAR_MAX_LENGTH = 16383
+
+# Prefix length indexed on TEXT columns (pandas writes strings as TEXT)
+TEXT_KEY_LENGTH = 255
+
+TEXT_TYPES = {"tinytext", "text", "mediumtext", "longtext", "blob"}
+
+# Collation of the normalized name columns, insensitive to case and accents
+NORMALIZED_COLLATION = "utf8mb4_0900_ai_ci"
+
+# Normalized name columns computed by MySQL, as (column, source column, lookup
+# key); refcache.py recomputes the same columns in Python for the pandas mode
+NORMALIZED_COLUMNS = {
+    "refcp": [("nom_de_la_commune_normalized", "nom_de_la_commune", "code_postal")],
+    "ref_iris_geo2024": [("lib_iris_normalized", "lib_iris", "depcom")],
+}
+
+# Code and label columns held as categories in memory, in the client and in
+# the reference frames: a row stores a small integer code instead of its
+# string, and the merges on these keys join the codes (align_categories)
+CATEGORY_COLUMNS = [
+    "cp",
+    "code_postal",
+    "code_commune_insee",
+    "c_insee",
+    "depcom",
+    "code_iris",
+    "c_iris",
+    "codgeo",
+    "codegeo",
+    "dep",
+    "reg",
+    "typ_iris",
+    "ville",
+    "nom_de_la_commune",
+    "libelle_d_acheminement",
+    "lib_iris",
+    "libcom",
+    "civilit_",
+    "sexe",
+    "e_sexe",
+    "indice_conf_age",
+    "pays",
+]
+
+# Other text columns become categories when at most this share of their
+# values are distinct; names and identifiers stay strings
+CATEGORY_RATIO = 0.5
+
+# Rows looked at before counting the distinct values of a whole column: when
+# they are all distinct, the column holds identifiers and stays text
+SAMPLE_ROWS = 10000
+
+
+def integer_sql_type(minimum, maximum):
+    """Plus petit type entier MySQL contenant [minimum, maximum], ou None."""
+    unsigned = minimum >= 0
+    for sql_type, largest in INTEGER_TYPES:
+        if unsigned and maximum <= 2 * largest + 1:
+            return f"{sql_type} UNSIGNED"
+        if not unsigned and -largest - 1 <= minimum and maximum <= largest:
+            return sql_type
+    return None
+
+
+def string_sql_type(max_len):
+    """Type MySQL d'une chaîne d'au plus max_len caractères."""
+    if max_len > VARCHAR_MAX_LENGTH:
+        return "TEXT"
+    return f"VARCHAR({max(max_len, 1)})"
+
+
+def column_summary(series):
+    """Résume une colonne typée : sa nature et l'étendue de ses valeurs.
+
+    summary_sql_type en déduit le type de la colonne, et widened_sql_type
+    vérifie qu'une colonne existante peut recevoir ces valeurs.
+    """
+    values = series.dropna()
+    if values.empty:
+        return {"kind": None}
+    if pd.api.types.is_bool_dtype(values):
+        return {"kind": "int", "min": 0, "max": 1}
+    if pd.api.types.is_integer_dtype(values):
+        return {"kind": "int", "min": int(values.min()), "max": int(values.max())}
+    if pd.api.types.is_float_dtype(values):
+        return {"kind": "float", "single": values.dtype == np.float32}
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return {"kind": "datetime"}
+    return {"kind": "str", "max_len": int(values.astype(str).str.len().max())}
+
+
+def summary_sql_type(summary):
+    """Type MySQL le plus compact contenant les valeurs résumées."""
+    kind = summary["kind"]
+    if kind is None:
+        return "VARCHAR(255)"
+    if kind == "int":
+        return integer_sql_type(summary["min"], summary["max"]) or "DOUBLE"
+    if kind == "float":
+        return "FLOAT" if summary["single"] else "DOUBLE"
+    if kind == "datetime":
+        return "DATETIME(6)"
+    return string_sql_type(summary["max_len"])
+
+
+def _integer_range(base, unsigned):
+    for sql_type, largest in INTEGER_TYPES:
+        if sql_type.lower() == base:
+            return (0, 2 * largest + 1) if unsigned else (-largest - 1, largest)
+    return None
+
+
+def widened_sql_type(column_type, summary):
+    """Type à donner à une colonne pour qu'elle reçoive les valeurs résumées.
+
+    Args:
+        column_type (str): Type actuel (colonne COLUMN_TYPE d'information_schema).
+        summary (dict): Résumé renvoyé par column_summary.
+
+    Returns:
+        str | None: Nouveau type, ou None si le type actuel convient.
+    """
+    kind = summary["kind"]
+    if kind is None:
+        return None
+    column_type = column_type.lower()
+    base = column_type.split("(")[0].split()[0]
+    length = None
+    if base in ("char", "varchar"):
+        length = int(column_type.split("(")[1].split(")")[0])
+    integer_range = _integer_range(base, "unsigned" in column_type)
+
+    if kind == "str":
+        if base in TEXT_TYPES or (length is not None and summary["max_len"] <= length):
+            return None
+        # Numbers and dates already stored stay readable once turned into text
+        existing = length if length is not None else 26
+        return string_sql_type(max(summary["max_len"], existing))
+
+    # Width of the longest value once written as text
+    text_length = {"int": 20, "float": 24, "datetime": 26}[kind]
+    if kind == "int":
+        text_length = max(len(str(summary["min"])), len(str(summary["max"])))
+
+    if base in TEXT_TYPES or (length is not None and text_length <= length):
+        return None
+    if length is not None:
+        return string_sql_type(text_length)
+
+    if kind == "int":
+        if integer_range is None:
+            return None if base in ("float", "double", "decimal") else "DOUBLE"
+        low, high = integer_range
+        if low <= summary["min"] and summary["max"] <= high:
+            return None
+        return (
+            integer_sql_type(min(low, summary["min"]), max(high, summary["max"]))
+            or "DOUBLE"
+        )
+    if kind == "float":
+        if base == "double" or (base == "float" and summary["single"]):
+            return None
+        return "DOUBLE"
+    if base in ("datetime", "timestamp"):
+        return None
+    return string_sql_type(text_length)
+
+
+def widen_columns(table_name, df, connection):
+    """Élargit les colonnes de table_name trop étroites pour les valeurs de df.
+
+    Args:
+        table_name (str): Nom de la table.
+        df (pd.DataFrame): Lignes sur le point d'être insérées.
+        connection: Connexion DB-API à la base.
+
+    Returns:
+        dict: Nouveaux types des colonnes élargies.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        """
+        SELECT column_name, column_type
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s
+        """,
+        (table_name,),
+    )
+    column_types = {
+        column.lower(): column_type for column, column_type in cursor.fetchall()
+    }
+
+    widened = {}
+    for column in df.columns:
+        if column.lower() not in column_types:
+            continue
+        sql_type = widened_sql_type(
+            column_types[column.lower()], column_summary(df[column])
+        )
+        if sql_type is not None:
+            widened[column] = sql_type
+
+    if widened:
+        clauses = [
+            f"MODIFY `{column}` {sql_type}" for column, sql_type in widened.items()
+        ]
+        cursor.execute(f"ALTER TABLE `{table_name}` {', '.join(clauses)}")
+    connection.commit()
+    cursor.close()
+    return widened
+
+
+def _key_part(column, data_type):
+    if data_type in TEXT_TYPES:
+        return f"`{column}`({TEXT_KEY_LENGTH})"
+    return f"`{column}`"
+
+
+def _column_types(cursor, table_name):
+    cursor.execute(
+        """
+        SELECT column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s
+        """,
+        (table_name,),
+    )
+    return {
+        column.lower(): data_type.lower() for column, data_type in cursor.fetchall()
+    }
+
+
+def normalized_sql(expression):
+    """Expression SQL d'un libellé normalisé comme matching.normalize_text.
+
+    Les tirets deviennent des espaces ; la casse et les accents sont ignorés
+    par la collation lors des comparaisons.
+    """
+    return f"REPLACE({expression}, '-', ' ') COLLATE {NORMALIZED_COLLATION}"
+
+
+def add_normalized_columns(table_name, connection):
+    """Ajoute à une table de référence ses colonnes de libellés normalisés.
+
+    Les colonnes sont générées et stockées par MySQL, puis indexées avec leur
+    clé de recherche (code postal ou commune). Les colonnes déjà présentes
+    sont laissées telles quelles.
+
+    Args:
+        table_name (str): Nom de la table.
+        connection: Connexion DB-API à la base.
+
+    Returns:
+        list: Colonnes ajoutées.
+    """
+    cursor = connection.cursor()
+    data_types = _column_types(cursor, table_name)
+
+    clauses = []
+    added = []
+    for column, source, key in NORMALIZED_COLUMNS.get(table_name, []):
+        if column in data_types or source not in data_types:
+            continue
+        clauses.append(
+            f"ADD COLUMN `{column}` VARCHAR(255) COLLATE {NORMALIZED_COLLATION} "
+            f"AS ({normalized_sql(f'`{source}`')}) STORED"
+        )
+        if key in data_types:
+            key_part = _key_part(key, data_types[key])
+            clauses.append(f"ADD INDEX idx_{column} ({key_part}, `{column}`)")
+        added.append(column)
+
+    if clauses:
+        cursor.execute(f"ALTER TABLE `{table_name}` {', '.join(clauses)}")
+    connection.commit()
+    cursor.close()
+    return added
+
+
+def create_indexes(table_name, connection, spec_name=None):
+    """Crée les index de la spécification sur une table déjà chargée.
+
+    Les index sont ajoutés en une seule instruction ALTER TABLE après le
+    chargement, pour ne pas ralentir les insertions. La clé primaire n'est
+    posée que si la colonne est unique et sans valeur manquante ; sinon la
+    colonne reçoit un index simple. Les colonnes absentes de la table sont
+    ignorées.
+
+    Args:
+        table_name (str): Nom de la table.
+        connection: Connexion DB-API à la base (mysql.connector, ou
+            engine.raw_connection() pour SQLAlchemy).
+        spec_name (str, optional): Table dont la spécification s'applique, pour
+            une table de transit destinée à la remplacer. Par défaut à table_name.
+
+    Returns:
+        list: Colonnes indexées.
+    """
+    spec_name = spec_name or table_name
+    cursor = connection.cursor()
+    data_types = _column_types(cursor, table_name)
+
+    clauses = []
+    indexed = []
+    primary_key = PRIMARY_KEYS.get(spec_name)
+    if primary_key in data_types:
+        cursor.execute(
+            f"SELECT COUNT(*) = COUNT(DISTINCT `{primary_key}`) FROM `{table_name}`"
+        )
+        key_part = _key_part(primary_key, data_types[primary_key])
+        if cursor.fetchone()[0]:
+            clauses.append(f"ADD PRIMARY KEY ({key_part})")
+        else:
+            print(f"'{primary_key}' n'est pas unique dans '{spec_name}', index simple.")
+            clauses.append(f"ADD INDEX idx_{primary_key} ({key_part})")
+        indexed.append(primary_key)
+
+    for column in INDEX_SPEC.get(spec_name, []):
+        if column in data_types and column not in indexed:
+            key_part = _key_part(column, data_types[column])
+            clauses.append(f"ADD INDEX idx_{column} ({key_part})")
+            indexed.append(column)
+
+    if clauses:
+        cursor.execute(f"ALTER TABLE `{table_name}` {', '.join(clauses)}")
+    connection.commit()
+    cursor.close()
+    return indexed
+
+
+def index_table(table_name, engine, spec_name=None):
+    """Crée les index de table_name via un moteur SQLAlchemy."""
+    connection = engine.raw_connection()
+    try:
+        return create_indexes(table_name, connection, spec_name)
+    finally:
+        connection.close()
+
+
+def prepare_normalized_columns(table_names, engine):
+    """Ajoute les colonnes normalisées des tables via un moteur SQLAlchemy."""
+    connection = engine.raw_connection()
+    try:
+        for table_name in table_names:
+            add_normalized_columns(table_name, connection)
+    finally:
+        connection.close()
+
+
+def _compact_dtype(series, category):
+    """Type compact de series, sans perte de valeur, ou None pour la garder."""
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype) or pd.api.types.is_bool_dtype(dtype):
+        return None
+    if pd.api.types.is_integer_dtype(dtype):
+        if series.empty:
+            return None
+        downcast = pd.to_numeric(series, downcast="integer").dtype
+        return downcast if downcast != dtype else None
+    if not (pd.api.types.is_string_dtype(dtype) or dtype == object):
+        return None
+    values = series.dropna()
+    if not values.empty and not pd.api.types.is_string_dtype(values):
+        # Object columns of numbers or dates keep their type
+        return None
+    if category:
+        return "category"
+    sample = values.iloc[:SAMPLE_ROWS]
+    if len(values) > len(sample) and sample.is_unique:
+        return None
+    if values.nunique() <= CATEGORY_RATIO * len(series):
+        return "category"
+    return None
+
+
+def compact_frame(df, category_columns=CATEGORY_COLUMNS):
+    """Copie de df aux types les plus compacts, sans perte de valeur.
+
+    Les colonnes texte de category_columns, et les autres colonnes texte dont
+    au plus CATEGORY_RATIO des valeurs sont distinctes, deviennent des
+    catégories ; les entiers prennent le plus petit type qui contient leurs
+    valeurs. Les décimaux gardent leur précision.
+    """
+    category_columns = set(category_columns)
+    dtypes = {}
+    for col, series in df.items():
+        dtype = _compact_dtype(series, col in category_columns)
+        if dtype is not None:
+            dtypes[col] = dtype
+    return df.astype(dtypes) if dtypes else df
+
+
+def expand_categories(df):
+    """df avec ses catégories redevenues des valeurs (avant une écriture)."""
+    categories = {
+        col: series.cat.categories.dtype
+        for col, series in df.items()
+        if isinstance(series.dtype, pd.CategoricalDtype)
+    }
+    return df.astype(categories) if categories else df
+
+
+def drop_unused_categories(df):
+    """df sans les catégories que ses lignes n'utilisent pas.
+
+    Une tranche d'une table compacte garde sinon les catégories de toute la
+    table, qui sont copiées avec elle vers chaque processus.
+    """
+    columns = {
+        col: series.cat.remove_unused_categories()
+        for col, series in df.items()
+        if isinstance(series.dtype, pd.CategoricalDtype)
+    }
+    return df.assign(**columns) if columns else df
+
+
+def align_categories(left, right):
+    """left et right aux mêmes catégories, si ce sont deux colonnes catégorielles.
+
+    pd.merge compare valeur par valeur deux clés aux catégories différentes ;
+    avec les mêmes catégories, il joint directement leurs codes entiers.
+    """
+    categorical = isinstance(left.dtype, pd.CategoricalDtype) and isinstance(
+        right.dtype, pd.CategoricalDtype
+    )
+    if not categorical or left.dtype == right.dtype:
+        return left, right
+    dtype = pd.CategoricalDtype(left.cat.categories.union(right.cat.categories))
+    return left.astype(dtype), right.astype(dtype)
+
+
+def map_categories(series, func):
+    """func appliquée une fois par catégorie de series plutôt qu'à chaque ligne.
+
+    func reçoit des valeurs (pd.Series) et renvoie autant de valeurs. Le
+    résultat d'une colonne catégorielle est catégoriel lui aussi ; une autre
+    colonne est passée telle quelle à func.
+    """
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return func(series)
+    mapped = pd.Categorical(func(series.cat.categories.to_series()))
+    codes = series.cat.codes.to_numpy()
+    # Missing values (code -1) stay missing
+    codes = np.where(codes >= 0, mapped.codes[codes], -1)
+    return pd.Series(
+        pd.Categorical.from_codes(codes, dtype=mapped.dtype),
+        index=series.index,
+        name=series.name,
+    )
@@ -0,0 +1,79 @@
+from sqlalchemy import inspect, text
+from schema import index_table
+from writer import STAGING_SUFFIX, swap_table
+
+
+def table_columns(table_name, engine):
+    """Renvoie les noms des colonnes d'une table, dans leur ordre."""
+    return [column["name"] for column in inspect(engine).get_columns(table_name)]
+
+
+def create_table_as_select(table_name, select, engine):
+    """Remplace table_name par le résultat d'une requête, exécutée dans MySQL.
+
+    Les lignes ne transitent pas par Python ; la table est remplie sous un nom
+    de transit, indexée selon schema.py, puis substituée à l'ancienne.
+
+    Args:
+        table_name (str): Table à créer.
+        select (str): Requête SELECT produisant le contenu de la table.
+        engine (sqlalchemy.Engine): Connexion à la base de données.
+
+    Returns:
+        int: Nombre de lignes de la table créée.
+    """
+    staging = f"{table_name}{STAGING_SUFFIX}"
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS `{staging}`"))
+        # Sent as is, so that colons in the query are not read as parameters
+        connection.exec_driver_sql(f"CREATE TABLE `{staging}` AS {select}")
+        rows = connection.execute(text(f"SELECT COUNT(*) FROM `{staging}`")).scalar()
+    index_table(staging, engine, spec_name=table_name)
+    swap_table(staging, table_name, engine)
+    return int(rows)
+
+
+def left_join_select(left, right, key, engine):
+    """Requête SELECT équivalente à pd.merge(left, right, on=key, how="left").
+
+    Les colonnes portées par les deux tables (hors clé) reçoivent les
+    suffixes _x et _y, comme avec pandas.
+    """
+    return left_join_sql(
+        f"`{left}`",
+        f"`{right}`",
+        table_columns(left, engine),
+        table_columns(right, engine),
+        key,
+    )
+
+
+def left_join_sql(
+    left_source, right_source, left_columns, right_columns, key, quote="`"
+):
+    """Requête SELECT de jointure à gauche entre deux sources déjà citées.
+
+    Args:
+        left_source (str): Table (citée) ou expression de table de gauche.
+        right_source (str): Table (citée) ou expression de table de droite.
+        left_columns (list): Colonnes de la source de gauche.
+        right_columns (list): Colonnes de la source de droite.
+        key (str): Colonne de jointure, présente des deux côtés.
+        quote (str, optional): Caractère de citation des identifiants du moteur.
+    """
+    q = quote
+    right_columns = [col for col in right_columns if col != key]
+    shared = set(left_columns) & set(right_columns)
+
+    selection = [
+        f"l.{q}{col}{q} AS {q}{col}_x{q}" if col in shared else f"l.{q}{col}{q}"
+        for col in left_columns
+    ] + [
+        f"r.{q}{col}{q} AS {q}{col}_y{q}" if col in shared else f"r.{q}{col}{q}"
+        for col in right_columns
+    ]
+    return (
+        f"SELECT {', '.join(selection)} "
+        f"FROM {left_source} l LEFT JOIN {right_source} r "
+        f"ON r.{q}{key}{q} = l.{q}{key}{q}"
+    )
@@ -0,0 +1,316 @@
+import asyncio
+import importlib
+import json
+import time
+from collections import deque
+import numpy as np
+import pandas as pd
+import configparser
+from georesolver import GeoResolver
+from storage import open_storage
+
+# Load configuration
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+SERVICE_HOST = config.get("service", "host", fallback="127.0.0.1")
+SERVICE_PORT = config.getint("service", "port", fallback=8765)
+# Largest batch, and longest wait (ms) for a batch to fill after its first request
+MAX_BATCH = config.getint("service", "batch", fallback=256)
+MAX_DELAY_MS = config.getfloat("service", "delai_ms", fallback=2)
+
+# Fields read from each JSON client; missing ones are null
+CLIENT_FIELDS = ["id_client", "cp", "ville", "lieu_dit", "prenom", "sexe", "age"]
+
+# Fields returned for each client
+RESULT_FIELDS = [
+    "id_client",
+    "c_insee",
+    "c_iris",
+    "c_qualite_iris",
+    "codgeo",
+    "e_sexe",
+    "e_age",
+    "e_top_age_ok",
+    "e_annee_naissance",
+    "indice_conf_age",
+]
+
+# Latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+STATUS_LINES = {
+    200: "200 OK",
+    400: "400 Bad Request",
+    404: "404 Not Found",
+    500: "500 Internal Server Error",
+}
+
+
+class Enricher:
+    """Références de 01.py et 02.py gardées en mémoire, enrichissement par lots.
+
+    Le codgeo est obtenu par GeoResolver (mêmes règles qu'EG_Insee_Iris), puis
+    l'âge et le sexe par les fonctions d'EG_age_sexe. Un âge déclaré remplace
+    l'estimation pour le client qui le fournit (e_top_age_ok = 1).
+
+    Args:
+        resolver (GeoResolver): Index des codes postaux, communes et IRIS.
+        references_age_sexe (tuple): Références renvoyées par
+            charger_references_age_sexe (02.py).
+    """
+
+    def __init__(self, resolver, references_age_sexe):
+        self.resolver = resolver
+        self.references_age_sexe = references_age_sexe
+        self.age_sexe = importlib.import_module("02")
+
+    @classmethod
+    def from_storage(cls, storage, seuil=None):
+        """Charge une fois toutes les références depuis le stockage."""
+        age_sexe = importlib.import_module("02")
+        return cls(
+            GeoResolver.from_storage(storage, seuil),
+            age_sexe.charger_references_age_sexe(storage),
+        )
+
+    def enrich(self, clients):
+        """Enrichit une liste de clients (dictionnaires) ; renvoie une liste de résultats."""
+        current_year = pd.Timestamp.now().year
+        tb_client = pd.DataFrame.from_records(clients, columns=CLIENT_FIELDS)
+        # A client without a first name gets the estimate of an unknown name
+        tb_client["prenom"] = tb_client["prenom"].fillna("").astype(str)
+        geographie = self.resolver.resolve_batch(
+            tb_client["cp"], tb_client["ville"], tb_client["lieu_dit"]
+        )
+        tb_client = tb_client.join(geographie)
+        tb_client = self.age_sexe.estimer_age_sexe(
+            tb_client,
+            self.references_age_sexe,
+            "prenom",
+            "sexe",
+            "NA",
+            1,
+            "codgeo",
+            current_year,
+        )
+        # estimer_age_sexe derives c_insee and c_iris from codgeo: the codes
+        # found by GeoResolver are kept instead
+        tb_client[["c_insee", "c_iris"]] = geographie[["c_insee", "c_iris"]]
+        age = pd.to_numeric(tb_client["age"], errors="coerce")
+        declare = age.notna()
+        tb_client.loc[declare, "e_age"] = age[declare]
+        tb_client.loc[declare, "e_top_age_ok"] = 1
+        tb_client = self.age_sexe.finaliser_age_sexe(tb_client, current_year)
+        # to_json turns NaN into null and numpy scalars into JSON numbers
+        return json.loads(tb_client[RESULT_FIELDS].to_json(orient="records"))
+
+
+class LatencyStats:
+    """Latences des dernières requêtes et tailles des lots traités."""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.requests += 1
+
+    def snapshot(self):
+        """Percentiles des latences (ms) et taille moyenne des lots."""
+        stats = {"requetes": self.requests, "lots": len(self.batch_sizes)}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000
+            for percentile in (50, 90, 99):
+                stats[f"p{percentile}_ms"] = round(
+                    float(np.percentile(latencies, percentile)), 3
+                )
+            stats["max_ms"] = round(float(latencies.max()), 3)
+        if self.batch_sizes:
+            stats["taille_moyenne_lot"] = round(float(np.mean(self.batch_sizes)), 2)
+        return stats
+
+
+class MicroBatcher:
+    """Regroupe les clients de requêtes concurrentes en lots vectorisés.
+
+    Un lot part dès qu'il atteint max_batch clients, ou max_delay secondes
+    après l'arrivée de son premier client. Il est traité dans un thread, de
+    sorte que la boucle asyncio continue d'accepter des requêtes, qui forment
+    le lot suivant. Si le lot échoue, chacun de ses clients est traité seul :
+    seules les requêtes des clients fautifs reçoivent l'erreur.
+    """
+
+    def __init__(self, process, max_batch, max_delay, stats):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = stats
+        self.queue = asyncio.Queue()
+
+    async def submit(self, client):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((client, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.stats.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(
+                    None, self.process, [client for client, _ in batch]
+                )
+            except Exception as err:
+                if len(batch) == 1:
+                    _settle(batch[0][1], error=err)
+                    continue
+                # One bad client must not fail the others: each is retried alone
+                for client, future in batch:
+                    try:
+                        result = await loop.run_in_executor(
+                            None, self.process, [client]
+                        )
+                    except Exception as err:
+                        _settle(future, error=err)
+                    else:
+                        _settle(future, result[0])
+            else:
+                for (_, future), result in zip(batch, results):
+                    _settle(future, result)
+
+
+def _settle(future, result=None, error=None):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class EnrichmentService:
+    """Service HTTP local d'enrichissement (asyncio, sans dépendance externe).
+
+    Routes :
+        POST /enrichir : un client (objet JSON) ou une liste de clients, avec
+            les champs de CLIENT_FIELDS ; renvoie les champs de RESULT_FIELDS.
+        GET /stats : nombre de requêtes, percentiles de latence et taille
+            moyenne des lots.
+
+    Args:
+        enricher (Enricher): Références chargées et enrichissement par lots.
+        max_batch (int): Nombre maximal de clients par lot.
+        max_delay_ms (float): Attente maximale d'un lot incomplet, en millisecondes.
+    """
+
+    def __init__(self, enricher, max_batch=MAX_BATCH, max_delay_ms=MAX_DELAY_MS):
+        self.stats = LatencyStats()
+        self.batcher = MicroBatcher(
+            enricher.enrich, max_batch, max_delay_ms / 1000, self.stats
+        )
+
+    async def start(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        """Démarre le regroupement des lots et l'écoute HTTP ; renvoie le serveur."""
+        self.batcher_task = asyncio.create_task(self.batcher.run())
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def route(self, method, path, body):
+        if method == "GET" and path == "/stats":
+            return 200, self.stats.snapshot()
+        if method != "POST" or path != "/enrichir":
+            return 404, {"erreur": f"Route inconnue : {method} {path}"}
+
+        started = time.perf_counter()
+        try:
+            payload = json.loads(body or b"null")
+        except ValueError as err:
+            return 400, {"erreur": f"JSON invalide : {err}"}
+        clients = payload if isinstance(payload, list) else [payload]
+        if not all(isinstance(client, dict) for client in clients):
+            return 400, {"erreur": "Un client est un objet JSON."}
+
+        try:
+            results = await asyncio.gather(
+                *(self.batcher.submit(client) for client in clients)
+            )
+        except Exception as err:
+            return 500, {"erreur": str(err)}
+        self.stats.record(time.perf_counter() - started)
+        return 200, results if isinstance(payload, list) else results[0]
+
+    async def handle(self, reader, writer):
+        """Traite les requêtes HTTP/1.1 d'une connexion (keep-alive)."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.route(method, path.split("?")[0], body)
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(
+                    (
+                        f"HTTP/1.1 {STATUS_LINES[status]}\r\n"
+                        "Content-Type: application/json; charset=utf-8\r\n"
+                        f"Content-Length: {len(data)}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+                        "\r\n"
+                    ).encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(enricher, host=SERVICE_HOST, port=SERVICE_PORT):
+    """Sert les requêtes jusqu'à l'arrêt du processus."""
+    service = EnrichmentService(enricher)
+    server = await service.start(host, port)
+    print(f"Service d'enrichissement à l'écoute sur http://{host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+# Exemple d'utilisation
+if __name__ == "__main__":
+    # Stockage des tables (section [database] de config.ini)
+    storage = open_storage()
+
+    # Similarité minimale du rapprochement approché (0 : correspondances exactes)
+    SIMILARITE = config.getfloat("enrichissement", "similarite", fallback=0)
+
+    # References are loaded once, before the first request
+    enricher = Enricher.from_storage(storage, SIMILARITE or None)
+    asyncio.run(serve(enricher))
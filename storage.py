@@ -0,0 +1,637 @@
+import glob
+import hashlib
+import os
+import shutil
+import pandas as pd
+from sqlalchemy import create_engine, event, inspect, text
+import configparser
+from instrumentation import step, timed_chunks
+from refcache import add_derived_columns, read_reference_table, table_signature
+from schema import INDEX_SPEC, PRIMARY_KEYS, compact_frame, expand_categories
+from serverside import create_table_as_select, left_join_select, left_join_sql
+from streaming import read_table_in_chunks
+from writer import STAGING_SUFFIX, TableWriter
+
+try:
+    import duckdb
+except ImportError:  # The duckdb backend is unavailable without duckdb
+    duckdb = None
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # The parquet backend is unavailable without pyarrow
+    pq = None
+
+# Load configuration from config.ini
+config = configparser.ConfigParser()
+config.read("./config.ini")
+
+DB_CONFIG = {
+    "host": config["database"]["host"],
+    "user": config["database"]["user"],
+    "password": config["database"]["password"],
+    "database": config["database"]["database"],
+    "port": config["database"].get("port", "3306"),
+}
+
+# Storage backend: mysql, sqlite, duckdb or parquet
+BACKEND = config.get("database", "backend", fallback="mysql")
+# Database file (sqlite, duckdb) or directory (parquet) of the embedded backends
+STORAGE_PATH = config.get("database", "chemin", fallback="")
+
+DEFAULT_PATHS = {
+    "sqlite": "donnees.sqlite",
+    "duckdb": "donnees.duckdb",
+    "parquet": "donnees_parquet",
+}
+
+# DuckDB column types holding numbers, widened to DOUBLE rather than text
+DUCKDB_NUMERIC_TYPES = {
+    "TINYINT",
+    "SMALLINT",
+    "INTEGER",
+    "BIGINT",
+    "HUGEINT",
+    "UTINYINT",
+    "USMALLINT",
+    "UINTEGER",
+    "UBIGINT",
+    "FLOAT",
+    "DOUBLE",
+}
+
+
+def mysql_url():
+    """URL SQLAlchemy de la base MySQL de la section [database]."""
+    return (
+        f"mysql+pymysql://{DB_CONFIG['user']}:{DB_CONFIG['password']}"
+        f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['database']}"
+    )
+
+
+class Storage:
+    """Tables lues et écrites par initfiles.py, 01.py, 02.py, 03.py et les rapports.
+
+    Chaque moteur lit une table (avec les colonnes dérivées de refcache.py), la
+    parcourt par lots, l'écrit par une table de transit substituée d'un coup à
+    l'ancienne, réalise la jointure à gauche de 03.py et renvoie la signature
+    (lignes, checksum) des modes incrémental et pipeline.
+    """
+
+    backend = None
+    engine = None
+    # Quote of the identifiers in the queries of the backend
+    quote = '"'
+    # Whether query() can run SELECT queries on the tables
+    can_query = True
+
+    def read_table(self, table_name):
+        """Contenu de table_name, avec ses colonnes dérivées, aux types compacts."""
+        with step(f"lecture {table_name}") as measured:
+            df = compact_frame(self._read_table(table_name))
+            measured.rows_out = len(df)
+        return df
+
+    def _read_table(self, table_name):
+        raise NotImplementedError
+
+    def table_source(self, table_name):
+        """Expression désignant table_name dans la clause FROM d'une requête."""
+        return f"{self.quote}{table_name}{self.quote}"
+
+    def query(self, select):
+        """Résultat d'une requête SELECT, tel quel (sans colonnes dérivées)."""
+        return pd.read_sql_query(select, self.engine)
+
+    def read_table_in_chunks(self, source, chunksize):
+        """Parcourt une table par lots d'au plus chunksize lignes.
+
+        Args:
+            source (str | iterable): Nom de la table, ou itérable de DataFrames
+                déjà découpés.
+            chunksize (int): Nombre de lignes par lot.
+
+        Yields:
+            pd.DataFrame: Lots successifs, dans l'ordre de la table, aux types
+                compacts.
+        """
+        if not isinstance(source, str):
+            yield from source
+            return
+        chunks = map(compact_frame, self._read_chunks(source, chunksize))
+        yield from timed_chunks(f"lecture {source}", chunks)
+
+    def table_writer(self, table_name):
+        """Écrivain par lots de table_name (contexte : publie ou abandonne la table)."""
+        raise NotImplementedError
+
+    def write_table(self, df, table_name):
+        """Remplace table_name par le contenu de df ; renvoie le nombre de lignes."""
+        with step(f"ecriture {table_name}", rows=len(df)):
+            with self.table_writer(table_name) as writer:
+                writer.write(df)
+        return writer.rows
+
+    def has_table(self, table_name):
+        raise NotImplementedError
+
+    def drop_table(self, table_name):
+        raise NotImplementedError
+
+    def table_signature(self, table_name):
+        """Nombre de lignes et checksum du contenu (ou None) de table_name."""
+        raise NotImplementedError
+
+    def left_join_table(self, left, right, key, table_name):
+        """Remplace table_name par la jointure à gauche de left et right sur key.
+
+        Les colonnes portées par les deux tables (hors clé) reçoivent les
+        suffixes _x et _y, comme avec pd.merge.
+
+        Returns:
+            int: Nombre de lignes de la table créée.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Libère les connexions du stockage."""
+        if self.engine is not None:
+            self.engine.dispose()
+
+    def require_mysql(self, feature):
+        """Refuse une fonctionnalité propre à MySQL sur un autre moteur."""
+        if self.backend != "mysql":
+            raise ValueError(
+                f"{feature} n'est disponible qu'avec le moteur mysql "
+                f"(moteur actuel : {self.backend})."
+            )
+
+
+class MySQLStorage(Storage):
+    """Base MySQL : instantanés de refcache.py, LOAD DATA et RENAME de writer.py."""
+
+    backend = "mysql"
+    quote = "`"
+
+    def __init__(self, url=None):
+        self.engine = create_engine(
+            url or mysql_url(), connect_args={"local_infile": True}
+        )
+
+    def _read_table(self, table_name):
+        return read_reference_table(table_name, self.engine)
+
+    def _read_chunks(self, table_name, chunksize):
+        return read_table_in_chunks(table_name, self.engine, chunksize)
+
+    def table_writer(self, table_name):
+        return TableWriter(table_name, self.engine)
+
+    def has_table(self, table_name):
+        return inspect(self.engine).has_table(table_name)
+
+    def drop_table(self, table_name):
+        with self.engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS `{table_name}`"))
+
+    def table_signature(self, table_name):
+        return table_signature(table_name, self.engine)
+
+    def left_join_table(self, left, right, key, table_name):
+        return create_table_as_select(
+            table_name, left_join_select(left, right, key, self.engine), self.engine
+        )
+
+
+class StagedTableWriter:
+    """Écrivain des moteurs embarqués, à la manière de writer.TableWriter.
+
+    Les lots sont ajoutés à une table de transit, substituée à la table de
+    sortie à la fermeture ; en cas d'erreur, la table de sortie reste intacte.
+    """
+
+    def __init__(self, storage, table_name):
+        self.storage = storage
+        self.table_name = table_name
+        self.staging = f"{table_name}{STAGING_SUFFIX}"
+        self.created = False
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+    def write(self, df):
+        """Ajoute les lignes de df à la table de transit."""
+        # Categories are written as their values, not as ENUM or dictionaries
+        df = expand_categories(df)
+        self.storage.append_rows(self.staging, df, create=not self.created)
+        self.created = True
+        self.rows += len(df)
+
+    def close(self):
+        """Substitue la table de transit à la table de sortie."""
+        if not self.created:
+            # Nothing was written: no output table, as with the MySQL writer
+            self.storage.drop_table(self.table_name)
+            return
+        self.storage.swap_table(self.staging, self.table_name)
+
+    def discard(self):
+        """Abandonne la table de transit ; la table de sortie reste intacte."""
+        self.storage.drop_table(self.staging)
+
+
+def _write_ahead_log(dbapi_connection, connection_record):
+    dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+
+class SQLiteStorage(Storage):
+    """Base SQLite d'un seul fichier, sans serveur.
+
+    La substitution de la table de transit et la création de ses index
+    (INDEX_SPEC et PRIMARY_KEYS de schema.py) forment une seule transaction.
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.engine = create_engine(f"sqlite:///{path}")
+        # Write-ahead log: a table is read by chunks while another one is written
+        event.listen(self.engine, "connect", _write_ahead_log)
+
+    def _read_table(self, table_name):
+        return add_derived_columns(
+            table_name, pd.read_sql_table(table_name, con=self.engine)
+        )
+
+    def _read_chunks(self, table_name, chunksize):
+        return read_table_in_chunks(table_name, self.engine, chunksize)
+
+    def table_writer(self, table_name):
+        return StagedTableWriter(self, table_name)
+
+    def append_rows(self, table_name, df, create):
+        df.to_sql(
+            table_name,
+            self.engine,
+            index=False,
+            if_exists="replace" if create else "append",
+        )
+
+    def has_table(self, table_name):
+        return inspect(self.engine).has_table(table_name)
+
+    def drop_table(self, table_name):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{table_name}"')
+
+    def table_signature(self, table_name):
+        # SQLite has no checksum function: the rows are hashed in rowid order
+        digest = hashlib.sha256()
+        rows = 0
+        with self.engine.connect() as connection:
+            result = connection.exec_driver_sql(
+                f'SELECT * FROM "{table_name}" ORDER BY rowid'
+            )
+            for row in result:
+                digest.update(repr(tuple(row)).encode("utf-8"))
+                rows += 1
+        return {"rows": rows, "checksum": digest.hexdigest()}
+
+    def columns(self, table_name):
+        columns = inspect(self.engine).get_columns(table_name)
+        return [column["name"] for column in columns]
+
+    def swap_table(self, staging, table_name):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{table_name}"')
+            connection.exec_driver_sql(
+                f'ALTER TABLE "{staging}" RENAME TO "{table_name}"'
+            )
+            for statement in self._index_statements(table_name, connection):
+                connection.exec_driver_sql(statement)
+
+    def _index_statements(self, table_name, connection):
+        columns = self.columns(table_name)
+        statements = []
+        primary_key = PRIMARY_KEYS.get(table_name)
+        if primary_key in columns:
+            unique = connection.exec_driver_sql(
+                f'SELECT COUNT("{primary_key}") = COUNT(*) '
+                f'AND COUNT(DISTINCT "{primary_key}") = COUNT(*) FROM "{table_name}"'
+            ).scalar()
+            statements.append(
+                f'CREATE {"UNIQUE " if unique else ""}INDEX '
+                f'"idx_{table_name}_{primary_key}" ON "{table_name}" ("{primary_key}")'
+            )
+        for column in INDEX_SPEC.get(table_name, []):
+            if column in columns and column != primary_key:
+                statements.append(
+                    f'CREATE INDEX "idx_{table_name}_{column}" '
+                    f'ON "{table_name}" ("{column}")'
+                )
+        return statements
+
+    def left_join_table(self, left, right, key, table_name):
+        staging = f"{table_name}{STAGING_SUFFIX}"
+        select = left_join_sql(
+            f'"{left}"',
+            f'"{right}"',
+            self.columns(left),
+            self.columns(right),
+            key,
+            quote='"',
+        )
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{staging}"')
+            connection.exec_driver_sql(f'CREATE TABLE "{staging}" AS {select}')
+            rows = connection.exec_driver_sql(
+                f'SELECT COUNT(*) FROM "{staging}"'
+            ).scalar()
+        self.swap_table(staging, table_name)
+        return int(rows)
+
+
+class DuckDBStorage(Storage):
+    """Base DuckDB d'un seul fichier : moteur colonnaire embarqué.
+
+    Les jointures et agrégations s'exécutent dans DuckDB, sans faire transiter
+    les lignes par un socket. Aucun index n'est créé : DuckDB parcourt ses
+    colonnes par blocs résumés (min/max), ce qui suffit aux jointures.
+    """
+
+    backend = "duckdb"
+
+    def __init__(self, path, read_only=False):
+        if duckdb is None:
+            raise ImportError("Le moteur duckdb nécessite le paquet duckdb.")
+        self.path = path
+        # Only read-only connections may share the file between processes
+        self.read_only = read_only
+        self._connection = None
+
+    @property
+    def connection(self):
+        # Opened on first use, so that importing a script does not lock the file
+        if self._connection is None:
+            self._connection = duckdb.connect(self.path, read_only=self.read_only)
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _read_table(self, table_name):
+        return add_derived_columns(
+            table_name, self.connection.execute(f'SELECT * FROM "{table_name}"').df()
+        )
+
+    def query(self, select):
+        return self.connection.execute(select).df()
+
+    def _read_chunks(self, table_name, chunksize):
+        # A cursor of its own, so that chunks can be written while this one is read
+        cursor = self.connection.cursor()
+        try:
+            reader = cursor.execute(f'SELECT * FROM "{table_name}"').fetch_record_batch(
+                chunksize
+            )
+            for batch in reader:
+                yield batch.to_pandas()
+        finally:
+            cursor.close()
+
+    def table_writer(self, table_name):
+        return StagedTableWriter(self, table_name)
+
+    def append_rows(self, table_name, df, create):
+        self.connection.register("lot", df)
+        try:
+            if create:
+                self.connection.execute(
+                    f'CREATE OR REPLACE TABLE "{table_name}" AS SELECT * FROM lot'
+                )
+                return
+            try:
+                self.connection.execute(
+                    f'INSERT INTO "{table_name}" BY NAME SELECT * FROM lot'
+                )
+            except duckdb.Error:
+                # Data of later batches may not fit the types of the first one
+                self._widen_columns(table_name)
+                self.connection.execute(
+                    f'INSERT INTO "{table_name}" BY NAME SELECT * FROM lot'
+                )
+        finally:
+            self.connection.unregister("lot")
+
+    def _widen_columns(self, table_name):
+        current = self._column_types(f'"{table_name}"')
+        incoming = self._column_types("lot")
+        for column, column_type in incoming.items():
+            if column not in current or current[column] == column_type:
+                continue
+            numeric = {current[column], column_type} <= DUCKDB_NUMERIC_TYPES
+            self.connection.execute(
+                f'ALTER TABLE "{table_name}" ALTER "{column}" '
+                f'TYPE {"DOUBLE" if numeric else "VARCHAR"}'
+            )
+
+    def _column_types(self, relation):
+        described = self.connection.execute(
+            f"DESCRIBE SELECT * FROM {relation}"
+        ).fetchall()
+        return {name: column_type for name, column_type, *_ in described}
+
+    def has_table(self, table_name):
+        return bool(
+            self.connection.execute(
+                "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?",
+                [table_name],
+            ).fetchone()[0]
+        )
+
+    def drop_table(self, table_name):
+        self.connection.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+
+    def table_signature(self, table_name):
+        # Sum of the row hashes: any change to a row changes the checksum
+        rows, checksum = self.connection.execute(
+            f'SELECT COUNT(*), SUM(hash(t)::HUGEINT) FROM "{table_name}" AS t'
+        ).fetchone()
+        return {"rows": int(rows), "checksum": str(checksum or 0)}
+
+    def columns(self, table_name):
+        return list(self._column_types(f'"{table_name}"'))
+
+    def swap_table(self, staging, table_name):
+        self.connection.execute("BEGIN TRANSACTION")
+        try:
+            self.connection.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+            self.connection.execute(f'ALTER TABLE "{staging}" RENAME TO "{table_name}"')
+            self.connection.execute("COMMIT")
+        except duckdb.Error:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def left_join_table(self, left, right, key, table_name):
+        staging = f"{table_name}{STAGING_SUFFIX}"
+        select = left_join_sql(
+            f'"{left}"',
+            f'"{right}"',
+            self.columns(left),
+            self.columns(right),
+            key,
+            quote='"',
+        )
+        self.connection.execute(f'CREATE OR REPLACE TABLE "{staging}" AS {select}')
+        rows = self.connection.execute(f'SELECT COUNT(*) FROM "{staging}"').fetchone()
+        self.swap_table(staging, table_name)
+        return int(rows[0])
+
+
+class ParquetStorage(Storage):
+    """Dossier de fichiers Parquet, sans base de données.
+
+    Chaque table est un sous-dossier de fichiers part-00000.parquet,
+    part-00001.parquet... (un par lot écrit). La table de transit remplace
+    l'ancienne par deux renommages de dossiers. La jointure de 03.py est
+    réalisée par DuckDB directement sur les fichiers s'il est installé, sinon
+    par pandas.
+    """
+
+    backend = "parquet"
+
+    def __init__(self, directory):
+        if pq is None:
+            raise ImportError("Le moteur parquet nécessite le paquet pyarrow.")
+        self.directory = directory
+        # Queries are run by DuckDB directly on the files
+        self.can_query = duckdb is not None
+
+    def table_path(self, table_name):
+        return os.path.join(self.directory, table_name)
+
+    def table_source(self, table_name):
+        pattern = os.path.join(self.table_path(table_name), "part-*.parquet")
+        return f"read_parquet('{pattern}', union_by_name = true)"
+
+    def query(self, select):
+        if duckdb is None:
+            raise ImportError("Les requêtes sur le moteur parquet nécessitent duckdb.")
+        with duckdb.connect() as connection:
+            return connection.execute(select).df()
+
+    def parts(self, table_name):
+        pattern = os.path.join(self.table_path(table_name), "part-*.parquet")
+        return sorted(glob.glob(pattern))
+
+    def _read_table(self, table_name):
+        parts = self.parts(table_name)
+        if not parts:
+            raise ValueError(f"Table '{table_name}' introuvable dans {self.directory}.")
+        frames = [pd.read_parquet(part) for part in parts]
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+        return add_derived_columns(table_name, df)
+
+    def _read_chunks(self, table_name, chunksize):
+        for part in self.parts(table_name):
+            for batch in pq.ParquetFile(part).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+
+    def table_writer(self, table_name):
+        return StagedTableWriter(self, table_name)
+
+    def append_rows(self, table_name, df, create):
+        path = self.table_path(table_name)
+        if create:
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+        part = os.path.join(path, f"part-{len(self.parts(table_name)):05d}.parquet")
+        # One file per batch: each keeps its own types, unified when read
+        df.to_parquet(part, index=False)
+
+    def has_table(self, table_name):
+        return bool(self.parts(table_name))
+
+    def drop_table(self, table_name):
+        shutil.rmtree(self.table_path(table_name), ignore_errors=True)
+
+    def table_signature(self, table_name):
+        parts = self.parts(table_name)
+        rows = sum(pq.ParquetFile(part).metadata.num_rows for part in parts)
+        modified = max((os.stat(part).st_mtime_ns for part in parts), default=0)
+        return {"rows": int(rows), "checksum": f"{len(parts)}:{modified}"}
+
+    def columns(self, table_name):
+        return pq.read_schema(self.parts(table_name)[0]).names
+
+    def swap_table(self, staging, table_name):
+        path = self.table_path(table_name)
+        old = f"{path}__ancienne"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old)
+        os.rename(self.table_path(staging), path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def left_join_table(self, left, right, key, table_name):
+        if duckdb is None:
+            merged_df = pd.merge(
+                self.read_table(left), self.read_table(right), on=key, how="left"
+            )
+            return self.write_table(merged_df, table_name)
+
+        select = left_join_sql(
+            self.table_source(left),
+            self.table_source(right),
+            self.columns(left),
+            self.columns(right),
+            key,
+            quote='"',
+        )
+        staging = f"{table_name}{STAGING_SUFFIX}"
+        self.drop_table(staging)
+        os.makedirs(self.table_path(staging))
+        part = os.path.join(self.table_path(staging), "part-00000.parquet")
+        with duckdb.connect() as connection:
+            connection.execute(f"COPY ({select}) TO '{part}' (FORMAT PARQUET)")
+        self.swap_table(staging, table_name)
+        return self.table_signature(table_name)["rows"]
+
+
+def open_storage(backend=BACKEND, path=STORAGE_PATH, read_only=False):
+    """Ouvre le stockage de la section [database] de config.ini.
+
+    Args:
+        backend (str, optional): mysql, sqlite, duckdb ou parquet.
+        path (str, optional): Fichier de la base (sqlite, duckdb) ou dossier des
+            tables (parquet) ; par défaut, DEFAULT_PATHS.
+        read_only (bool, optional): Stockage seulement lu, que d'autres
+            processus peuvent lire en même temps (DuckDB verrouille sinon son
+            fichier).
+
+    Returns:
+        Storage: Stockage ouvert.
+    """
+    if backend == "mysql":
+        return MySQLStorage()
+    path = path or DEFAULT_PATHS.get(backend)
+    if backend == "sqlite":
+        return SQLiteStorage(path)
+    if backend == "duckdb":
+        return DuckDBStorage(path, read_only)
+    if backend == "parquet":
+        return ParquetStorage(path)
+    raise ValueError(
+        f"Moteur de stockage inconnu : '{backend}' (mysql, sqlite, duckdb ou parquet)."
+    )
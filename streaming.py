@@ -0,0 +1,23 @@
+import pandas as pd
+
+
+def read_table_in_chunks(source, engine, chunksize):
+    """Parcourt une table client par lots de chunksize lignes.
+
+    Le curseur est lu côté serveur (stream_results), de sorte que seul le lot
+    en cours est chargé en mémoire.
+
+    Args:
+        source (str | iterable): Nom de la table, ou itérable de DataFrames déjà découpés.
+        engine (sqlalchemy.Engine): Connexion à la base de données.
+        chunksize (int): Nombre de lignes par lot.
+
+    Yields:
+        pd.DataFrame: Lots successifs, dans l'ordre de la table.
+    """
+    if not isinstance(source, str):
+        yield from source
+        return
+
+    with engine.connect().execution_options(stream_results=True) as connection:
+        yield from pd.read_sql_table(source, con=connection, chunksize=chunksize)
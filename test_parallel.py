@@ -0,0 +1,114 @@
+import importlib
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from parallel import (
+    ORDER_COLUMN,
+    DepartementSlices,
+    departement_from_code,
+    departement_pool,
+    map_by_departement,
+)
+from refcache import DERIVED_COLUMNS
+from schema import compact_frame, drop_unused_categories
+
+insee_iris = importlib.import_module("01")
+
+CHAMPS = {
+    "civilite": "civilit_",
+    "prenom": "prenom",
+    "nom": "nom",
+    "lieu_dit": "lieu_dit",
+    "cp": "cp",
+    "ville": "ville",
+    "id_client": "id_client",
+}
+
+
+def references(compact=False):
+    refcp = pd.DataFrame(
+        {
+            "code_commune_insee": ["01053", "75101"],
+            "nom_de_la_commune": ["BOURG EN BRESSE", "PARIS 01"],
+            "code_postal": ["01000", "75001"],
+        }
+    )
+    ref_iris = pd.DataFrame(
+        {
+            "code_iris": ["010530101", "751010101"],
+            "lib_iris": ["Centre", "Louvre"],
+            "depcom": ["01053", "75101"],
+        }
+    )
+    if compact:
+        refcp, ref_iris = compact_frame(refcp), compact_frame(ref_iris)
+    return insee_iris.indexer_references_insee_iris(
+        DERIVED_COLUMNS["refcp"](refcp),
+        DERIVED_COLUMNS["ref_iris_geo2024"](ref_iris),
+    )
+
+
+def clients():
+    return pd.DataFrame(
+        {
+            "id_client": ["1", "2", "3", "4", "5"],
+            "civilit_": ["M", "Mme", "M", "Mme", "M"],
+            "prenom": ["Jean", "Marie", "Paul", "Anne", "Luc"],
+            "nom": ["Martin", "Durand", "Petit", "Roux", "Blanc"],
+            "cp": ["01000", None, "75001", None, "01000"],
+            "ville": ["Bourg-en-Bresse", "Paris", "Paris 01", None, "Bourg en Bresse"],
+            "lieu_dit": ["Centre", None, "Louvre", None, ""],
+        }
+    )
+
+
+def ajouter_departement(lot, references_departement):
+    return lot.assign(taille_references=len(references_departement))
+
+
+def test_map_by_departement_keeps_rows_without_code():
+    tb = clients()
+    departements = departement_from_code(tb["cp"], 5)
+    slices = DepartementSlices({"01": [1], "75": [1, 2]}, [])
+    with departement_pool(2, slices) as executor:
+        result = map_by_departement(ajouter_departement, tb, departements, (), executor)
+    assert result["id_client"].tolist() == tb["id_client"].tolist()
+    # Rows without a postcode get the empty slice of the references
+    assert result["taille_references"].tolist() == [1, 0, 2, 0, 1]
+
+
+def test_parallel_enrichment_matches_serial_with_null_codes():
+    refs = references()
+    tb = clients()
+    serial = insee_iris.enrichir_insee_iris(tb, refs, 0, CHAMPS)
+    slices = insee_iris.decouper_references_insee_iris(refs)
+    with departement_pool(2, slices) as executor:
+        parallel = map_by_departement(
+            insee_iris.enrichir_insee_iris,
+            tb,
+            departement_from_code(tb["cp"], 5),
+            (0, {**CHAMPS, ORDER_COLUMN: ORDER_COLUMN}, None),
+            executor,
+        )
+    assert len(parallel) == len(tb)
+    assert_frame_equal(parallel, serial)
+
+
+def test_parallel_enrichment_ships_only_used_categories():
+    refs = references(compact=True)
+    tb = compact_frame(clients())
+    slices = insee_iris.decouper_references_insee_iris(refs)
+    # Each slice keeps its own categories, not those of the whole table
+    assert slices["75"][0]["code_postal"].cat.categories.tolist() == ["75001"]
+    assert slices["75"][1]["depcom"].cat.categories.tolist() == ["75101"]
+    serial = insee_iris.enrichir_insee_iris(tb, refs, 0, CHAMPS)
+    with departement_pool(2, slices) as executor:
+        parallel = map_by_departement(
+            insee_iris.enrichir_insee_iris,
+            tb,
+            departement_from_code(tb["cp"], 5),
+            (0, {**CHAMPS, ORDER_COLUMN: ORDER_COLUMN}, None),
+            executor,
+        )
+    assert_frame_equal(
+        drop_unused_categories(parallel), drop_unused_categories(serial)
+    )
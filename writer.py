@@ -0,0 +1,198 @@
+import csv
+import os
+import tempfile
+import pandas as pd
+from sqlalchemy import inspect, text
+from schema import (
+    OUTPUT_TYPES,
+    column_summary,
+    expand_categories,
+    index_table,
+    summary_sql_type,
+    widen_columns,
+)
+
+# Suffix of the staging table filled before it replaces the output table
+STAGING_SUFFIX = "__nouvelle"
+
+# Rows per multi-row INSERT when LOAD DATA LOCAL INFILE is refused
+INSERT_BATCH_SIZE = 5000
+
+# Missing values in the staging file, turned back into NULL while loading
+NULL_MARKER = "\\N"
+
+
+def swap_table(staging, table_name, engine):
+    """Remplace table_name par staging en un seul RENAME TABLE.
+
+    Les lecteurs voient l'ancienne table ou la nouvelle, jamais une table
+    vide ou partiellement écrite.
+    """
+    old = f"{table_name}__ancienne"
+    exists = inspect(engine).has_table(table_name)
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS `{old}`"))
+        if exists:
+            connection.execute(
+                text(
+                    f"RENAME TABLE `{table_name}` TO `{old}`, "
+                    f"`{staging}` TO `{table_name}`"
+                )
+            )
+        else:
+            connection.execute(text(f"RENAME TABLE `{staging}` TO `{table_name}`"))
+        connection.execute(text(f"DROP TABLE IF EXISTS `{old}`"))
+
+
+def _csv_ready(df):
+    """Copie de df où les booléens sont écrits 0/1, comme MySQL les attend."""
+    bools = [col for col in df.columns if pd.api.types.is_bool_dtype(df[col])]
+    if not bools:
+        return df
+    return df.astype({col: "Int8" for col in bools})
+
+
+class TableWriter:
+    """Écrit une table de sortie par lots, puis la publie d'un seul coup.
+
+    Les lots sont chargés dans une table de transit au schéma explicite
+    (OUTPUT_TYPES de schema.py, sinon le type le plus compact des valeurs du
+    premier lot, élargi si un lot suivant ne tient plus). Chaque lot passe par
+    un fichier CSV chargé avec LOAD DATA LOCAL INFILE, ou par des INSERT
+    multi-lignes si le serveur le refuse. À la fermeture, la table de transit
+    est indexée puis renommée en table de sortie.
+
+    Args:
+        table_name (str): Table de sortie.
+        engine (sqlalchemy.Engine): Connexion à la base de données, créée avec
+            connect_args={"local_infile": True} pour permettre LOAD DATA.
+    """
+
+    def __init__(self, table_name, engine):
+        self.table_name = table_name
+        self.staging = f"{table_name}{STAGING_SUFFIX}"
+        self.engine = engine
+        self.columns = None
+        self.rows = 0
+        self.load_data = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+        return False
+
+    def write(self, df):
+        """Ajoute les lignes de df à la table de transit."""
+        # Categories are written as their values, not as a code type
+        df = expand_categories(df)
+        connection = self.engine.raw_connection()
+        try:
+            if self.columns is None:
+                self._create(df, connection)
+            else:
+                # Data of later batches may not fit the types picked so far
+                widen_columns(self.staging, df, connection)
+            df = _csv_ready(df[self.columns])
+            if len(df) > 0:
+                if self.load_data:
+                    try:
+                        self._load_data(df, connection)
+                    except self.engine.dialect.dbapi.Error as err:
+                        connection.rollback()
+                        print(f"LOAD DATA refusé ({err}), INSERT multi-lignes.")
+                        self.load_data = False
+                if not self.load_data:
+                    self._insert(df, connection)
+            connection.commit()
+        finally:
+            connection.close()
+        self.rows += len(df)
+
+    def close(self):
+        """Indexe la table de transit et la substitue à la table de sortie."""
+        if self.columns is None:
+            # Nothing was written: no output table, as when pandas writes nothing
+            with self.engine.begin() as connection:
+                connection.execute(text(f"DROP TABLE IF EXISTS `{self.table_name}`"))
+            return
+        index_table(self.staging, self.engine, spec_name=self.table_name)
+        swap_table(self.staging, self.table_name, self.engine)
+
+    def discard(self):
+        """Abandonne la table de transit ; la table de sortie reste intacte."""
+        with self.engine.begin() as connection:
+            connection.execute(text(f"DROP TABLE IF EXISTS `{self.staging}`"))
+
+    def _create(self, df, connection):
+        explicit = OUTPUT_TYPES.get(self.table_name, {})
+        definitions = [
+            f"`{col}` {explicit.get(col) or summary_sql_type(column_summary(df[col]))}"
+            for col in df.columns
+        ]
+        cursor = connection.cursor()
+        cursor.execute(f"DROP TABLE IF EXISTS `{self.staging}`")
+        cursor.execute(f"CREATE TABLE `{self.staging}` ({', '.join(definitions)})")
+        cursor.close()
+        self.columns = list(df.columns)
+        # Explicit types are checked against the data like the inferred ones
+        widen_columns(self.staging, df, connection)
+
+    def _load_data(self, df, connection):
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".csv", encoding="utf-8", newline="", delete=False
+        ) as staging_file:
+            df.to_csv(
+                staging_file,
+                index=False,
+                header=False,
+                na_rep=NULL_MARKER,
+                quoting=csv.QUOTE_MINIMAL,
+                lineterminator="\n",
+            )
+        try:
+            variables = ", ".join(f"@v{i}" for i in range(len(self.columns)))
+            # '\\N' in SQL is the two characters of NULL_MARKER
+            assignments = ", ".join(
+                f"`{col}` = IF(@v{i} = '\\\\N', NULL, @v{i})"
+                for i, col in enumerate(self.columns)
+            )
+            path = staging_file.name.replace(os.sep, "/")
+            cursor = connection.cursor()
+            cursor.execute(
+                f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE `{self.staging}` "
+                "CHARACTER SET utf8mb4 "
+                "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+                "LINES TERMINATED BY '\\n' "
+                f"({variables}) SET {assignments}"
+            )
+            cursor.close()
+        finally:
+            os.remove(staging_file.name)
+
+    def _insert(self, df, connection):
+        columns = ", ".join(f"`{col}`" for col in self.columns)
+        marker = "?" if self.engine.dialect.paramstyle == "qmark" else "%s"
+        placeholders = ", ".join([marker] * len(self.columns))
+        query = f"INSERT INTO `{self.staging}` ({columns}) VALUES ({placeholders})"
+        cursor = connection.cursor()
+        for start in range(0, len(df), INSERT_BATCH_SIZE):
+            batch = df.iloc[start : start + INSERT_BATCH_SIZE].astype(object)
+            batch = batch.where(batch.notna(), None)
+            cursor.executemany(query, list(batch.itertuples(index=False, name=None)))
+        cursor.close()
+
+
+def write_table(df, table_name, engine):
+    """Remplace table_name par le contenu de df à travers un TableWriter.
+
+    Returns:
+        int: Nombre de lignes écrites.
+    """
+    with TableWriter(table_name, engine) as writer:
+        writer.write(df)
+    return writer.rows